@@ -1 +1 @@
-from . import schemas, crud, models, dependencies, config, database, api, errors, services
+from . import schemas, crud, models, dependencies, config, database, api, errors, services, hashing, cache, tasks, instrumentation, ratelimit, migrations, session_store, keys
@@ -1,2 +1,4 @@
 from .user import user_router
 from .user_session import session_router
+from .metrics import metrics_router
+from .well_known import well_known_router
@@ -0,0 +1,128 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from app.cache import session_cache, token_cache, user_cache
+from app.database import async_engine, replica_engine, pool_metrics, pool_stats
+from app.dependencies import metrics_access
+from app.hashing import password_hasher
+from app.instrumentation import format_labels, request_metrics, summary_samples
+from app.ratelimit import login_throttle
+from app.tasks import password_rehasher, session_refresher
+
+# internal: for the scraper and operators, see METRICS_TOKEN
+metrics_router = APIRouter(
+    prefix="/metrics",
+    dependencies=[Depends(metrics_access)],
+    include_in_schema=False,
+)
+
+
+@metrics_router.get("", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Per route request metrics plus the hashing, pool and cache metrics below, in the Prometheus text format
+    :return:
+    """
+    lines = request_metrics.render()
+
+    lines += ["# HELP password_hashing_seconds Time per password hash or verify, including the queue",
+              "# TYPE password_hashing_seconds summary"]
+    for operation, stats in password_hasher.latency.items():
+        lines += summary_samples("password_hashing_seconds", {"operation": operation}, stats)
+    lines += ["# TYPE password_hashing_pending gauge", f"password_hashing_pending {password_hasher.pending}",
+              "# TYPE password_hashing_rejected_total counter",
+              f"password_hashing_rejected_total {password_hasher.rejected}",
+              "# HELP password_rehash_total Outdated password hashes replaced after a login, by outcome",
+              "# TYPE password_rehash_total counter"]
+    lines += [f"password_rehash_total{format_labels({'outcome': outcome})} {getattr(password_rehasher, outcome)}"
+              for outcome in ("rehashed", "skipped", "failed")]
+
+    engines = {"primary": async_engine, "replica": replica_engine}
+    lines += ["# HELP db_pool_checkout_seconds Time to check a connection out of the pool",
+              "# TYPE db_pool_checkout_seconds summary"]
+    for name, engine in engines.items():
+        if engine is not None:
+            lines += summary_samples("db_pool_checkout_seconds", {"pool": name}, pool_stats[name].wait)
+    lines += ["# TYPE db_pool_checked_out gauge"]
+    lines += [f"db_pool_checked_out{format_labels({'pool': name})} {engine.pool.checkedout()}"
+              for name, engine in engines.items() if engine is not None and hasattr(engine.pool, "checkedout")]
+    lines += ["# TYPE db_pool_timeouts_total counter"]
+    lines += [f"db_pool_timeouts_total{format_labels({'pool': name})} {pool_stats[name].timeouts}"
+              for name, engine in engines.items() if engine is not None]
+
+    lines += ["# HELP login_throttled_total Login attempts rejected before checking credentials, by reason",
+              "# TYPE login_throttled_total counter"]
+    lines += [f"login_throttled_total{format_labels({'reason': reason})} {count}"
+              for reason, count in login_throttle.rejected.items()]
+    lines += ["# TYPE login_lockouts_total counter", f"login_lockouts_total {login_throttle.lockouts}"]
+
+    lines += ["# HELP session_refresh_pending Session extensions buffered for the next batched write",
+              "# TYPE session_refresh_pending gauge", f"session_refresh_pending {session_refresher.pending}",
+              "# TYPE session_refresh_flushed_total counter",
+              f"session_refresh_flushed_total {session_refresher.flushed}",
+              "# TYPE session_refresh_dropped_total counter",
+              f"session_refresh_dropped_total {session_refresher.dropped}"]
+
+    caches = {"session": session_cache.metrics(), "token": token_cache.metrics(), "user": user_cache.metrics()}
+    lines += ["# TYPE cache_hit_ratio gauge"]
+    lines += [f"cache_hit_ratio{format_labels({'cache': name})} {metrics['hit_rate']}"
+              for name, metrics in caches.items()]
+
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+@metrics_router.get("/hashing")
+async def hashing_metrics():
+    """
+    Password hashing pool occupancy and per-call latency, and the rehashes of outdated hashes
+    :return:
+    """
+    return {**password_hasher.metrics(), "rehash": password_rehasher.metrics()}
+
+
+@metrics_router.get("/session-cache")
+async def session_cache_metrics():
+    """
+    Session resolution cache size and hit rate
+    :return:
+    """
+    return session_cache.metrics()
+
+
+@metrics_router.get("/session-refresh")
+async def session_refresh_metrics():
+    """
+    Sliding expiry: session extensions waiting to be written, written, and skipped because the buffer was full
+    :return:
+    """
+    return session_refresher.metrics()
+
+
+@metrics_router.get("/auth-cache")
+async def auth_cache_metrics():
+    """
+    Verified token and user snapshot cache size and hit rate
+    :return:
+    """
+    return {"tokens": token_cache.metrics(), "users": user_cache.metrics()}
+
+
+@metrics_router.get("/pool")
+async def connection_pool_metrics():
+    """
+    Database connection pool occupancy, overflow and checkout wait times
+    :return:
+    """
+    metrics = {"primary": pool_metrics(async_engine, pool_stats["primary"])}
+    if replica_engine is not None:
+        metrics["replica"] = pool_metrics(replica_engine, pool_stats["replica"])
+    return metrics
+
+
+@metrics_router.get("/rate-limit")
+async def rate_limit_metrics():
+    """
+    Login attempts rejected by the rate limiter or an account lockout
+    :return:
+    """
+    return login_throttle.metrics()
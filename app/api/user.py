@@ -1,63 +1,136 @@
-from fastapi import Depends, APIRouter
-from sqlalchemy.orm import Session
+from fastapi import Depends, APIRouter, Header, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app import schemas, crud, services
+from app import schemas, services
+from app.config import USER_HTTP_MAX_AGE
 from app.dependencies import get_db, get_session_user, cross_validate_user
 
 user_router = APIRouter(
     prefix="/user"
 )
 
+# /me depends on the session cookie, so only the browser may keep it, and must check back every time
+_PRIVATE = "private, no-cache"
+_PUBLIC = f"public, max-age={USER_HTTP_MAX_AGE}"
+
+
+def _etag(user_id: int, version: int) -> str:
+    # strong: every change to a user bumps its version
+    return f'"{user_id}.{version}"'
+
+
+def _matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag, with the weak comparison RFC 9110 asks for
+    :param if_none_match:   The header, a list of ETags or "*"
+    :param etag:            The current ETag
+    :return:                Whether the client's copy is current
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in if_none_match.split(","))
+
+
+def _not_modified(etag: str, cache_control: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
 @user_router.post("/", response_model=schemas.User)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     """
     Create a new user
     :param user:    The user to create
     :param db:      The database session
     :return:
     """
-    return services.user.create_user(user, db)
+    return await services.user.create_user(user, db)
 
 
-@user_router.get("/me", response_model=schemas.User)
-def read_users_me(current_user: schemas.User = Depends(get_session_user)):
+@user_router.get("/me", response_model=schemas.User, responses={304: {"description": "Not modified"}})
+async def read_users_me(response: Response, current_user: schemas.User = Depends(get_session_user),
+                        if_none_match: str | None = Header(None)):
     """
     Get the current user using the access token
+    Answers 304 without a body if If-None-Match carries the current ETag.
+    :param response:
     :param current_user:
+    :param if_none_match:
     :return:
     """
+    etag = _etag(current_user.id, current_user.version)
+    if _matches(if_none_match, etag):
+        return _not_modified(etag, _PRIVATE)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = _PRIVATE
     return current_user
 
 
-@user_router.get("/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
+@user_router.get("/export")
+async def export_users():
+    """
+    Stream every user as newline delimited JSON, without building the whole list in memory
+    :return:    An NDJSON stream of users
+    """
+    return StreamingResponse(services.user.export_users(), media_type="application/x-ndjson")
+
+
+@user_router.get("/{user_id}", response_model=schemas.User, responses={304: {"description": "Not modified"}})
+async def read_user(user_id: int, response: Response, if_none_match: str | None = Header(None),
+                    db: AsyncSession = Depends(get_db)):
     """
     Get a user by their ID
-    :param user_id:     The ID of the user to get
-    :param db:          The database session
-    :return:            The user with the given ID
+    Answers 304 without a body if If-None-Match carries the current ETag, straight from the version cache
+    when it knows the user, otherwise after loading it.
+    :param user_id:         The ID of the user to get
+    :param response:        The response, to set the caching headers on
+    :param if_none_match:   The ETags of the client's copies
+    :param db:              The database session
+    :return:                The user with the given ID
     """
-    return services.user.get_user_by_id(user_id, db)
+    if if_none_match and (version := services.user.get_cached_version(user_id)) is not None:
+        if _matches(if_none_match, etag := _etag(user_id, version)):
+            return _not_modified(etag, _PUBLIC)
+
+    user = await services.user.get_user_by_id(user_id, db)
+    etag = _etag(user.id, user.version)
+    if _matches(if_none_match, etag):
+        return _not_modified(etag, _PUBLIC)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = _PUBLIC
+    return user
 
 
 # TODO: make this possibly use auth or user session once permissions are somehow added
 #       to the system so that the amount of users returned can be limited, handle this in services
 @user_router.get("/", response_model=list[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+async def read_users(skip: int = 0, limit: int = 100, cursor: str | None = None,
+                     db: AsyncSession = Depends(get_db)):
     """
-    Get a list of users
-    :param skip:    The number of users to skip
-    :param limit:   The maximum number of users to return
-    :param db:      The database session
-    :return:        A list of users
+    Get a list of users, ordered by ID.
+    Pass the X-Next-Cursor header of a page as `cursor` to get the next one, `skip` is kept for older clients
+    but gets slower the deeper the page.
+    The page is validated and dumped to JSON in one pass through schemas.UserList, the response_model is only
+    there for the docs: returning a Response skips FastAPI's validate, dump to dicts and encode again.
+    :param skip:        The number of users to skip, ignored if a cursor is given
+    :param limit:       The maximum number of users to return
+    :param cursor:      The cursor of the page to get
+    :param db:          The database session
+    :return:            A list of users
     """
-    return services.user.get_users(skip=skip, limit=limit, db=db)
+    users = await services.user.get_users(skip=skip, limit=limit, db=db, cursor=cursor)
+    response = Response(schemas.UserList.dump_json(schemas.UserList.validate_python(users, from_attributes=True)),
+                        media_type="application/json")
+    if next_cursor := services.user.next_cursor(users, limit):
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 
 @user_router.put("/me", response_model=schemas.User)
-def update_user_me(updates: schemas.UserUpdate,
-                   current_user: schemas.User = Depends(cross_validate_user),
-                   db: Session = Depends(get_db)):
+async def update_user_me(updates: schemas.UserUpdate,
+                         current_user: schemas.User = Depends(cross_validate_user),
+                         db: AsyncSession = Depends(get_db)):
     """
     Update any aspect of a user, including possibly password, username, or deactivating account.
     Requires authentication token.
@@ -67,13 +140,13 @@ def update_user_me(updates: schemas.UserUpdate,
     :return:
     """
 
-    return services.user.update_user(db, current_user.id, updates)
+    return await services.user.update_user(db, current_user.id, updates)
 
 
 @user_router.delete("/me", response_model=schemas.User)
-def delete_user_me(
+async def delete_user_me(
                 current_user: schemas.User = Depends(cross_validate_user),
-                db: Session = Depends(get_db)):
+                db: AsyncSession = Depends(get_db)):
     """
     Delete a user.
     Requires user to be logged in and provide username and password again for security reasons.
@@ -82,4 +155,4 @@ def delete_user_me(
     :return:
     """
 
-    return crud.user.delete(db, current_user.id)
+    return await services.user.delete_user(db, current_user.id)
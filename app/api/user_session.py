@@ -1,9 +1,8 @@
-from fastapi import APIRouter, Depends, Response
-from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Form, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import schemas, services
-from app.dependencies import get_db, authenticate_user, get_session_user
+from app.dependencies import authenticate_user, get_db, get_session_user
 
 session_router = APIRouter(
     prefix="/session"
@@ -11,44 +10,51 @@ session_router = APIRouter(
 
 
 @session_router.post("/auth", response_model=schemas.Token)
-def generate_auth_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def generate_auth_token(user: schemas.User = Depends(authenticate_user), db: AsyncSession = Depends(get_db)):
     """
-    Login a user to get an authentication token
-    :param form_data:   The form data containing the username and password
-    :param db:          The database session
+    Login a user to get an authentication token, and a refresh token to renew it without the password
+    :param user:    The user, authenticated from the form data containing the username and password
+    :param db:      The database session
+    :return:
+    """
+    return await services.user_session.issue_tokens(user, db)
+
+
+@session_router.post("/refresh", response_model=schemas.Token)
+async def refresh_auth_token(refresh_token: str = Form(...), db: AsyncSession = Depends(get_db)):
+    """
+    Exchange a refresh token for a new authentication token and a new refresh token.
+    A refresh token works once: using it again revokes every token descended from the same login
+    :param refresh_token:   The refresh token from /session/auth or the previous refresh
+    :param db:              The database session
     :return:
     """
-    user = services.user.verify_credentials(form_data, db)
-    access_token = services.user_session.create_access_token(data={"sub": user.username})
-    return {"access_token": access_token, "token_type": "bearer"}
+    return await services.user_session.refresh_tokens(refresh_token, db)
 
 
 @session_router.post("/login")
-def login(
+async def login(
         response: Response,
         user: schemas.User = Depends(authenticate_user),
-        db: Session = Depends(get_db),
 ):
     """
     Login a user to get an authentication token
     :param response:
     :param user:
-    :param db:
     :return:
     """
-    user_session = services.user_session.session_login(user, db)
-    response.set_cookie(key="session_id", value=str(user_session.session_id),
+    token = await services.user_session.session_login(user)
+    response.set_cookie(key="session_id", value=token,
                         httponly=True)  # http only helps with security
     return {"message": "Logged in successfully"}
 
 
 @session_router.post("/logout")
-def logout(
+async def logout(
         response: Response,  # Inject the Response object to delete the cookie
         current_user: schemas.User = Depends(get_session_user),
-        db: Session = Depends(get_db),
 ):
 
-    services.user_session.session_logout(current_user, db)
+    await services.user_session.session_logout(current_user)
     response.delete_cookie(key="session_id")
     return {"message": "Logged out successfully"}
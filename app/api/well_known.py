@@ -0,0 +1,19 @@
+from fastapi import APIRouter, Response
+
+from app.config import JWKS_MAX_AGE
+from app.keys import key_ring
+
+well_known_router = APIRouter(
+    prefix="/.well-known"
+)
+
+
+@well_known_router.get("/jwks.json")
+async def jwks():
+    """
+    The public keys access tokens are signed with, as a JWK set, for services that verify tokens themselves.
+    Includes keys that don't sign yet or anymore, match a token's kid header against them
+    :return:
+    """
+    return Response(key_ring.jwks(), media_type="application/json",
+                    headers={"Cache-Control": f"public, max-age={JWKS_MAX_AGE}"})
@@ -0,0 +1,270 @@
+import hashlib
+import importlib
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any
+
+from app import schemas
+from app.config import (SESSION_CACHE_SIZE, SESSION_CACHE_LOCAL_TTL, SESSION_CACHE_BACKEND, TOKEN_CACHE_SIZE,
+                        USER_CACHE_SIZE, USER_CACHE_TTL, USER_VERSION_CACHE_SIZE)
+
+
+class CacheBackend:
+    """
+    A cache shared between processes, e.g. redis or memcached.
+    Values are opaque bytes, expiry is in seconds from now.
+    """
+
+    async def get(self, key: str) -> bytes | None:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+
+
+class InMemoryBackend(CacheBackend):
+    """
+    Process local stand-in for a shared backend, for tests and development.
+    """
+
+    def __init__(self):
+        self._data: dict[str, tuple[bytes, float]] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        if (entry := self._data.get(key)) is None:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._data.pop(key, None)
+
+
+def load_backend(spec: str | None) -> CacheBackend | None:
+    """
+    Build a backend from a config value
+    :param spec:    None, "memory", or "package.module:Class" for a CacheBackend subclass
+    :return:        The backend, or None if no shared backend is configured
+    """
+    if not spec:
+        return None
+    if spec == "memory":
+        return InMemoryBackend()
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class LRUCache:
+    """
+    Bounded least recently used cache where every entry carries its own expiry.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: OrderedDict[Any, tuple[Any, float]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key) -> Any | None:
+        if (entry := self._data.get(key)) is None:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class SessionCache:
+    """
+    Caches the user a session cookie resolves to, so authenticated requests skip the session + user queries.
+    Keyed by the digest of the session token, like the session store, never by the token itself.
+
+    Entries carry the session's expiry, for sliding expiration, and never outlive it. The local LRU is additionally
+    capped at `local_ttl` seconds, since invalidations made by other processes only reach the shared backend. With a
+    `local_ttl` of 0 nothing is kept locally and every lookup goes to the shared backend, which is how the forked
+    workers of `app.server` run so that a logout on one worker holds on all of them.
+    """
+
+    def __init__(self, max_entries: int, local_ttl: float, backend: CacheBackend | None = None):
+        self.local = LRUCache(max_entries)
+        self.local_ttl = local_ttl
+        self.backend = backend
+        self.hits_local = 0
+        self.hits_shared = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token_hash: bytes) -> str:
+        return f"session:{token_hash.hex()}"
+
+    async def get(self, token_hash: bytes) -> schemas.SessionUser | None:
+        key = self._key(token_hash)
+        if (session := self.local.get(key)) is not None:
+            self.hits_local += 1
+            return session
+
+        if self.backend is not None and (raw := await self.backend.get(key)) is not None:
+            self.hits_shared += 1
+            session = schemas.SessionUser.model_validate_json(raw)
+            if self.local_ttl > 0:
+                self.local.set(key, session, min((session.expires_at - datetime.utcnow()).total_seconds(),
+                                                 self.local_ttl))
+            return session
+
+        self.misses += 1
+        return None
+
+    async def set(self, token_hash: bytes, user: schemas.User, expires_at: datetime):
+        ttl = (expires_at - datetime.utcnow()).total_seconds()
+        if ttl <= 0:
+            return
+        key = self._key(token_hash)
+        session = schemas.SessionUser(user=user, expires_at=expires_at)
+        if self.local_ttl > 0:
+            self.local.set(key, session, min(ttl, self.local_ttl))
+        if self.backend is not None:
+            await self.backend.set(key, session.model_dump_json().encode(), ttl)
+
+    async def invalidate(self, *token_hashes: bytes):
+        keys = [self._key(token_hash) for token_hash in token_hashes]
+        for key in keys:
+            self.local.delete(key)
+        if self.backend is not None and keys:
+            await self.backend.delete(*keys)
+
+    def metrics(self) -> dict:
+        lookups = self.hits_local + self.hits_shared + self.misses
+        return {
+            "entries": len(self.local),
+            "hits_local": self.hits_local,
+            "hits_shared": self.hits_shared,
+            "misses": self.misses,
+            "hit_rate": (self.hits_local + self.hits_shared) / lookups if lookups else 0.0,
+        }
+
+
+class TokenCache:
+    """
+    Access tokens that have already been verified, so a repeated token skips the signature check and decode.
+    Keyed by the token's digest, each entry expires with the token's exp claim.
+    """
+
+    def __init__(self, max_entries: int):
+        self.local = LRUCache(max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> str | None:
+        if (subject := self.local.get(self._key(token))) is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return subject
+
+    def set(self, token: str, subject: str, exp: int | float):
+        if (ttl := exp - time.time()) > 0:
+            self.local.set(self._key(token), subject, ttl)
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.local),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class UserCache:
+    """
+    Snapshots of users by id, with a username -> id index for the token path, and the last seen version of
+    many more users than there are snapshots, for conditional GETs.
+    Kept for at most `ttl` seconds, invalidate() is wired to crud.user.update / delete.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_versions: int):
+        self.by_id = LRUCache(max_entries)
+        self.ids_by_username = LRUCache(max_entries)
+        self.versions = LRUCache(max_versions)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get_by_id(self, user_id: int) -> schemas.User | None:
+        if (user := self.by_id.get(user_id)) is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return user
+
+    def get_by_username(self, username: str) -> schemas.User | None:
+        user_id = self.ids_by_username.get(username)
+        user = self.by_id.get(user_id) if user_id is not None else None
+        # the index can outlive a rename, only trust it if the snapshot still carries the username
+        if user is None or user.username != username:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return user
+
+    def get_version(self, user_id: int) -> int | None:
+        return self.versions.get(user_id)
+
+    def set_version(self, user_id: int, version: int):
+        self.versions.set(user_id, version, self.ttl)
+
+    def set(self, user: schemas.User):
+        self.by_id.set(user.id, user, self.ttl)
+        self.ids_by_username.set(user.username, user.id, self.ttl)
+        self.set_version(user.id, user.version)
+
+    def invalidate(self, user_id: int):
+        if (user := self.by_id.get(user_id)) is not None:
+            self.ids_by_username.delete(user.username)
+        self.by_id.delete(user_id)
+        self.versions.delete(user_id)
+
+    def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.by_id),
+            "versions": len(self.versions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_LOCAL_TTL, load_backend(SESSION_CACHE_BACKEND))
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL, USER_VERSION_CACHE_SIZE)
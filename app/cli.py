@@ -0,0 +1,220 @@
+"""
+Command line tools for running the backend.
+
+usage: python -m app.cli serve --workers 4
+       python -m app.cli migrate
+       python -m app.cli schema-version
+       python -m app.cli import-users users.jsonl
+       python -m app.cli rotate-key --prune
+       python -m app.cli calibrate-hashing --target-ms 250
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+from pathlib import Path
+
+from app.config import (BULK_MAX_USERS, BULK_CHUNK_SIZE, SERVER_HOST, SERVER_PORT, SERVER_WORKERS,
+                        SERVER_GRACEFUL_TIMEOUT, SERVER_MAX_REQUESTS, SERVER_MAX_REQUESTS_JITTER,
+                        JWT_KEY_ACTIVATION_SECONDS, PASSWORD_HASH_TARGET_MS)
+
+
+def read_users(path: Path) -> list[dict]:
+    """
+    Read users from a JSON array, a JSON lines or a CSV file, going by the extension
+    :param path:    The file to read
+    :return:        The users, as UserCreate fields
+    """
+    with path.open(newline="") as file:
+        if path.suffix == ".csv":
+            # empty cells are missing values, e.g. no display name
+            return [{key: value for key, value in row.items() if value} for row in csv.DictReader(file)]
+        if path.suffix == ".json":
+            return json.load(file)
+        return [json.loads(line) for line in file if line.strip()]
+
+
+async def import_users(users: list[dict], batch_size: int, chunk_size: int) -> int:
+    """
+    Create users through services.user.create_users, `batch_size` at a time.
+    Exits without touching the database if it hasn't been migrated, that is left to `migrate`.
+    :param users:       The users to create
+    :param batch_size:  The number of users per create_users call
+    :param chunk_size:  The number of users per INSERT
+    :return:            The number of users that could not be created
+    """
+    from app import migrations, services
+    from app.database import AsyncSessionLocal, async_engine
+    from app.hashing import password_hasher
+
+    try:
+        await migrations.check(async_engine)
+    except migrations.SchemaOutOfDateError as schema_error:
+        await async_engine.dispose()
+        sys.exit(f"{schema_error}\nimport-users never migrates, run `fast-backend migrate` first")
+    password_hasher.start()
+    failed = 0
+    try:
+        for start in range(0, len(users), batch_size):
+            async with AsyncSessionLocal() as db:
+                result = await services.user.create_users(users[start:start + batch_size], db,
+                                                          chunk_size=chunk_size)
+            for error in result.errors:
+                field = f" {error.field}:" if error.field else ""
+                print(f"row {start + error.index}:{field} {error.detail}", file=sys.stderr)
+            failed += len(result.errors)
+            print(f"{min(start + batch_size, len(users))}/{len(users)} processed, {result.created} created")
+    finally:
+        password_hasher.shutdown()
+        await async_engine.dispose()
+    return failed
+
+
+def migrate() -> int:
+    """
+    Apply the pending schema migrations
+    :return:    The schema version afterwards
+    """
+    from app import migrations
+    from app.database import engine
+
+    before, after = migrations.migrate(engine)
+    if before == after:
+        print(f"schema is up to date at version {after}")
+    else:
+        print(f"schema migrated from version {before if before is not None else 'none'} to {after}")
+    return after
+
+
+def schema_version() -> bool:
+    """
+    Print the database's schema version next to the one this code expects
+    :return:    Whether the database is up to date
+    """
+    from app import migrations
+    from app.database import engine
+
+    with engine.connect() as conn:
+        version = migrations.read_version(conn)
+    print(f"database: {version if version is not None else 'not managed'}, code: {migrations.LATEST_VERSION}")
+    return version is not None and version >= migrations.LATEST_VERSION
+
+
+def rotate_key(prune: bool) -> str:
+    """
+    Add a signing key to JWT_KEY_DIR, it takes over from the current one after JWT_KEY_ACTIVATION_SECONDS
+    :param prune:   Also delete the keys whose tokens have all expired
+    :return:        The kid of the new key
+    """
+    from app.config import ALGORITHM, JWT_KEY_DIR
+    from app.keys import generate_key, key_ring
+
+    if key_ring.symmetric or not JWT_KEY_DIR:
+        sys.exit(f"rotate-key needs an asymmetric HASH_ALGORITHM and JWT_KEY_DIR, not {ALGORITHM}")
+    if prune:
+        for key in key_ring.retired():
+            Path(JWT_KEY_DIR, f"{key.kid}.pem").unlink()
+            print(f"removed key {key.kid}")
+    kid = generate_key(ALGORITHM, JWT_KEY_DIR)
+    print(f"added key {kid}, it starts signing in {JWT_KEY_ACTIVATION_SECONDS:.0f} seconds")
+    return kid
+
+
+def calibrate_hashing(profiles: list[str], target_ms: float, seconds: float) -> str | None:
+    """
+    Time each password hash cost profile on this host, one core at a time, and tune each to the target latency
+    :param profiles:    HASH_PROFILES names or "scheme:setting=value,..." specs
+    :param target_ms:   The latency per hash to tune to
+    :param seconds:     How long to time each profile for
+    :return:            The name of the profile closest to the target without going over, None if none is
+    """
+    import os
+    from passlib.registry import get_crypt_handler
+
+    from app.config import PASSWORD_HASH_PROFILE, CRYPT_SCHEME
+    from app.hashing import measure_profile, parse_profile, tune_profile
+
+    cores = os.cpu_count() or 1
+    current = PASSWORD_HASH_PROFILE or CRYPT_SCHEME
+    best, best_seconds = None, 0.0
+    print(f"{'profile':<22} {'ms/hash':>9} {'hashes/s/core':>14} {f'hashes/s x{cores}':>14}   "
+          f"tuned to {target_ms:.0f} ms")
+    for profile in profiles:
+        scheme, _ = parse_profile(profile)
+        if not get_crypt_handler(scheme).has_backend():
+            print(f"{profile:<22} skipped, no {scheme} backend installed (the argon2 extra, argon2-cffi)")
+            continue
+        seconds_per_hash = measure_profile(profile, seconds)
+        tuned = tune_profile(profile, target_ms / 1000, seconds_per_hash)
+        marker = " (current)" if profile == current else ""
+        print(f"{profile:<22} {seconds_per_hash * 1000:>9.1f} {1 / seconds_per_hash:>14.1f} "
+              f"{cores / seconds_per_hash:>14.1f}   {tuned}{marker}")
+        if best_seconds < seconds_per_hash <= target_ms / 1000:
+            best, best_seconds = profile, seconds_per_hash
+    if best:
+        print(f"closest to {target_ms:.0f} ms: PASSWORD_HASH_PROFILE={best}, or a tuned spec from above")
+    return best
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="run the app on several worker processes")
+    serve_parser.add_argument("--host", default=SERVER_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVER_PORT)
+    serve_parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                              help="worker processes (default: %(default)s)")
+    serve_parser.add_argument("--max-requests", type=int, default=SERVER_MAX_REQUESTS,
+                              help="replace a worker after this many requests, 0 to never (default: %(default)s)")
+    serve_parser.add_argument("--max-requests-jitter", type=int, default=SERVER_MAX_REQUESTS_JITTER,
+                              help="add up to this many requests to each worker's limit (default: %(default)s)")
+    serve_parser.add_argument("--graceful-timeout", type=int, default=SERVER_GRACEFUL_TIMEOUT,
+                              help="seconds in-flight requests get after SIGTERM (default: %(default)s)")
+
+    commands.add_parser("migrate", help="create the tables or apply pending schema migrations")
+    commands.add_parser("schema-version", help="show the schema version, exits with 1 if migrations are pending")
+
+    rotate_parser = commands.add_parser("rotate-key", help="add a JWT signing key, for asymmetric HASH_ALGORITHMs")
+    rotate_parser.add_argument("--prune", action="store_true",
+                               help="first delete the keys no unexpired token was signed with")
+
+    calibrate_parser = commands.add_parser("calibrate-hashing",
+                                           help="time the password hash cost profiles and tune them to a latency")
+    calibrate_parser.add_argument("profiles", nargs="*",
+                                  help="profiles or scheme:setting=value,... specs (default: every named profile)")
+    calibrate_parser.add_argument("--target-ms", type=float, default=PASSWORD_HASH_TARGET_MS,
+                                  help="latency per hash to tune to (default: %(default)s)")
+    calibrate_parser.add_argument("--seconds", type=float, default=2,
+                                  help="time spent hashing per profile (default: %(default)s)")
+
+    import_parser = commands.add_parser("import-users", help="create users from a .json, .jsonl or .csv file")
+    import_parser.add_argument("path", type=Path)
+    import_parser.add_argument("--batch-size", type=int, default=BULK_MAX_USERS,
+                               help="users checked and hashed together (default: %(default)s)")
+    import_parser.add_argument("--chunk-size", type=int, default=BULK_CHUNK_SIZE,
+                               help="users per INSERT and transaction (default: %(default)s)")
+
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        from app.server import serve
+        sys.exit(serve(args.host, args.port, args.workers, args.max_requests, args.max_requests_jitter,
+                       args.graceful_timeout))
+    elif args.command == "migrate":
+        migrate()
+    elif args.command == "schema-version":
+        sys.exit(0 if schema_version() else 1)
+    elif args.command == "rotate-key":
+        rotate_key(args.prune)
+    elif args.command == "calibrate-hashing":
+        from app.hashing import HASH_PROFILES
+        calibrate_hashing(args.profiles or list(HASH_PROFILES), args.target_ms, args.seconds)
+    elif args.command == "import-users":
+        failed = asyncio.run(import_users(read_users(args.path), min(args.batch_size, BULK_MAX_USERS),
+                                          args.chunk_size))
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
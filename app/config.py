@@ -1,10 +1,142 @@
 import os
 
 from fastapi.security import OAuth2PasswordBearer
-from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=[os.getenv("CRYPT_SCHEME")], deprecated="auto")
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("HASH_ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="session/auth")
+
+# asymmetric HASH_ALGORITHMs (RS256, ES256, EdDSA, ...) sign with the private keys in this directory, <kid>.pem,
+# and publish the public keys at /.well-known/jwks.json, see app.keys. HS* algorithms use SECRET_KEY
+JWT_KEY_DIR = os.getenv("JWT_KEY_DIR")
+# a new key is published this long before it signs, at least as long as verifiers cache the key set
+JWT_KEY_ACTIVATION_SECONDS = float(os.getenv("JWT_KEY_ACTIVATION_SECONDS", 600))
+# how often each process checks the key directory for added or removed keys
+JWT_KEY_RELOAD_SECONDS = float(os.getenv("JWT_KEY_RELOAD_SECONDS", 30))
+# Cache-Control max-age of /.well-known/jwks.json
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", 300))
+
+# scheme of new password hashes when PASSWORD_HASH_PROFILE is unset, with passlib's default cost
+CRYPT_SCHEME = os.getenv("CRYPT_SCHEME")
+# cost profile of new password hashes: a name from app.hashing.HASH_PROFILES or "scheme:setting=value,...",
+# `python -m app.cli calibrate-hashing` measures them on this host. Hashes with any other scheme or cost are
+# replaced in the background after the user's next successful login
+PASSWORD_HASH_PROFILE = os.getenv("PASSWORD_HASH_PROFILE")
+# the hashing latency calibrate-hashing tunes the profiles to, in milliseconds
+PASSWORD_HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", 250))
+# set to false to keep outdated hashes as they are
+PASSWORD_REHASH_ON_LOGIN = os.getenv("PASSWORD_REHASH_ON_LOGIN", "true").lower() in ("1", "true", "yes")
+
+# password hashing runs in a process pool so bcrypt does not hold the GIL on the request path
+# under `app.cli serve` both are for the whole machine, and split between the web workers
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", os.cpu_count() or 1))
+# hashes queued or running before new requests are rejected with a 503
+HASH_POOL_MAX_PENDING = int(os.getenv("HASH_POOL_MAX_PENDING", HASH_POOL_WORKERS * 4))
+# chunks of an import's passwords hashing at once, on top of max pending. More wait for a free slot
+HASH_POOL_MAX_BATCH_CHUNKS = int(os.getenv("HASH_POOL_MAX_BATCH_CHUNKS", HASH_POOL_WORKERS))
+
+# resolved session -> user lookups, kept per process and optionally in a shared backend
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+# upper bound on how long a process trusts its local copy, other processes' invalidations only reach the shared backend.
+# `fast-backend serve` with more than one worker forces it to 0, so a logout or password change on one worker is seen
+# by the others at once: lookups go to the shared backend, or to the database when none is configured
+SESSION_CACHE_LOCAL_TTL = float(os.getenv("SESSION_CACHE_LOCAL_TTL", 30))
+# "memory" for the in-process stand-in, "package.module:Class" for a custom CacheBackend, unset for none
+SESSION_CACHE_BACKEND = os.getenv("SESSION_CACHE_BACKEND")
+
+# verified access tokens, keyed by digest and kept until their exp claim
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+# user snapshots for the token and session paths, invalidated by crud.user.update / delete
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+# user id -> version, answers conditional GETs without loading the user, kept for USER_CACHE_TTL like the snapshots
+USER_VERSION_CACHE_SIZE = int(os.getenv("USER_VERSION_CACHE_SIZE", 100000))
+# Cache-Control max-age of GET /user/{user_id}, clients revalidate with If-None-Match after it
+USER_HTTP_MAX_AGE = int(os.getenv("USER_HTTP_MAX_AGE", 30))
+
+# `python -m app.cli serve`: address, web worker processes, and graceful shutdown
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1))
+# seconds in-flight requests get to finish after SIGTERM before they are cancelled
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+# a worker is replaced after this many requests (plus up to the jitter, so they don't all go at once), 0 to never
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", 0))
+SERVER_MAX_REQUESTS_JITTER = int(os.getenv("SERVER_MAX_REQUESTS_JITTER", 0))
+
+# run the schema migrations on startup instead of only checking the schema version, for development
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() in ("1", "true", "yes")
+
+# refresh tokens from /session/auth, exchanged at /session/refresh for a new access token and a new refresh token
+REFRESH_TOKEN_EXPIRE_DAYS = float(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 30))
+
+# rows fetched per round trip when streaming GET /user/export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+# background deletion of expired sessions, set the interval to 0 to disable
+SESSION_REAPER_INTERVAL = float(os.getenv("SESSION_REAPER_INTERVAL", 60))
+SESSION_REAPER_BATCH_SIZE = int(os.getenv("SESSION_REAPER_BATCH_SIZE", 1000))
+
+# a user's oldest sessions past this many are deleted at login
+MAX_SESSIONS_PER_USER = int(os.getenv("MAX_SESSIONS_PER_USER", 5))
+# how long a session lasts after login
+SESSION_LIFETIME_SECONDS = float(os.getenv("SESSION_LIFETIME_SECONDS", 3600))
+# sliding expiry: once this fraction of its lifetime has passed, a session used again is extended to a full lifetime
+SESSION_REFRESH_AFTER = float(os.getenv("SESSION_REFRESH_AFTER", 0.5))
+# extensions are buffered per process and written in batched UPDATEs every interval seconds (0 for fixed expiry),
+# or as soon as the buffer holds MAX_PENDING sessions; while it is full, further extensions wait for a later request
+SESSION_REFRESH_INTERVAL = float(os.getenv("SESSION_REFRESH_INTERVAL", 10))
+SESSION_REFRESH_MAX_PENDING = int(os.getenv("SESSION_REFRESH_MAX_PENDING", 10000))
+# where sessions live: unset for the user_sessions table, "memory" for the in-process stand-in,
+# "package.module:Class" for a custom SessionStore, e.g. on a key-value store away from the users database
+SESSION_STORE = os.getenv("SESSION_STORE")
+
+# /metrics and /metrics/*: when set, scrapers send "Authorization: Bearer <METRICS_TOKEN>". When unset, only
+# clients on this host are answered, which behind a reverse proxy on the same host is everyone: set a token there
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# development aid: maximum queries a single request may run, unset to disable
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET")) if os.getenv("QUERY_BUDGET") else None
+# "log" to warn about requests over budget, "raise" to fail them at the query that crossed it (for tests)
+QUERY_BUDGET_MODE = os.getenv("QUERY_BUDGET_MODE", "log")
+
+# `fast-backend import-users`: users checked and hashed together, and users per INSERT / transaction
+BULK_MAX_USERS = int(os.getenv("BULK_MAX_USERS", 10000))
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 1000))
+
+# statements slower than this many seconds are logged with their parameters and crud caller, unset to disable
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS")) if os.getenv("SLOW_QUERY_SECONDS") else None
+
+# per request cProfile dumps, off unless PROFILE_DIR is set
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+# requests with this header are profiled, when PROFILE_TOKEN is set the header value has to match it
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+# fraction of all other requests to profile
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+
+# login attempts (/session/login, /session/auth): token buckets per client ip and per username
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", 30))
+RATE_LIMIT_IP_BURST = int(os.getenv("RATE_LIMIT_IP_BURST", 10))
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", 10))
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", 5))
+# keys kept by the in-memory backend, the least recently used are dropped past this
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+# unset for in-memory, "package.module:Class" for a custom RateLimitBackend shared between processes
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND")
+# after this many failed logins in a row an account is locked, for twice as long with every further failure
+LOCKOUT_THRESHOLD = int(os.getenv("LOCKOUT_THRESHOLD", 5))
+LOCKOUT_BASE_SECONDS = float(os.getenv("LOCKOUT_BASE_SECONDS", 30))
+LOCKOUT_MAX_SECONDS = float(os.getenv("LOCKOUT_MAX_SECONDS", 900))
+# failed logins are forgotten after this long without another one
+LOCKOUT_WINDOW_SECONDS = float(os.getenv("LOCKOUT_WINDOW_SECONDS", 3600))
+
+
+def __getattr__(name: str):
+    # pwd_context is built on first use: passlib is only needed by the hashing workers and the CLI
+    if name == "pwd_context":
+        from app.hashing import crypt_context
+        globals()["pwd_context"] = crypt_context(PASSWORD_HASH_PROFILE or CRYPT_SCHEME)
+        return globals()["pwd_context"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
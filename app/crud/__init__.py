@@ -1,2 +1,2 @@
-from . import user_session, user
+from . import user_session, user, refresh_token
 
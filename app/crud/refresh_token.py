@@ -0,0 +1,117 @@
+import secrets
+from datetime import datetime
+
+from sqlalchemy import select, update, delete as sql_delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models
+
+
+class RefreshTokenReuseError(Exception):
+    """
+    A refresh token was presented after it had already been exchanged, by the client or by someone who copied it
+    """
+
+    def __init__(self, user_id: int, family_id: int):
+        super().__init__(f"Refresh token reused for user {user_id}")
+        self.user_id = user_id
+        self.family_id = family_id
+
+
+async def create(db: AsyncSession, user_id: int, token_hash: bytes,
+                 family_id: int | None = None, expires_at: datetime | None = None) -> models.RefreshToken:
+    """
+    Create a new refresh token
+    :param db:          The database session
+    :param user_id:     The ID of the user
+    :param token_hash:  The digest of the token
+    :param family_id:   The family of the token it replaces, a new family if not given
+    :param expires_at:  When the token expires, the column default if not given
+    :return:            The created token
+    """
+    db_token = models.RefreshToken(user_id=user_id, token_hash=token_hash,
+                                   family_id=family_id if family_id is not None else secrets.randbits(63),
+                                   **({"expires_at": expires_at} if expires_at else {}))
+    db.add(db_token)
+    await db.commit()
+    return db_token
+
+
+async def rotate(db: AsyncSession, token_hash: bytes, new_token_hash: bytes,
+                 expires_at: datetime | None = None) -> models.RefreshToken | None:
+    """
+    Exchange a refresh token for a new one in the same family, in one transaction: a lookup through the unique
+    index, an UPDATE that marks the old token used, and the INSERT of the new one.
+    The UPDATE only succeeds for a token not used before, so of two concurrent exchanges of the same token
+    one gets through and the other counts as reuse.
+    :param db:              The database session
+    :param token_hash:      The digest of the token presented
+    :param new_token_hash:  The digest of the token to replace it with
+    :param expires_at:      When the new token expires, the column default if not given
+    :return:                The new token, None if the presented one is unknown or expired
+    :raises RefreshTokenReuseError: If the presented token was already used. Its whole family is deleted first
+    """
+    now = datetime.utcnow()
+    db_token = await db.scalar(select(models.RefreshToken).filter(models.RefreshToken.token_hash == token_hash,
+                                                                  models.RefreshToken.expires_at > now))
+    if db_token is None:
+        return None
+    user_id, family_id = db_token.user_id, db_token.family_id
+
+    claimed = await db.execute(update(models.RefreshToken)
+                               .filter(models.RefreshToken.id == db_token.id, models.RefreshToken.used_at.is_(None))
+                               .values(used_at=now).execution_options(synchronize_session=False))
+    if claimed.rowcount != 1:
+        await db.rollback()
+        await delete_family(db, family_id)
+        raise RefreshTokenReuseError(user_id, family_id)
+
+    db_new_token = models.RefreshToken(user_id=user_id, token_hash=new_token_hash, family_id=family_id,
+                                       **({"expires_at": expires_at} if expires_at else {}))
+    db.add(db_new_token)
+    await db.commit()
+    return db_new_token
+
+
+async def delete_family(db: AsyncSession, family_id: int) -> int:
+    """
+    Revoke every token descended from the same login
+    :param db:          The database session
+    :param family_id:   The family of the tokens
+    :return:            The number of deleted tokens
+    """
+    result = await db.execute(sql_delete(models.RefreshToken).filter(models.RefreshToken.family_id == family_id))
+    await db.commit()
+    return result.rowcount
+
+
+async def delete_by_user(db: AsyncSession, user_id: int, commit: bool = True) -> int:
+    """
+    Revoke every refresh token of a user
+    :param db:          The database session
+    :param user_id:     The ID of the user
+    :param commit:      False to leave the delete in the caller's transaction
+    :return:            The number of deleted tokens
+    """
+    result = await db.execute(sql_delete(models.RefreshToken).filter(models.RefreshToken.user_id == user_id))
+    if commit:
+        await db.commit()
+    return result.rowcount
+
+
+async def delete_expired(db: AsyncSession, batch_size: int) -> int:
+    """
+    Delete one batch of expired refresh tokens, used or not, in its own short transaction
+    :param db:          The database session
+    :param batch_size:  The maximum number of tokens to delete
+    :return:            The number of deleted tokens
+    """
+    expired_ids = list(await db.scalars(select(models.RefreshToken.id).filter(
+        models.RefreshToken.expires_at < datetime.utcnow()).order_by(models.RefreshToken.expires_at)
+        .limit(batch_size)))
+    if not expired_ids:
+        return 0
+
+    await db.execute(sql_delete(models.RefreshToken).filter(models.RefreshToken.id.in_(expired_ids)))
+    await db.commit()
+    return len(expired_ids)
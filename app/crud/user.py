@@ -1,105 +1,242 @@
-from sqlalchemy.orm import Session
+import re
+from typing import AsyncIterator, Awaitable, Callable, Sequence
+
+from sqlalchemy import insert, or_, select, update as sql_update, delete as sql_delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from sqlalchemy.sql.base import ExecutableOption
 
 from app import models
 
+# reads that may be served by the read replica, see database.RoutingSession. Only for reads shown to users:
+# the replica lags, and stickiness only covers the client that wrote, so anything that checks credentials or
+# reads a row to update it has to see the primary
+REPLICA = {"replica": True}
+
+# called with (db, user) after a user is updated, or right before it is deleted, to drop cached copies
+InvalidationHook = Callable[[AsyncSession, models.User], Awaitable[None]]
+invalidation_hooks: list[InvalidationHook] = []
+
+
+def register_invalidation_hook(hook: InvalidationHook) -> InvalidationHook:
+    """
+    Register a hook to run whenever a user changes, usable as a decorator
+    :param hook:    The coroutine function to call with the database session and the user
+    :return:        The hook
+    """
+    invalidation_hooks.append(hook)
+    return hook
+
+
+# the unique column in a duplicate key error: "users.email" (sqlite), "ix_users_email" (mysql, postgres)
+_DUPLICATE_COLUMN = re.compile(r"(?:users\.|ix_users_)(email|username)\b")
+
+
+def duplicate_field(error: IntegrityError) -> str | None:
+    """
+    Find which unique column of the users table an IntegrityError is about
+    :param error:   The error raised by an INSERT or UPDATE
+    :return:        "email", "username", or None if it is about something else
+    """
+    # mysql puts the duplicated value before the key name, so the last match is the key
+    matches = _DUPLICATE_COLUMN.findall(str(error.orig))
+    return matches[-1] if matches else None
+
+
+async def _invalidate(db: AsyncSession, db_user: models.User):
+    for hook in invalidation_hooks:
+        await hook(db, db_user)
 
-def create(db: Session, user: dict) -> models.User | None:
+
+async def create(db: AsyncSession, user: dict) -> models.User | None:
     """
-    Create a new user
+    Create a new user, the unique indexes on email and username reject duplicates
     :param db:      The database session
     :param user:    The user to create
     :return:        The created user
+    :raises IntegrityError: If the email or username is taken, see duplicate_field. The session is rolled back
     """
-    # TODO handle errors adding to db
-
     db_user = models.User(**user)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise
+    await db.refresh(db_user)
     return db_user
 
 
-def read_by_id(db: Session, user_id: int) -> models.User | None:
+async def create_many(db: AsyncSession, users: list[dict]) -> int:
+    """
+    Create users with a multi-row INSERT, in one transaction
+    :param db:      The database session
+    :param users:   The users to create
+    :return:        The number of created users
+    :raises IntegrityError: If any email or username is taken, nothing is created and the session is rolled back
+    """
+    if users:
+        try:
+            await db.execute(insert(models.User), users)
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            raise
+    return len(users)
+
+
+async def read_by_id(db: AsyncSession, user_id: int, options: Sequence[ExecutableOption] = (),
+                     replica: bool = False) -> models.User | None:
     """
     Get a user by their ID
     :param db:          The database session
     :param user_id:     The ID of the user to get
+    :param options:     Loader options for relationships, e.g. selectinload(models.User.user_sessions)
+    :param replica:     Let the read replica answer, for display only, see REPLICA
     :return:            The user with the given ID
     """
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return await db.scalar(select(models.User).options(*options).filter(models.User.id == user_id)
+                          .execution_options(replica=replica))
 
 
-def read_by_session_id(db: Session, session_id: int) -> models.User | None:
-    """
-    Get a user by their session ID
-    :param db:          The database session
-    :param session_id:  The ID of the session to get the user for
-    :return:            The user with the given session ID
-    """
-    db_session = db.query(models.UserSession).filter(
-        models.UserSession.session_id == session_id).first()
-    if db_session:
-        return db_session.user
-    else:
-        return None
-
-
-def read_by_username(db: Session, username: str) -> models.User | None:
+async def read_by_username(db: AsyncSession, username: str, options: Sequence[ExecutableOption] = (),
+                           replica: bool = False) -> models.User | None:
     """
     Get a user by their username
     :param db:          The database session
     :param username:    The username of the user to get
+    :param options:     Loader options for relationships, e.g. selectinload(models.User.user_sessions)
+    :param replica:     Let the read replica answer, for display only, see REPLICA
     :return:            The user with the given username
     """
     if username is None: return None
-    return db.query(models.User).filter(models.User.username == username).first()
+    return await db.scalar(select(models.User).options(*options).filter(models.User.username == username)
+                          .execution_options(replica=replica))
 
 
-def read_by_email(db: Session, email: str) -> models.User | None:
+async def read_by_email(db: AsyncSession, email: str, options: Sequence[ExecutableOption] = (),
+                        replica: bool = False) -> models.User | None:
     """
     Get a user by their email address
     :param db:          The database session
     :param email:       The email address of the user to get
+    :param options:     Loader options for relationships, e.g. selectinload(models.User.user_sessions)
+    :param replica:     Let the read replica answer, for display only, see REPLICA
     :return:            The user with the given email address
     """
     if email is None: return None
-    return db.query(models.User).filter(models.User.email == email).first()
+    return await db.scalar(select(models.User).options(*options).filter(models.User.email == email)
+                          .execution_options(replica=replica))
 
 
-def read(db: Session, skip: int = 0, limit: int = 100) -> list[models.User] | None:
+async def read_taken(db: AsyncSession, emails: list[str], usernames: list[str]) -> tuple[set[str], set[str]]:
     """
-    Get all users
+    Find which of the given emails and usernames are already registered, in one query
     :param db:          The database session
-    :param skip:        The number of users to skip
+    :param emails:      The email addresses to check
+    :param usernames:   The usernames to check
+    :return:            The taken emails and the taken usernames
+    """
+    if not emails and not usernames:
+        return set(), set()
+    # primary only: this guards inserts, a lagging replica would let duplicates through
+    rows = await db.execute(select(models.User.email, models.User.username).filter(
+        or_(models.User.email.in_(emails), models.User.username.in_(usernames))))
+    taken_emails, taken_usernames = set(), set()
+    for email, username in rows:
+        taken_emails.add(email)
+        taken_usernames.add(username)
+    return taken_emails & set(emails), taken_usernames & set(usernames)
+
+
+async def read(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None,
+               options: Sequence[ExecutableOption] = ()) -> list[models.User] | None:
+    """
+    Get all users, ordered by ID
+    :param db:          The database session
+    :param skip:        The number of users to skip, ignored if after_id is given
     :param limit:       The maximum number of users to return
+    :param after_id:    Only return users with an ID greater than this (keyset pagination)
+    :param options:     Loader options for relationships, e.g. selectinload(models.User.user_sessions)
     :return:            A list of users
     """
-    return db.query(models.User).offset(skip).limit(limit).all()
+    query = select(models.User).options(*options).order_by(models.User.id).limit(limit).execution_options(**REPLICA)
+    if after_id is not None:
+        # seeks straight to the position through the primary key, unlike offset which reads every skipped row
+        query = query.filter(models.User.id > after_id)
+    else:
+        query = query.offset(skip)
+    return list(await db.scalars(query))
 
 
-def update(db: Session, db_user: models.User, update_data: dict) -> models.User | None:
+async def stream(db: AsyncSession, batch_size: int = 1000) -> AsyncIterator[list[models.User]]:
+    """
+    Stream all users, ordered by ID, without loading the whole table into memory
+    :param db:          The database session
+    :param batch_size:  The number of users fetched per round trip
+    :return:            An iterator over batches of users
+    """
+    result = await db.stream_scalars(
+        select(models.User).order_by(models.User.id).execution_options(yield_per=batch_size, **REPLICA))
+    async for batch in result.partitions():
+        yield batch
+
+
+async def update(db: AsyncSession, db_user: models.User, update_data: dict) -> models.User | None:
     # if new password is set it will be in hashed_password already set from the service layer
     # all other dict keys will be same name as column in db
     # so we can just set them all at once
+    # a taken email or username raises IntegrityError (see duplicate_field) after rolling back, together with
+    # anything the caller left uncommitted in the session, e.g. the refresh tokens revoked by a password change
     for key, value in update_data.items():
         setattr(db_user, key, value)
+    # incremented in the UPDATE itself, so concurrent updates each get their own version
+    db_user.version = models.User.version + 1
+
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise
+    await db.refresh(db_user)
+    await _invalidate(db, db_user)
+    return db_user
 
 
-    db.commit()
-    db.refresh(db_user)
-    return db_user
+async def replace_password_hash(db: AsyncSession, user_id: int, old_hash: str, new_hash: str) -> bool:
+    """
+    Swap a password hash for a new hash of the same password, e.g. with the current cost profile.
+    Not an update of the user: no new version, no invalidation hooks
+    :param db:          The database session
+    :param user_id:     The ID of the user
+    :param old_hash:    The hash the new one was made to replace
+    :param new_hash:    The new hash
+    :return:            Whether it was replaced, False if the password changed in the meantime
+    """
+    result = await db.execute(sql_update(models.User)
+                              .filter(models.User.id == user_id, models.User.hashed_password == old_hash)
+                              .values(hashed_password=new_hash).execution_options(synchronize_session=False))
+    await db.commit()
+    return result.rowcount == 1
 
 
-def delete(db: Session, user_id: int) -> models.User:
+async def delete(db: AsyncSession, user_id: int) -> models.User | None:
     """
     Delete a user by their ID
     :param db:          The database session
     :param user_id:     The ID of the user to delete
-    :return:            The deleted user
+    :return:            The deleted user, None if there was no user with that ID, e.g. after a concurrent delete
     """
-    db_user = db.query(models.User).filter(models.User.id == user_id).first()
-    db.delete(db_user)
-    db.commit()
+    # the sessions are loaded up front so the delete can detach them, the relationship never lazy loads
+    db_user = await db.scalar(select(models.User).options(selectinload(models.User.user_sessions))
+                              .filter(models.User.id == user_id))
+    if db_user is None:
+        return None
+    # before the delete, while the user's sessions can still be found
+    await _invalidate(db, db_user)
+    # in the same transaction, the foreign key would reject the delete otherwise
+    await db.execute(sql_delete(models.RefreshToken).filter(models.RefreshToken.user_id == user_id))
+    await db.delete(db_user)
+    await db.commit()
     return db_user
-
-
@@ -1,58 +1,118 @@
 from datetime import timedelta, datetime
+from typing import Sequence
 
-from sqlalchemy.orm import Session
+from sqlalchemy import bindparam, select, update, delete as sql_delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.base import ExecutableOption
 
 from app import models
 
 
-def create(db: Session, user_id: int) -> models.UserSession:
+async def create(db: AsyncSession, user_id: int, token_hash: bytes,
+                 expires_at: datetime | None = None) -> models.UserSession:
     """
     Create a new session
     :param db:          The database session
-    :param session:     The session to create
+    :param user_id:     The ID of the user
+    :param token_hash:  The digest of the session token
+    :param expires_at:  When the session expires, the column default if not given
     :return:            The created session
     """
 
-    db_session = models.UserSession(user_id=user_id, )
+    db_session = models.UserSession(user_id=user_id, token_hash=token_hash,
+                                    **({"expires_at": expires_at} if expires_at else {}))
     db.add(db_session)
-    db.commit()
-    db.refresh(db_session)
+    await db.commit()
+    await db.refresh(db_session)
     return db_session
 
 
-def read_by_id(db: Session, session_id: int) -> models.UserSession | None:
+async def create_capped(db: AsyncSession, user_id: int, token_hash: bytes, max_sessions: int,
+                        expires_at: datetime | None = None) -> tuple[models.UserSession, list[bytes]]:
+    """
+    Create a new session and delete all but the user's `max_sessions` newest, in one transaction
+    :param db:              The database session
+    :param user_id:         The ID of the user
+    :param token_hash:      The digest of the session token
+    :param max_sessions:    The number of sessions the user may keep, including the new one
+    :param expires_at:      When the session expires, the column default if not given
+    :return:                The created session and the token digests of the deleted ones
+    """
+    db_session = models.UserSession(user_id=user_id, token_hash=token_hash,
+                                    **({"expires_at": expires_at} if expires_at else {}))
+    db.add(db_session)
+    await db.flush()
+
+    newest = (select(models.UserSession.session_id)
+              .filter(models.UserSession.user_id == user_id)
+              .order_by(models.UserSession.created_at.desc(), models.UserSession.session_id.desc())
+              .limit(max_sessions)
+              .subquery())
+    # the extra derived table is what lets mysql use LIMIT inside NOT IN on the table being deleted from
+    stale = (models.UserSession.user_id == user_id,
+             models.UserSession.session_id.not_in(select(newest.c.session_id)))
+
+    evicted = await _delete_returning_hashes(db, *stale)
+    await db.commit()
+    return db_session, evicted
+
+
+async def _delete_returning_hashes(db: AsyncSession, *criteria) -> list[bytes]:
+    # the digests are what the session cache is keyed by, so callers can drop the deleted sessions from it
+    if db.get_bind().dialect.delete_returning:
+        return list(await db.scalars(
+            sql_delete(models.UserSession).filter(*criteria).returning(models.UserSession.token_hash)
+            .execution_options(synchronize_session=False)))
+    rows = (await db.execute(select(models.UserSession.session_id, models.UserSession.token_hash)
+                             .filter(*criteria))).all()
+    if rows:
+        await db.execute(sql_delete(models.UserSession)
+                         .filter(models.UserSession.session_id.in_([session_id for session_id, _ in rows]))
+                         .execution_options(synchronize_session=False))
+    return [token_hash for _, token_hash in rows]
+
+
+async def read_by_token_hash(db: AsyncSession, token_hash: bytes,
+                             options: Sequence[ExecutableOption] = ()) -> models.UserSession | None:
     """
-    Get a session by its ID
+    Get a session by the digest of its token, through the unique index. Expired sessions are treated as missing
     :param db:          The database session
-    :param session_id:  The ID of the session to get
-    :return:            The session with the given ID
+    :param token_hash:  The digest of the session token
+    :param options:     Loader options for relationships, e.g. joinedload(models.UserSession.user)
+    :return:            The session with the given token
     """
-    return db.query(models.UserSession).filter(models.UserSession.session_id == session_id).first()
+    return await db.scalar(select(models.UserSession).options(*options).filter(
+        models.UserSession.token_hash == token_hash, models.UserSession.expires_at > datetime.utcnow()))
 
 
-def read_by_user(db: Session, user_id: int) -> list[models.UserSession] | None:
+async def read_by_user(db: AsyncSession, user_id: int,
+                       options: Sequence[ExecutableOption] = ()) -> list[models.UserSession] | None:
     """
     Get all sessions for a user
     :param db:          The database session
     :param user_id:     The ID of the user
+    :param options:     Loader options for relationships, e.g. joinedload(models.UserSession.user)
     :return:            A list of sessions for the user
     """
-    return (db.query(models.UserSession).filter(models.UserSession.user_id == user_id).order_by(
-        models.UserSession.created_at).all())
+    return list(await db.scalars(select(models.UserSession).options(*options).filter(
+        models.UserSession.user_id == user_id).order_by(
+        models.UserSession.created_at)))
 
 
-def read(db: Session, skip: int = 0, limit: int = 100) -> list[models.UserSession] | None:
+async def read(db: AsyncSession, skip: int = 0, limit: int = 100,
+               options: Sequence[ExecutableOption] = ()) -> list[models.UserSession] | None:
     """
     Get all sessions
     :param db:          The database session
     :param skip:        The number of sessions to skip
     :param limit:       The maximum number of sessions to return
+    :param options:     Loader options for relationships, e.g. joinedload(models.UserSession.user)
     :return:            A list of sessions
     """
-    return db.query(models.UserSession).offset(skip).limit(limit).all()
+    return list(await db.scalars(select(models.UserSession).options(*options).offset(skip).limit(limit)))
 
 
-def read_by_age(db: Session, age: timedelta) -> list[models.UserSession]:
+async def read_by_age(db: AsyncSession, age: timedelta) -> list[models.UserSession]:
     """
     Get all sessions older than a given timedelta
     :param db:          The database session
@@ -60,31 +120,68 @@ def read_by_age(db: Session, age: timedelta) -> list[models.UserSession]:
     :return:            A list of sessions older than 'age'
     """
     cutoff_time = datetime.utcnow() - age
-    return db.query(models.UserSession).filter(models.UserSession.created_at < cutoff_time).all()
+    return list(await db.scalars(select(models.UserSession).filter(models.UserSession.created_at < cutoff_time)))
 
 
-def delete(db: Session, session_id: int) -> models.UserSession | None:
+async def extend(db: AsyncSession, last_seen: dict[bytes, datetime], lifetime: timedelta):
+    """
+    Move the expiry of many sessions to `lifetime` after they were last seen, in one executemany UPDATE and
+    transaction. A session is never shortened, and ones deleted since are skipped
+    :param db:          The database session
+    :param last_seen:   Token digest -> when the session was last used
+    :param lifetime:    How long a session lasts after it was last used
+    """
+    if not last_seen:
+        return
+    table = models.UserSession.__table__
+    await db.execute(
+        update(table)
+        .where(table.c.token_hash == bindparam("b_token_hash"), table.c.expires_at < bindparam("b_expires_at"))
+        .values(last_seen_at=bindparam("b_last_seen_at"), expires_at=bindparam("b_expires_at")),
+        [{"b_token_hash": token_hash, "b_last_seen_at": seen, "b_expires_at": seen + lifetime}
+         for token_hash, seen in last_seen.items()])
+    await db.commit()
+
+
+async def delete(db: AsyncSession, token_hash: bytes) -> models.UserSession | None:
     """
-    Delete a session by its ID
+    Delete a session by the digest of its token
     :param db:          The database session
-    :param session_id:  The ID of the session to delete
+    :param token_hash:  The digest of the session token
     :return:            The deleted session
     """
-    db_session = db.query(models.UserSession).filter(models.UserSession.session_id == session_id).first()
+    db_session = await db.scalar(select(models.UserSession).filter(models.UserSession.token_hash == token_hash))
     if db_session:
-        db.delete(db_session)
-        db.commit()
+        await db.delete(db_session)
+        await db.commit()
     return db_session
 
 
-def delete_by_user(db: Session, user_id: int) -> int:
+async def delete_expired(db: AsyncSession, batch_size: int) -> int:
+    """
+    Delete one batch of expired sessions, in its own short transaction
+    :param db:          The database session
+    :param batch_size:  The maximum number of sessions to delete
+    :return:            The number of deleted sessions
+    """
+    # ids first, then delete by primary key: portable (no DELETE ... LIMIT) and only locks the rows it removes
+    expired_ids = list(await db.scalars(select(models.UserSession.session_id).filter(
+        models.UserSession.expires_at < datetime.utcnow()).order_by(models.UserSession.expires_at).limit(batch_size)))
+    if not expired_ids:
+        return 0
+
+    await db.execute(sql_delete(models.UserSession).filter(models.UserSession.session_id.in_(expired_ids)))
+    await db.commit()
+    return len(expired_ids)
+
+
+async def delete_by_user(db: AsyncSession, user_id: int) -> list[bytes]:
     """
     Delete all sessions for a user
     :param db:          The database session
     :param user_id:     The ID of the user
-    :return:            A list of deleted sessions
+    :return:            The token digests of the deleted sessions
     """
-    result = db.query(models.UserSession).filter(models.UserSession.user_id == user_id).delete()
-
-    db.commit()
-    return result
+    deleted = await _delete_returning_hashes(db, models.UserSession.user_id == user_id)
+    await db.commit()
+    return deleted
@@ -1,31 +1,220 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base
+import math
+import time
+
+from sqlalchemy import Select, create_engine, event, exc, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from dotenv import load_dotenv
 import os
 
+from app.instrumentation import LatencyStats
+
 load_dotenv()
 
 DB_TYPE = os.getenv("DB_TYPE")
 DB_CONNECTION = os.getenv("DB_CONNECTION")
+DB_ASYNC_CONNECTION = os.getenv("DB_ASYNC_CONNECTION", "aiomysql")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("DB_NAME")
+# optional read replica with the same credentials, reads go to the primary when it is unset
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_PORT = os.getenv("DB_REPLICA_PORT", DB_PORT)
+# after a client writes, its reads stay on the primary for this long so they see their own writes
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", 5))
+# carries that deadline to whichever worker serves the client's next request
+REPLICA_STICKY_COOKIE = "primary_until"
+
+# connection pool, per engine and per process
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# recycle connections before the server's wait_timeout or a failover silently kills them
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# DB_URL / ASYNC_DB_URL override the assembled urls, e.g. for sqlite files in development
+SQLALCHEMY_DB_URL = (os.getenv("DB_URL")
+                     or f'{DB_TYPE}+{DB_CONNECTION}://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+SQLALCHEMY_ASYNC_DB_URL = (os.getenv("ASYNC_DB_URL")
+                           or f'{DB_TYPE}+{DB_ASYNC_CONNECTION}://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
+SQLALCHEMY_ASYNC_REPLICA_DB_URL = (
+        os.getenv("ASYNC_REPLICA_DB_URL")
+        or (DB_REPLICA_HOST
+            and f'{DB_TYPE}+{DB_ASYNC_CONNECTION}://{DB_USER}:{DB_PASS}@{DB_REPLICA_HOST}:{DB_REPLICA_PORT}/{DB_NAME}'))
+
+
+class PoolStats:
+    """
+    How long checkouts from a connection pool wait, and how often they give up.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.wait = LatencyStats()
+        self.timeouts = 0
+
+
+class _TimedCheckout:
+    stats: PoolStats
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            self.stats.wait.record(time.perf_counter() - start)
+
+
+def _instrumented(pool_class, stats: PoolStats):
+    # a subclass per engine, so the stats survive the pool being recreated on dispose()
+    return type(f"Instrumented{pool_class.__name__}", (_TimedCheckout, pool_class), {"stats": stats})
+
+
+def _pool_options(url: str, pool_class, stats: PoolStats) -> dict:
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # in-memory sqlite lives and dies with its single connection, there is nothing to size
+        return {}
+    return {
+        "poolclass": _instrumented(pool_class, stats),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+pool_stats = {"primary": PoolStats(), "replica": PoolStats()}
+
+# the sync engine is only used for schema management and scripts, requests go through the async engine
+engine = create_engine(SQLALCHEMY_DB_URL, **_pool_options(SQLALCHEMY_DB_URL, QueuePool, PoolStats()))
+async_engine = create_async_engine(
+    SQLALCHEMY_ASYNC_DB_URL, **_pool_options(SQLALCHEMY_ASYNC_DB_URL, AsyncAdaptedQueuePool, pool_stats["primary"]))
+replica_engine = (create_async_engine(SQLALCHEMY_ASYNC_REPLICA_DB_URL,
+                                      **_pool_options(SQLALCHEMY_ASYNC_REPLICA_DB_URL, AsyncAdaptedQueuePool,
+                                                      pool_stats["replica"]))
+                  if SQLALCHEMY_ASYNC_REPLICA_DB_URL else None)
 
-SQLALCHEMY_DB_URL = f'{DB_TYPE}+{DB_CONNECTION}://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+# client key -> monotonic time until which its reads stay on the primary. Per process, for clients that don't keep
+# the stickiness cookie
+_recent_writers: dict[str, float] = {}
 
-engine = create_engine(SQLALCHEMY_DB_URL)
+
+def mark_recent_writer(client: str):
+    now = time.monotonic()
+    if len(_recent_writers) > 10000:
+        for key in [key for key, until in _recent_writers.items() if until <= now]:
+            del _recent_writers[key]
+    _recent_writers[client] = now + REPLICA_STICKY_SECONDS
+
+
+def is_recent_writer(client: str) -> bool:
+    return _recent_writers.get(client, 0) > time.monotonic()
+
+
+def sticky_cookie_active(value: str | None) -> bool:
+    """
+    Check the stickiness cookie a client sent back
+    :param value:   The cookie, the epoch time until which the client's reads stay on the primary
+    :return:        Whether that time is still ahead, and no further than a fresh cookie would set it
+    """
+    try:
+        until = float(value)
+    except (TypeError, ValueError):
+        return False
+    now = time.time()
+    return now < until <= now + REPLICA_STICKY_SECONDS
+
+
+class RoutingSession(Session):
+    """
+    Runs SELECTs marked with the `replica` execution option on the read replica, everything else on the primary.
+
+    Once the session writes, or if its client wrote in the last REPLICA_STICKY_SECONDS, every statement goes to
+    the primary so reads see the session's own writes. To carry that across requests set info["client"], which
+    holds within this process, and info["response"], which gets the REPLICA_STICKY_COOKIE on commit so the
+    client's next request stays on the primary whichever worker serves it. info["sticky"] marks a request that
+    sent the cookie back.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or (clause is not None and not isinstance(clause, Select)):
+            self.info["wrote"] = True
+        elif (replica_engine is not None
+              and isinstance(clause, Select)
+              and clause.get_execution_options().get("replica")
+              and not self.info.get("wrote")
+              and not self.info.get("sticky")
+              and not is_recent_writer(self.info.get("client"))):
+            return replica_engine.sync_engine
+        return async_engine.sync_engine
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _remember_writer(session: RoutingSession):
+    if not session.info.get("wrote"):
+        return
+    if client := session.info.get("client"):
+        mark_recent_writer(client)
+    if (response := session.info.get("response")) is not None:
+        response.set_cookie(REPLICA_STICKY_COOKIE, f"{time.time() + REPLICA_STICKY_SECONDS:.3f}",
+                            max_age=math.ceil(REPLICA_STICKY_SECONDS), httponly=True, samesite="lax")
+
+
+def _dispose_after_fork():
+    # a forked worker shares the parent's pooled connections, sockets included. Give it fresh pools of its own,
+    # without closing the inherited connections, which belong to the parent
+    for forked_engine in (engine, async_engine.sync_engine, replica_engine and replica_engine.sync_engine):
+        if forked_engine is not None:
+            forked_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_after_fork)
 
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# expire_on_commit is off so objects returned from crud stay usable without another round trip
+AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine,
+                                       sync_session_class=RoutingSession)
+
 Base = declarative_base()
 
 
+def pool_metrics(async_engine: AsyncEngine, stats: PoolStats) -> dict:
+    """
+    Occupancy and checkout wait times of an engine's connection pool
+    :param async_engine:    The engine
+    :param stats:           The engine's PoolStats
+    :return:                The metrics
+    """
+    pool = async_engine.pool
+    metrics = {"status": pool.status(), "checkout_wait_seconds": stats.wait.as_dict(), "timeouts": stats.timeouts}
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            # negative while the pool is still below pool_size
+            "overflow": pool.overflow(),
+        })
+    return metrics
+
+
 def create_tables():
-    from app.models.user import Base as UserBase
-    from app.models.user_session import Base as UserSessionBase
-    UserBase.metadata.create_all(bind=engine)
-    UserSessionBase.metadata.create_all(bind=engine)
\ No newline at end of file
+    """
+    Create the tables or bring them up to date, for scripts and development setups, see app.migrations
+    """
+    from app.migrations import migrate
+    migrate(engine)
@@ -1,31 +1,60 @@
-from fastapi import Depends, Request
+import secrets
+
+from fastapi import Depends, Request, Response
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import schemas, services
-from app.config import oauth2_scheme
-from app.database import SessionLocal
+from app.config import METRICS_TOKEN, oauth2_scheme
+from app.database import REPLICA_STICKY_COOKIE, AsyncSessionLocal, sticky_cookie_active
+from app.errors import MetricsAccessError, UserAuthorizationError
+from app.ratelimit import login_throttle
+
+
+async def get_db(request: Request, response: Response):
+    async with AsyncSessionLocal() as db:
+        # lets the replica routing keep this client on the primary right after it writes, see RoutingSession
+        db.sync_session.info.update({
+            "client": request.cookies.get("session_id") or (request.client and request.client.host),
+            "response": response,
+            "sticky": sticky_cookie_active(request.cookies.get(REPLICA_STICKY_COOKIE)),
+        })
+        yield db
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def login_attempt(request: Request, form_data: OAuth2PasswordRequestForm = Depends()) -> OAuth2PasswordRequestForm:
+    # resolved before get_db, so throttled attempts never reach the database or the hashing pool
+    await login_throttle.check(request.client and request.client.host, form_data.username)
+    return form_data
 
 
-def authenticate_user(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)) -> schemas.User:
-    return services.user.verify_credentials(form_data, db)
+async def authenticate_user(form_data: OAuth2PasswordRequestForm = Depends(login_attempt),
+                            db: AsyncSession = Depends(get_db)) -> schemas.User:
+    try:
+        user = await services.user.verify_credentials(form_data, db)
+    except UserAuthorizationError:
+        await login_throttle.failed(form_data.username)
+        raise
+    await login_throttle.succeeded(form_data.username)
+    return user
 
-def get_token_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> schemas.User:
-    return services.user.get_user_by_token(token, db)
+async def get_token_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> schemas.User:
+    return await services.user.get_user_by_token(token, db)
 
 
-def get_session_user(request: Request, db: Session = Depends(get_db)) -> schemas.User:
-    return services.user.get_user_by_session(request, db)
+async def get_session_user(request: Request, db: AsyncSession = Depends(get_db)) -> schemas.User:
+    return await services.user.get_user_by_session(request, db)
 
 
-def cross_validate_user(session_user: schemas.User = Depends(get_session_user),
-                        token_user: schemas.User = Depends(get_token_user)) -> schemas.User:
+async def cross_validate_user(session_user: schemas.User = Depends(get_session_user),
+                              token_user: schemas.User = Depends(get_token_user)) -> schemas.User:
     return services.user_session.cross_validate_user(session_user, token_user)
+
+
+async def metrics_access(request: Request):
+    if METRICS_TOKEN is not None:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+            raise MetricsAccessError("Send the metrics token as a bearer token")
+    elif not request.client or request.client.host not in ("127.0.0.1", "::1"):
+        raise MetricsAccessError("Only served to this host while METRICS_TOKEN is unset")
@@ -1,3 +1,5 @@
+import math
+
 from fastapi import HTTPException, status
 
 class BaseAPIException(HTTPException):
@@ -34,4 +36,30 @@ class UserAuthorizationError(BaseAPIException):
                          additional_detail=additional_detail)
 
 
+class MetricsAccessError(BaseAPIException):
+    def __init__(self, additional_detail: str = None):
+        super().__init__(status_code=status.HTTP_403_FORBIDDEN,
+                         detail="Metrics are not public",
+                         additional_detail=additional_detail)
+
+
+class ServiceUnavailableError(BaseAPIException):
+    def __init__(self, additional_detail: str = None):
+        super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail="Service unavailable",
+                         additional_detail=additional_detail)
+
+
+class InvalidCursorError(BaseAPIException):
+    def __init__(self, additional_detail: str = None):
+        super().__init__(status_code=status.HTTP_400_BAD_REQUEST,
+                         detail="Invalid pagination cursor",
+                         additional_detail=additional_detail)
+
 
+class TooManyRequestsError(BaseAPIException):
+    def __init__(self, retry_after: float, additional_detail: str = None):
+        super().__init__(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                         detail="Too many requests",
+                         additional_detail=additional_detail)
+        self.headers = {"Retry-After": str(math.ceil(retry_after))}
@@ -0,0 +1,225 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app import config
+from app.config import HASH_POOL_WORKERS, HASH_POOL_MAX_PENDING, HASH_POOL_MAX_BATCH_CHUNKS
+from app.errors import ServiceUnavailableError
+from app.instrumentation import LatencyStats
+
+
+# named cost profiles for PASSWORD_HASH_PROFILE: scheme and passlib settings, rounds is bcrypt's log2 cost and
+# argon2's time_cost. argon2 memory_cost is in KiB, and every hashing worker may use that much at once
+HASH_PROFILES: dict[str, tuple[str, dict[str, int]]] = {
+    "bcrypt-fast": ("bcrypt", {"rounds": 10}),
+    "bcrypt": ("bcrypt", {"rounds": 12}),
+    "bcrypt-strong": ("bcrypt", {"rounds": 13}),
+    # OWASP's minimum
+    "argon2-owasp": ("argon2", {"memory_cost": 19456, "rounds": 2, "parallelism": 1}),
+    "argon2-interactive": ("argon2", {"memory_cost": 65536, "rounds": 3, "parallelism": 1}),
+    "argon2-strong": ("argon2", {"memory_cost": 262144, "rounds": 4, "parallelism": 1}),
+}
+# hashes of these schemes can still be verified, and are replaced at the next login
+KNOWN_SCHEMES = ("bcrypt", "argon2")
+
+
+def parse_profile(spec: str) -> tuple[str, dict[str, int]]:
+    """
+    :param spec:    A HASH_PROFILES name, "scheme:setting=value,..." (e.g. "argon2:memory_cost=65536,rounds=3"),
+                    or a bare scheme for passlib's defaults
+    :return:        The scheme and its settings
+    """
+    if spec in HASH_PROFILES:
+        return HASH_PROFILES[spec]
+    scheme, _, settings = spec.partition(":")
+    return scheme, {name: int(value) for name, _, value in
+                    (setting.partition("=") for setting in settings.split(",") if setting)}
+
+
+def format_profile(scheme: str, settings: dict[str, int]) -> str:
+    return f"{scheme}:" + ",".join(f"{name}={value}" for name, value in settings.items())
+
+
+def crypt_context(spec: str):
+    """
+    Build the CryptContext for a cost profile. Only its settings count as current: hashes of another scheme or
+    with another cost, higher or lower, need an update
+    :param spec:    See parse_profile
+    :return:        The context
+    """
+    from passlib.context import CryptContext
+
+    scheme, settings = parse_profile(spec)
+    options = {}
+    for name, value in settings.items():
+        if name == "rounds":
+            options.update({f"{scheme}__default_rounds": value, f"{scheme}__min_rounds": value,
+                            f"{scheme}__max_rounds": value})
+        else:
+            options[f"{scheme}__{name}"] = value
+    schemes = [scheme] + [known for known in KNOWN_SCHEMES if known != scheme]
+    # CRYPT_SCHEME was the only setting before the profiles, hashes made with it keep working
+    if config.CRYPT_SCHEME and config.CRYPT_SCHEME not in schemes:
+        schemes.append(config.CRYPT_SCHEME)
+    return CryptContext(schemes=schemes, default=scheme, deprecated="auto", **options)
+
+
+def measure_profile(spec: str, seconds: float = 2) -> float:
+    """
+    Time hashing in this process, on one core
+    :param spec:        See parse_profile
+    :param seconds:     Roughly how long to keep hashing for
+    :return:            Seconds per hash
+    """
+    context = crypt_context(spec)
+    context.hash("calibration-warmup")
+    hashes = 0
+    start = time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds or hashes < 2:
+        context.hash(f"calibration-{hashes}")
+        hashes += 1
+    return elapsed / hashes
+
+
+def tune_profile(spec: str, target_seconds: float, seconds_per_hash: float) -> str:
+    """
+    Scale a profile's work factor to the slowest setting that still hashes within the target on this host,
+    keeping everything else. bcrypt doubles per round, argon2 grows linearly with its time_cost
+    :param spec:                The profile, see parse_profile
+    :param target_seconds:      The latency to aim for, per hash
+    :param seconds_per_hash:    The profile's measured cost, from measure_profile
+    :return:                    The tuned profile as "scheme:setting=value,..."
+    """
+    scheme, settings = parse_profile(spec)
+    rounds = settings.get("rounds")
+    if rounds is None:
+        return format_profile(scheme, settings)
+    if scheme == "bcrypt":
+        # bcrypt takes at least 4 rounds and at most 31
+        while rounds < 31 and seconds_per_hash * 2 <= target_seconds:
+            rounds, seconds_per_hash = rounds + 1, seconds_per_hash * 2
+        while rounds > 4 and seconds_per_hash > target_seconds:
+            rounds, seconds_per_hash = rounds - 1, seconds_per_hash / 2
+    else:
+        rounds = max(1, int(target_seconds / (seconds_per_hash / rounds)))
+    return format_profile(scheme, {**settings, "rounds": rounds})
+
+
+# these run in the workers, config.pwd_context is looked up on call so only the workers load passlib
+
+def _hash(password: str) -> str:
+    return config.pwd_context.hash(password)
+
+
+def _verify_needs_update(password: str, hashed_password: str) -> tuple[bool, bool]:
+    # the rehash itself is left to the caller, so the login doesn't wait for a second hash
+    if not config.pwd_context.verify(password, hashed_password):
+        return False, False
+    return True, config.pwd_context.needs_update(hashed_password)
+
+
+def _hash_many(passwords: list[str]) -> list[str]:
+    return [config.pwd_context.hash(password) for password in passwords]
+
+
+class PasswordHasher:
+    """
+    Runs pwd_context.hash / pwd_context.verify in a process pool.
+
+    At most `max_pending` calls may be queued or running at once, past that new calls are rejected with a
+    ServiceUnavailableError (503) instead of piling up behind a login storm. Batches from hash_many are counted
+    apart, at most `max_batch_chunks` chunks at once across every batch, so an import neither gets logins
+    rejected nor gets rejected itself.
+    """
+
+    def __init__(self, workers: int, max_pending: int, max_batch_chunks: int | None = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_batch_chunks = max_batch_chunks or workers
+        self.pending = 0
+        self.batch_pending = 0
+        self.rejected = 0
+        self.latency = {"hash": LatencyStats(), "verify": LatencyStats(), "hash_many": LatencyStats()}
+        self._executor: ProcessPoolExecutor | None = None
+        self._batch_slots: asyncio.Semaphore | None = None
+
+    def start(self):
+        if self._executor is None:
+            # spawn rather than fork, the parent has an event loop and db connections we don't want copied
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self._batch_slots = None
+
+    async def _run(self, name: str, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise ServiceUnavailableError("Too many password operations in progress, try again shortly")
+
+        self.start()
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+            self.latency[name].record(time.perf_counter() - start)
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", _hash, password)
+
+    async def verify_needs_update(self, password: str, hashed_password: str) -> tuple[bool, bool]:
+        """
+        Verify a password and check its hash against the current cost profile
+        :param password:            The password
+        :param hashed_password:     The stored hash
+        :return:                    Whether the password matches, and whether the hash should be replaced
+        """
+        return await self._run("verify", _verify_needs_update, password, hashed_password)
+
+    async def hash_many(self, passwords: list[str], chunk_size: int = 8) -> list[str]:
+        """
+        Hash a batch of passwords across the workers, e.g. for imports.
+        Waits for its turn instead of being rejected, and keeps at most `max_batch_chunks` chunks in flight so
+        logins can still get into the pool.
+        :param passwords:   The passwords to hash
+        :param chunk_size:  Passwords sent to a worker at once
+        :return:            The hashes, in the same order
+        """
+        self.start()
+        if self._batch_slots is None:
+            self._batch_slots = asyncio.Semaphore(self.max_batch_chunks)
+        loop = asyncio.get_running_loop()
+
+        async def hash_chunk(chunk: list[str]) -> list[str]:
+            async with self._batch_slots:
+                self.batch_pending += 1
+                try:
+                    return await loop.run_in_executor(self._executor, _hash_many, chunk)
+                finally:
+                    self.batch_pending -= 1
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(hash_chunk(passwords[i:i + chunk_size])
+                                         for i in range(0, len(passwords), chunk_size)))
+        self.latency["hash_many"].record(time.perf_counter() - start)
+        return [hash_ for result in results for hash_ in result]
+
+    def metrics(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "max_batch_chunks": self.max_batch_chunks,
+            "batch_pending": self.batch_pending,
+            "latency_seconds": {name: stats.as_dict() for name, stats in self.latency.items()},
+        }
+
+
+password_hasher = PasswordHasher(HASH_POOL_WORKERS, HASH_POOL_MAX_PENDING, HASH_POOL_MAX_BATCH_CHUNKS)
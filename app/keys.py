@@ -0,0 +1,212 @@
+"""
+The keys access tokens are signed and verified with.
+
+With an HS* HASH_ALGORITHM that is SECRET_KEY, as it always was, and nothing is published. With an asymmetric
+one (RS256, ES256, EdDSA, ...) the private keys are PEM files in JWT_KEY_DIR named <kid>.pem, tokens carry the
+kid of the key that signed them in their header, and the public halves are served at /.well-known/jwks.json so
+other services can verify tokens without the secret and without calling us.
+
+Rotation: `python -m app.cli rotate-key` adds a key to the directory. It is published as soon as the workers
+notice it (within JWT_KEY_RELOAD_SECONDS), but only signs once it is JWT_KEY_ACTIVATION_SECONDS old, so
+verifiers that cache the key set have it before the first token they need it for. The keys before it keep
+verifying the tokens they signed until `rotate-key --prune` removes them, once every one of those has expired.
+
+Keys are parsed once, when the directory is read, and PyJWT is handed the key objects: no PEM is parsed per
+token. Nothing is loaded before the first token, jwt and cryptography stay out of worker startup.
+"""
+import base64
+import json
+import os
+import secrets
+import time
+from pathlib import Path
+from typing import Any
+
+from app.config import (ALGORITHM, SECRET_KEY, ACCESS_TOKEN_EXPIRE_MINUTES, JWT_KEY_DIR, JWT_KEY_ACTIVATION_SECONDS,
+                        JWT_KEY_RELOAD_SECONDS)
+
+
+class Key:
+    """
+    One signing key, parsed
+    :param kid:         The key id, None for SECRET_KEY
+    :param algorithm:   The JWT algorithm the key is used with, e.g. "RS256"
+    :param private_key: The key object tokens are signed with
+    :param public_key:  The key object tokens are verified with, the secret itself for HS*
+    :param created:     When the key was made, as a unix timestamp
+    """
+
+    def __init__(self, kid: str | None, algorithm: str, private_key: Any, public_key: Any, created: float):
+        self.kid = kid
+        self.algorithm = algorithm
+        self.private_key = private_key
+        self.public_key = public_key
+        self.created = created
+
+    def jwk(self) -> dict:
+        from jwt.algorithms import get_default_algorithms
+
+        jwk = get_default_algorithms()[self.algorithm].to_jwk(self.public_key, as_dict=True)
+        return {**jwk, "kid": self.kid, "alg": self.algorithm, "use": "sig"}
+
+
+def _created(path: Path) -> float:
+    # kids from generate_key start with their creation time, so copying the files around doesn't reorder them
+    prefix = path.stem.partition("-")[0]
+    return float(prefix) if prefix.isdigit() else path.stat().st_mtime
+
+
+def _unverified_kid(token: str) -> str | None:
+    # by hand, jwt.get_unverified_header validates the whole token and costs about as much as an ES256 check
+    import jwt
+
+    header = token.partition(".")[0]
+    try:
+        return json.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4))).get("kid")
+    except (ValueError, AttributeError) as header_error:
+        raise jwt.DecodeError("Invalid token header") from header_error
+
+
+class KeyRing:
+    """
+    The signing key and every key still trusted for verification, reloaded when the key directory changes
+    """
+
+    def __init__(self, algorithm: str, secret: str | None, directory: str | None, activation_seconds: float,
+                 reload_seconds: float):
+        self.algorithm = algorithm
+        self.secret = secret
+        self.directory = Path(directory) if directory else None
+        self.activation_seconds = activation_seconds
+        self.reload_seconds = reload_seconds
+        self.reloads = 0
+        # kid -> key, oldest first
+        self._keys: dict[str | None, Key] | None = None
+        self._jwks = b'{"keys":[]}'
+        self._mtime: float | None = None
+        self._next_check = 0.0
+
+    @property
+    def symmetric(self) -> bool:
+        return self.algorithm.startswith("HS")
+
+    def _load(self):
+        if self.symmetric:
+            self._keys = {None: Key(None, self.algorithm, self.secret, self.secret, 0)}
+            return
+        if self.directory is None:
+            raise RuntimeError(f"HASH_ALGORITHM {self.algorithm} signs with the keys in JWT_KEY_DIR, which is not set")
+
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+        keys = []
+        for path in self.directory.glob("*.pem"):
+            private_key = load_pem_private_key(path.read_bytes(), password=None)
+            keys.append(Key(path.stem, self.algorithm, private_key, private_key.public_key(), _created(path)))
+        if not keys:
+            raise RuntimeError(f"No signing keys in {self.directory}, run `python -m app.cli rotate-key`")
+        keys.sort(key=lambda key: key.created)
+        self._keys = {key.kid: key for key in keys}
+        self._jwks = json.dumps({"keys": [key.jwk() for key in keys]}, separators=(",", ":")).encode()
+        self.reloads += 1
+
+    def _refresh(self) -> dict[str | None, Key]:
+        # a stat of the directory every reload_seconds, the keys are only read again when it changed
+        if self._keys is not None and (self.symmetric or time.monotonic() < self._next_check):
+            return self._keys
+        self._next_check = time.monotonic() + self.reload_seconds
+        mtime = self.directory.stat().st_mtime if self.directory is not None and not self.symmetric else None
+        if self._keys is None or mtime != self._mtime:
+            self._load()
+            self._mtime = mtime
+        return self._keys
+
+    def signing_key(self) -> Key:
+        """
+        :return:    The newest key that has been published for JWT_KEY_ACTIVATION_SECONDS, or the oldest key
+                    while none has
+        """
+        keys = list(self._refresh().values())
+        active = [key for key in keys if key.created <= time.time() - self.activation_seconds]
+        return active[-1] if active else keys[0]
+
+    def verification_key(self, kid: str | None) -> Key | None:
+        """
+        :param kid:     The kid from a token's header
+        :return:        The key, None if it is not (or no longer) trusted
+        """
+        return self._refresh().get(kid)
+
+    def jwks(self) -> bytes:
+        """
+        :return:    The public keys as a serialized JWK set, empty for HS* where there is nothing to publish
+        """
+        self._refresh()
+        return self._jwks
+
+    def sign(self, payload: dict) -> str:
+        import jwt
+
+        key = self.signing_key()
+        return jwt.encode(payload, key.private_key, algorithm=key.algorithm,
+                          headers={"kid": key.kid} if key.kid is not None else None)
+
+    def verify(self, token: str) -> dict:
+        """
+        Check a token's signature and expiry
+        :param token:   The encoded token
+        :return:        Its claims
+        :raises jwt.PyJWTError: If the token is malformed, expired, or not signed by a trusted key
+        """
+        import jwt
+
+        kid = None if self.symmetric else _unverified_kid(token)
+        if (key := self.verification_key(kid)) is None:
+            raise jwt.InvalidKeyError(f"Unknown signing key: {kid}")
+        # only the key's own algorithm, a token can't pick how it is verified
+        return jwt.decode(token, key.public_key, algorithms=[key.algorithm])
+
+    def retired(self) -> list[Key]:
+        """
+        :return:    The keys older than the signing key whose tokens have all expired, safe to delete
+        """
+        signing_key = self.signing_key()
+        # the signing key took over once it was old enough, the last token of the keys before it expires after that
+        if time.time() < signing_key.created + self.activation_seconds + ACCESS_TOKEN_EXPIRE_MINUTES * 60:
+            return []
+        return [key for key in self._refresh().values() if key.created < signing_key.created]
+
+
+def generate_key(algorithm: str, directory: str) -> str:
+    """
+    Make a new private key for an asymmetric algorithm and save it to the key directory, readable by the owner only
+    :param algorithm:   The JWT algorithm, e.g. "RS256", "ES256" or "EdDSA"
+    :param directory:   The key directory
+    :return:            The kid of the new key
+    """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+    if algorithm.startswith(("RS", "PS")):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    elif algorithm in ("ES256", "ES384", "ES512"):
+        private_key = ec.generate_private_key({"ES256": ec.SECP256R1(), "ES384": ec.SECP384R1(),
+                                               "ES512": ec.SECP521R1()}[algorithm])
+    elif algorithm == "EdDSA":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        raise ValueError(f"Can't generate keys for {algorithm}, only for RS*, PS*, ES* and EdDSA")
+
+    kid = f"{int(time.time())}-{secrets.token_hex(4)}"
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    # written under a temporary name and renamed, so a worker reloading meanwhile never reads half a key
+    temporary = Path(directory, f".{kid}.tmp")
+    with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as file:
+        file.write(pem)
+    temporary.rename(Path(directory, f"{kid}.pem"))
+    return kid
+
+
+key_ring = KeyRing(ALGORITHM, SECRET_KEY, JWT_KEY_DIR, JWT_KEY_ACTIVATION_SECONDS, JWT_KEY_RELOAD_SECONDS)
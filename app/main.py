@@ -1,14 +1,66 @@
 from fastapi import FastAPI
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import ORJSONResponse
 
-from app.api import user_router, session_router
-from app.database import create_tables
+from app.api import user_router, session_router, metrics_router, well_known_router
+from app.config import (QUERY_BUDGET, QUERY_BUDGET_MODE, SLOW_QUERY_SECONDS, PROFILE_DIR, PROFILE_HEADER,
+                        PROFILE_TOKEN, PROFILE_SAMPLE_RATE, MIGRATE_ON_STARTUP)
+from app import migrations
+from app.database import create_tables, async_engine, replica_engine
+from app.errors import BaseAPIException
+from app.hashing import password_hasher
+from app.instrumentation import (MetricsMiddleware, ProfilingMiddleware, QueryBudgetMiddleware, log_slow_queries,
+                                 request_metrics, track_queries)
+from app.tasks import password_rehasher, session_reaper, session_refresher
 
-app = FastAPI()
+# orjson for every response_model route, the user list dumps itself, see app.api.user.read_users
+app = FastAPI(default_response_class=ORJSONResponse)
+
+track_queries(async_engine.sync_engine)
+if replica_engine is not None:
+    track_queries(replica_engine.sync_engine)
+if SLOW_QUERY_SECONDS is not None:
+    log_slow_queries(async_engine.sync_engine, SLOW_QUERY_SECONDS)
+    if replica_engine is not None:
+        log_slow_queries(replica_engine.sync_engine, SLOW_QUERY_SECONDS)
+# added first so it runs inside the query budget middleware and reuses its per request QueryStats
+app.add_middleware(MetricsMiddleware)
+if QUERY_BUDGET is not None:
+    app.add_middleware(QueryBudgetMiddleware, budget=QUERY_BUDGET, mode=QUERY_BUDGET_MODE)
+if PROFILE_DIR:
+    # outermost, so the profile covers the other middlewares too
+    app.add_middleware(ProfilingMiddleware, directory=PROFILE_DIR, header=PROFILE_HEADER,
+                       sample_rate=PROFILE_SAMPLE_RATE, token=PROFILE_TOKEN)
+
+
+@app.exception_handler(BaseAPIException)
+async def count_api_error(request, exc: BaseAPIException):
+    request_metrics.count_error(type(exc).__name__)
+    return await http_exception_handler(request, exc)
 
 
 @app.on_event("startup")
-def on_startup():
-    create_tables()
+async def on_startup():
+    # migrating is a deploy step (python -m app.cli migrate), a worker only checks it has been done
+    if MIGRATE_ON_STARTUP:
+        create_tables()
+    else:
+        await migrations.check(async_engine)
+    password_hasher.start()
+    session_reaper.start()
+    session_refresher.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await session_reaper.stop()
+    # before the engines go, it writes the session extensions still buffered
+    await session_refresher.stop()
+    await password_rehasher.stop()
+    password_hasher.shutdown()
+    await async_engine.dispose()
+    if replica_engine is not None:
+        await replica_engine.dispose()
 
 
 @app.get("/")
@@ -18,6 +70,8 @@ def lol():
 
 app.include_router(session_router)
 app.include_router(user_router)
+app.include_router(metrics_router)
+app.include_router(well_known_router)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+"""
+Schema migrations, applied with `python -m app.cli migrate` before new code is rolled out.
+
+The schema_version table holds the version of the last applied migration. A new database gets every table
+straight from the models and is stamped with the latest version. A database that predates this module (its
+tables made by create_all on boot) counts as version 1, and gets everything after it.
+To change the schema, change the model and append a migration that brings version N - 1 to N.
+"""
+import logging
+from typing import Callable
+
+from sqlalchemy import (BINARY, BigInteger, Column, Connection, DateTime, Engine, ForeignKey, Index, Integer,
+                        LargeBinary, MetaData, Table, inspect, select, text)
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+schema_metadata = MetaData()
+schema_version = Table("schema_version", schema_metadata, Column("version", Integer, nullable=False))
+
+
+def _add_user_version(conn: Connection):
+    # until this module existed the column was added by hand, with this same statement
+    if "version" in {column["name"] for column in inspect(conn).get_columns("users")}:
+        return
+    conn.execute(text("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+def _session_tokens(conn: Connection):
+    # the old integer ids can't be turned into tokens, so every session is dropped: everyone logs in again
+    metadata = MetaData()
+    Table("users", metadata, Column("id", Integer, primary_key=True))
+    user_sessions = Table(
+        "user_sessions", metadata,
+        Column("session_id", Integer, primary_key=True, index=True, unique=True),
+        Column("token_hash", LargeBinary(32).with_variant(BINARY(32), "mysql", "mariadb"), nullable=False,
+               unique=True),
+        Column("created_at", DateTime, nullable=False),
+        Column("expires_at", DateTime, nullable=False, index=True),
+        Column("user_id", Integer, ForeignKey("users.id")),
+        Index("ix_user_sessions_user_id_created_at", "user_id", "created_at"),
+    )
+    user_sessions.drop(conn, checkfirst=True)
+    user_sessions.create(conn)
+
+
+def _session_last_seen(conn: Connection):
+    column_type = DateTime().compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE user_sessions ADD COLUMN last_seen_at {column_type}"))
+
+
+def _refresh_tokens(conn: Connection):
+    metadata = MetaData()
+    Table("users", metadata, Column("id", Integer, primary_key=True))
+    Table(
+        "refresh_tokens", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("token_hash", LargeBinary(32).with_variant(BINARY(32), "mysql", "mariadb"), nullable=False,
+               unique=True),
+        Column("family_id", BigInteger, nullable=False, index=True),
+        Column("created_at", DateTime, nullable=False),
+        Column("expires_at", DateTime, nullable=False, index=True),
+        Column("used_at", DateTime, nullable=True),
+        Column("user_id", Integer, ForeignKey("users.id"), nullable=False, index=True),
+    ).create(conn)
+
+
+# (version, description, upgrade), in order, version 1 being the tables as create_all made them before
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (2, "add users.version", _add_user_version),
+    (3, "replace session ids with token digests", _session_tokens),
+    (4, "add user_sessions.last_seen_at", _session_last_seen),
+    (5, "add refresh_tokens", _refresh_tokens),
+]
+LATEST_VERSION = MIGRATIONS[-1][0] if MIGRATIONS else 1
+
+
+class SchemaOutOfDateError(RuntimeError):
+    pass
+
+
+def read_version(conn: Connection) -> int | None:
+    """
+    Get the version of the schema
+    :param conn:    A connection to the database
+    :return:        The version of the last applied migration, None if the schema is not managed yet
+    """
+    if not inspect(conn).has_table(schema_version.name):
+        return None
+    return conn.scalar(select(schema_version.c.version))
+
+
+def _stamp(conn: Connection, version: int):
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(version=version))
+
+
+def migrate(engine: Engine) -> tuple[int | None, int]:
+    """
+    Bring the schema up to LATEST_VERSION, each migration in its own transaction
+    :param engine:  A sync engine for the database
+    :return:        The version before and after
+    """
+    # every model has to be imported for its table to be in the metadata
+    from app import models
+    from app.database import Base
+
+    with engine.begin() as conn:
+        before = current = read_version(conn)
+        if current is None:
+            schema_metadata.create_all(conn)
+            if inspect(conn).has_table(models.User.__tablename__):
+                current = 1
+            else:
+                Base.metadata.create_all(conn)
+                current = LATEST_VERSION
+            _stamp(conn, current)
+
+    for version, description, upgrade in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info("Migrating schema to version %d: %s", version, description)
+        with engine.begin() as conn:
+            upgrade(conn)
+            _stamp(conn, version)
+        current = version
+    return before, current
+
+
+async def check(async_engine: AsyncEngine):
+    """
+    Make sure the database has been migrated at least as far as this code expects, with one query.
+    A newer schema is let through so older workers keep running while a deploy rolls out, migrations are
+    expected to stay compatible with the code before them.
+    :param async_engine:    The engine requests will go through
+    :raises SchemaOutOfDateError: If the schema is older than LATEST_VERSION, or not managed at all
+    """
+    try:
+        async with async_engine.connect() as conn:
+            version = await conn.scalar(select(schema_version.c.version))
+    except (OperationalError, ProgrammingError) as missing_table:
+        raise SchemaOutOfDateError("The database has no schema_version table, run `python -m app.cli migrate`"
+                                   ) from missing_table
+    if version is None or version < LATEST_VERSION:
+        raise SchemaOutOfDateError(f"The database schema is at version {version}, this code expects "
+                                   f"{LATEST_VERSION}: run `python -m app.cli migrate`")
+    if version > LATEST_VERSION:
+        logger.warning("The database schema is at version %d, newer than this code's %d", version, LATEST_VERSION)
@@ -1,4 +1,5 @@
-from . import user, user_session
+from . import user, user_session, refresh_token
 from .user import User
 from .user_session import UserSession
+from .refresh_token import RefreshToken
 
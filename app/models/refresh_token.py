@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import BINARY, BigInteger, Column, Integer, DateTime, ForeignKey, LargeBinary
+
+from app.config import REFRESH_TOKEN_EXPIRE_DAYS
+from app.database import Base
+
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    # surrogate key, never leaves the server
+    id = Column(Integer, primary_key=True)
+    # sha256 of the random token handed to the client, the token itself is never stored
+    token_hash = Column(LargeBinary(32).with_variant(BINARY(32), "mysql", "mariadb"), nullable=False, unique=True)
+    # random, shared by every token rotated from the same /session/auth, a reused token revokes them all
+    family_id = Column(BigInteger, nullable=False, index=True)
+    created_at = Column(DateTime, default=lambda: datetime.utcnow(), nullable=False)
+    expires_at = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+                        nullable=False, index=True)
+    # set when the token is exchanged for a new one, it is kept until it expires to catch a second use
+    used_at = Column(DateTime, nullable=True)
+
+    # foreign key for user
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
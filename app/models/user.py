@@ -18,8 +18,12 @@ class User(Base):
     # user status
     is_active = Column(Boolean, default=True)
 
+    # bumped by every update, the ETag of the user's representation is built from it
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
     # hashed password
     hashed_password = Column(String(255))
 
     # users have sessions, 1, or more
-    user_sessions = relationship("UserSession", back_populates="user")
+    # never lazy loaded, ask for them with a loader option (see crud) so a loop over users can't turn into N+1
+    user_sessions = relationship("UserSession", back_populates="user", lazy="raise_on_sql")
@@ -1,19 +1,29 @@
 from datetime import datetime, timedelta
 
-from sqlalchemy import Column, Integer, DateTime, ForeignKey
+from sqlalchemy import BINARY, Column, Integer, DateTime, ForeignKey, Index, LargeBinary
 from sqlalchemy.orm import relationship
 
+from app.config import SESSION_LIFETIME_SECONDS
 from app.database import Base
 
 
 class UserSession(Base):
     __tablename__ = "user_sessions"
+    __table_args__ = (
+        # a user's sessions by age, for the session cap at login
+        Index("ix_user_sessions_user_id_created_at", "user_id", "created_at"),
+    )
 
-    # primary key for session is a uuid
+    # surrogate key, never leaves the server
     session_id = Column(Integer, unique=True, primary_key=True, index=True)
+    # sha256 of the random token in the session cookie, the token itself is never stored
+    token_hash = Column(LargeBinary(32).with_variant(BINARY(32), "mysql", "mariadb"), nullable=False, unique=True)
     created_at = Column(DateTime, default=lambda: datetime.utcnow(), nullable=False)
-    expires_at = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(hours=1), nullable=False)
+    expires_at = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(seconds=SESSION_LIFETIME_SECONDS),
+                         nullable=False, index=True)
+    # the request that last extended the session, written in batches by tasks.SessionRefresher
+    last_seen_at = Column(DateTime, nullable=True)
 
     # foreign key for user
     user_id = Column(Integer, ForeignKey("users.id"))
-    user = relationship("User", back_populates="user_sessions")
+    user = relationship("User", back_populates="user_sessions", lazy="raise_on_sql")
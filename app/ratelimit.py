@@ -0,0 +1,164 @@
+import importlib
+import time
+from collections import OrderedDict
+
+from app.config import (RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_IP_BURST, RATE_LIMIT_USER_PER_MINUTE,
+                        RATE_LIMIT_USER_BURST, RATE_LIMIT_MAX_KEYS, RATE_LIMIT_BACKEND, LOCKOUT_THRESHOLD,
+                        LOCKOUT_BASE_SECONDS, LOCKOUT_MAX_SECONDS, LOCKOUT_WINDOW_SECONDS)
+from app.errors import TooManyRequestsError
+
+
+class RateLimitBackend:
+    """
+    Where token buckets and failure counts live. Implement this on top of e.g. redis (with the bucket
+    update in a script, so it stays atomic) to share limits between processes.
+    """
+
+    async def take(self, key: str, capacity: float, per_second: float) -> float:
+        """
+        Take a token from a bucket that holds up to `capacity` and refills at `per_second`
+        :return:    0 if a token was taken, otherwise the seconds until one is available
+        """
+        raise NotImplementedError
+
+    async def locked_for(self, key: str) -> float:
+        """
+        :return:    The seconds left on the key's lockout, 0 if it is not locked
+        """
+        raise NotImplementedError
+
+    async def add_failure(self, key: str, ttl: float) -> int:
+        """
+        Count a failure, the count is dropped `ttl` seconds after the last one
+        :return:    The number of failures so far
+        """
+        raise NotImplementedError
+
+    async def lock(self, key: str, seconds: float):
+        raise NotImplementedError
+
+    async def reset(self, key: str):
+        """
+        Forget the key's failures and lockout
+        """
+        raise NotImplementedError
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """
+    Per process buckets and failure counts, at most `max_keys` of each, least recently used dropped first.
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        # key -> (tokens, monotonic time of the last update)
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        # key -> (failures, locked until, forgotten at), monotonic
+        self._failures: OrderedDict[str, tuple[int, float, float]] = OrderedDict()
+
+    def _bounded(self, entries: OrderedDict):
+        if len(entries) > self.max_keys:
+            entries.popitem(last=False)
+
+    async def take(self, key: str, capacity: float, per_second: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * per_second)
+        if tokens >= 1:
+            tokens, wait = tokens - 1, 0.0
+        else:
+            wait = (1 - tokens) / per_second
+        self._buckets[key] = (tokens, now)
+        self._bounded(self._buckets)
+        return wait
+
+    def _entry(self, key: str) -> tuple[int, float, float]:
+        entry = self._failures.get(key)
+        if entry is None or entry[2] <= time.monotonic():
+            return 0, 0.0, 0.0
+        return entry
+
+    async def locked_for(self, key: str) -> float:
+        return max(0.0, self._entry(key)[1] - time.monotonic())
+
+    async def add_failure(self, key: str, ttl: float) -> int:
+        failures, locked_until, _ = self._entry(key)
+        self._failures.pop(key, None)
+        self._failures[key] = (failures + 1, locked_until, time.monotonic() + ttl)
+        self._bounded(self._failures)
+        return failures + 1
+
+    async def lock(self, key: str, seconds: float):
+        failures, _, forgotten_at = self._entry(key)
+        until = time.monotonic() + seconds
+        self._failures[key] = (failures, until, max(forgotten_at, until))
+
+    async def reset(self, key: str):
+        self._failures.pop(key, None)
+
+
+def load_backend(spec: str | None) -> RateLimitBackend:
+    """
+    Build a backend from a config value
+    :param spec:    None for in-memory, or "package.module:Class" for a RateLimitBackend subclass
+    :return:        The backend
+    """
+    if not spec:
+        return InMemoryRateLimitBackend(RATE_LIMIT_MAX_KEYS)
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class LoginThrottle:
+    """
+    Guards the credential checks: a token bucket per client ip and per username, checked before any database
+    or hashing work, and a lockout per username that doubles with every failure past `lockout_threshold`.
+    """
+
+    def __init__(self, backend: RateLimitBackend, ip_per_minute: float, ip_burst: int, user_per_minute: float,
+                 user_burst: int, lockout_threshold: int, lockout_base: float, lockout_max: float,
+                 lockout_window: float):
+        self.backend = backend
+        self.ip_limit = (ip_burst, ip_per_minute / 60)
+        self.user_limit = (user_burst, user_per_minute / 60)
+        self.lockout_threshold = lockout_threshold
+        self.lockout_base = lockout_base
+        self.lockout_max = lockout_max
+        self.lockout_window = lockout_window
+        self.rejected = {"ip": 0, "username": 0, "lockout": 0}
+        self.lockouts = 0
+
+    async def check(self, ip: str | None, username: str):
+        """
+        Let a login attempt through or reject it
+        :param ip:          The client's address
+        :param username:    The username being tried
+        :raises TooManyRequestsError: If the account is locked or either bucket is empty
+        """
+        if locked_for := await self.backend.locked_for(f"lockout:{username}"):
+            self.rejected["lockout"] += 1
+            raise TooManyRequestsError(locked_for, "Account temporarily locked after failed logins")
+        if ip is not None and (wait := await self.backend.take(f"ip:{ip}", *self.ip_limit)):
+            self.rejected["ip"] += 1
+            raise TooManyRequestsError(wait, "Too many login attempts from this address")
+        if wait := await self.backend.take(f"user:{username}", *self.user_limit):
+            self.rejected["username"] += 1
+            raise TooManyRequestsError(wait, "Too many login attempts for this user")
+
+    async def failed(self, username: str):
+        failures = await self.backend.add_failure(f"lockout:{username}", self.lockout_window)
+        if failures >= self.lockout_threshold:
+            self.lockouts += 1
+            await self.backend.lock(f"lockout:{username}", min(
+                self.lockout_max, self.lockout_base * 2 ** (failures - self.lockout_threshold)))
+
+    async def succeeded(self, username: str):
+        await self.backend.reset(f"lockout:{username}")
+
+    def metrics(self) -> dict:
+        return {"rejected": dict(self.rejected), "lockouts": self.lockouts}
+
+
+login_throttle = LoginThrottle(load_backend(RATE_LIMIT_BACKEND), RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_IP_BURST,
+                               RATE_LIMIT_USER_PER_MINUTE, RATE_LIMIT_USER_BURST, LOCKOUT_THRESHOLD,
+                               LOCKOUT_BASE_SECONDS, LOCKOUT_MAX_SECONDS, LOCKOUT_WINDOW_SECONDS)
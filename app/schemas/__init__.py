@@ -1,5 +1,5 @@
 from . import token, user, user_session
 
 from .token import Token
-from .user import (User, UserCreate, UserInDB, UserUpdate)
-from .user_session import (SessionCreate, SessionInDB)
\ No newline at end of file
+from .user import (User, UserCreate, UserInDB, UserUpdate, UserList, BulkUserError, BulkUserResult)
+from .user_session import (SessionCreate, SessionInDB, SessionUser)
\ No newline at end of file
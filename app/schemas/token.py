@@ -1,6 +1,10 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+    # single use, exchange it at /session/refresh for the next access token
+    refresh_token: Optional[str] = None
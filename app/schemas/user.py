@@ -1,6 +1,6 @@
 from typing import Optional, Dict, Any
 
-from pydantic import BaseModel, EmailStr, Field, field_validator, model_validator
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, field_validator, model_validator
 from pydantic_core.core_schema import ValidationInfo
 
 
@@ -30,15 +30,35 @@ class UserUpdate(BaseModel):
 
 
 class User(UserBase):
+    # only ever built from stored rows, whose emails were validated on the way in: checking them again with
+    # email-validator costs more than the rest of the model put together
+    email: Optional[str] = Field(None, description="The user's email address", max_length=255,
+                                 json_schema_extra={"format": "email"})
     id: int
     is_active: bool
+    version: int = Field(1, description="Bumped on every update")
 
     class Config:
         from_attributes = True
 
 
+# built once: validates ORM rows by attribute and dumps them straight to JSON bytes
+UserList = TypeAdapter(list[User])
+
+
 class UserInDB(User):
     hashed_password: str
 
     class Config:
         from_attributes = True
+
+
+class BulkUserError(BaseModel):
+    index: int = Field(..., description="Position of the user in the submitted list")
+    field: Optional[str] = Field(None, description="The field at fault, if any")
+    detail: str
+
+
+class BulkUserResult(BaseModel):
+    created: int
+    errors: list[BulkUserError]
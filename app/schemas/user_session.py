@@ -1,9 +1,12 @@
 from datetime import datetime
+from typing import Optional
+
 from pydantic import BaseModel
 
+from .user import User
+
 
 class SessionBase(BaseModel):
-    session_id: str
     created_at: datetime
     expires_at: datetime
 
@@ -13,5 +16,16 @@ class SessionCreate(SessionBase):
 
 
 class SessionInDB(SessionCreate):
+    # sha256 of the session token
+    token_hash: bytes
+    # the last request that extended the session, None until the first extension
+    last_seen_at: Optional[datetime] = None
+
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class SessionUser(BaseModel):
+    # what a session token resolves to, as kept by the session cache
+    user: User
+    expires_at: datetime
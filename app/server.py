@@ -0,0 +1,147 @@
+"""
+Production launcher: a supervisor that imports the app once, binds the socket and forks uvicorn workers that
+share it, gunicorn style. Run it through `python -m app.cli serve`.
+
+The supervisor replaces workers that exit, whether they were recycled after their request limit or crashed,
+and stops for good if one fails to start (e.g. the schema is out of date). On SIGTERM or SIGINT it passes
+SIGTERM on: every worker stops accepting connections, finishes the requests in flight within the graceful
+timeout, runs the shutdown handlers and exits.
+"""
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+# exit status of a worker whose startup failed, the supervisor gives up instead of restarting it
+WORKER_BOOT_ERROR = 3
+
+logger = logging.getLogger(__name__)
+
+
+def bind(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(index: int, workers: int, sock: socket.socket, max_requests: int, graceful_timeout: int):
+    """
+    Body of a forked worker, never returns
+    """
+    # first, the supervisor's handlers would signal its other workers
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+
+    from app.cache import session_cache
+    from app.config import HASH_POOL_WORKERS, HASH_POOL_MAX_PENDING, HASH_POOL_MAX_BATCH_CHUNKS
+    from app.hashing import password_hasher
+    from app.main import app
+    from app.tasks import password_rehasher, session_reaper
+
+    # the database pools were replaced by database._dispose_after_fork, the rest of the per process state is here
+    random.seed()
+    # one machine's worth of hashing processes, not one per web worker
+    password_hasher.workers = max(1, HASH_POOL_WORKERS // workers)
+    password_hasher.max_pending = max(1, HASH_POOL_MAX_PENDING // workers)
+    password_hasher.max_batch_chunks = max(1, HASH_POOL_MAX_BATCH_CHUNKS // workers)
+    password_rehasher.max_in_flight = max(1, password_hasher.max_pending // 2)
+    # a local copy would outlive a logout handled by another worker, the shared backend is the only copy
+    if workers > 1:
+        session_cache.local_ttl = 0
+    # one worker is enough to delete expired sessions
+    if index != 0:
+        session_reaper.interval = 0
+
+    server = uvicorn.Server(uvicorn.Config(app, limit_max_requests=max_requests or None,
+                                           timeout_graceful_shutdown=graceful_timeout))
+    status = 1
+    try:
+        server.run(sockets=[sock])
+        status = 0 if server.started else WORKER_BOOT_ERROR
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # skip the supervisor's stack and atexit handlers, they are not this process's
+        os._exit(status)
+
+
+def serve(host: str, port: int, workers: int, max_requests: int = 0, max_requests_jitter: int = 0,
+          graceful_timeout: int = 30) -> int:
+    """
+    Run the app on `workers` processes until SIGTERM or SIGINT
+    :param host:                    The address to listen on
+    :param port:                    The port to listen on
+    :param workers:                 The number of worker processes
+    :param max_requests:            Requests after which a worker is replaced, 0 to never replace them
+    :param max_requests_jitter:     Up to this many requests are added to each worker's limit
+    :param graceful_timeout:        Seconds in-flight requests get to finish once shutdown starts
+    :return:                        The exit status, 0 after a clean shutdown
+    """
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format="%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s")
+        logger.setLevel(logging.INFO)
+
+    # imported once here and inherited by every fork, so a recycled worker is serving again within milliseconds
+    import app.main  # noqa: F401
+
+    sock = bind(host, port)
+    children: dict[int, int] = {}
+    stopping = False
+    status = 0
+
+    def spawn(index: int):
+        limit = max_requests + random.randint(0, max_requests_jitter) if max_requests else 0
+        if (pid := os.fork()) == 0:
+            _run_worker(index, workers, sock, limit, graceful_timeout)
+        children[pid] = index
+
+    def stop(signum, _frame):
+        nonlocal stopping
+        if not stopping:
+            logger.info("Received %s, draining %d workers", signal.Signals(signum).name, len(children))
+            stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Listening on %s:%d with %d workers", host, port, workers)
+    for index in range(workers):
+        spawn(index)
+
+    # the workers enforce the graceful timeout, this is for one that hangs anyway
+    deadline = None
+    while children:
+        pid, wait_status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping:
+                deadline = deadline or time.monotonic() + graceful_timeout + 10
+                if time.monotonic() > deadline:
+                    logger.error("Killing %d workers that did not stop in time", len(children))
+                    for child in children:
+                        os.kill(child, signal.SIGKILL)
+            time.sleep(0.1)
+            continue
+
+        index = children.pop(pid)
+        exit_code = os.waitstatus_to_exitcode(wait_status)
+        if stopping:
+            continue
+        if exit_code == WORKER_BOOT_ERROR:
+            logger.error("Worker %d failed to start, shutting down", pid)
+            status = 1
+            stop(signal.SIGTERM, None)
+            continue
+        logger.info("Worker %d exited with %d, starting a replacement", pid, exit_code)
+        spawn(index)
+
+    sock.close()
+    return status
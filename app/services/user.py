@@ -1,111 +1,298 @@
-import jwt
+import base64
+import binascii
+import json
+from typing import AsyncIterator
+
 from fastapi import Request
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud, models, schemas
+from app.cache import session_cache, token_cache, user_cache
+from app.config import EXPORT_BATCH_SIZE, BULK_MAX_USERS, BULK_CHUNK_SIZE, PASSWORD_REHASH_ON_LOGIN
+from app.database import AsyncSessionLocal
+from app.errors import (UserCreationError, UserNotFoundError, UserAuthorizationError, UserUpdateError,
+                        InvalidCursorError)
+from app.hashing import password_hasher
+from app.keys import key_ring
+from app.services.user_session import invalidate_user_sessions
+from app.session_store import hash_token, session_store
+from app.tasks import password_rehasher, session_refresher
 
-from app import crud, schemas
-from app.config import SECRET_KEY, ALGORITHM, pwd_context
-from app.errors import UserCreationError, UserNotFoundError, UserAuthorizationError, UserUpdateError
 
+_REGISTERED = {"email": "Email already registered", "username": "Username already registered"}
+_TAKEN = {"email": "Email is already taken", "username": "Username is already taken"}
 
-def create_user(user: schemas.UserCreate, db: Session) -> schemas.User:
+
+async def create_user(user: schemas.UserCreate, db: AsyncSession) -> schemas.User:
     """
     Create a new user
     :param user:    The user to create
     :param db:      The database session
     :return:
     """
-    if error := next((msg for msg, check in [
-        ("Email already registered", crud.user.read_by_email(db, user.email)),
-        ("Username already registered", crud.user.read_by_username(db, user.username))
-    ] if check), None):
-        raise UserCreationError(error)
-
     user = {
         "username": user.username,
         "email": user.email,
         "display_name": user.display_name if user.display_name else user.username,
-        "hashed_password": pwd_context.hash(user.password),
+        "hashed_password": await password_hasher.hash(user.password),
         "is_active": True,
     }
 
-    return crud.user.create(db, user)
+    # no lookups first: the unique indexes catch duplicates, including ones from concurrent signups
+    try:
+        return await crud.user.create(db, user)
+    except IntegrityError as integrity_error:
+        raise UserCreationError(_REGISTERED.get(crud.user.duplicate_field(integrity_error),
+                                                "Email or username already registered")) from integrity_error
 
 
-def get_user_by_id(user_id: int, db: Session) -> schemas.User:
+async def create_users(users: list[dict], db: AsyncSession,
+                       chunk_size: int = BULK_CHUNK_SIZE) -> schemas.BulkUserResult:
+    """
+    Create many users at once, e.g. for imports.
+    Rows that fail validation or whose email or username is taken are reported and skipped, the rest are
+    created: one query checks every email and username, the passwords are hashed on every hashing worker,
+    and the users are inserted `chunk_size` per statement and transaction.
+    :param users:       The users to create, as UserCreate fields
+    :param db:          The database session
+    :param chunk_size:  The number of users per INSERT
+    :return:            How many users were created and why the others were not
+    """
+    if len(users) > BULK_MAX_USERS:
+        raise UserCreationError(f"At most {BULK_MAX_USERS} users per batch")
+
+    errors = []
+    valid = []
+    for index, raw_user in enumerate(users):
+        try:
+            valid.append((index, schemas.UserCreate.model_validate(raw_user)))
+        except ValidationError as validation_error:
+            error = validation_error.errors()[0]
+            errors.append(schemas.BulkUserError(index=index, field=".".join(map(str, error["loc"])) or None,
+                                                detail=error["msg"]))
+
+    taken_emails, taken_usernames = await crud.user.read_taken(
+        db, [user.email for _, user in valid if user.email], [user.username for _, user in valid])
+    accepted = []
+    for index, user in valid:
+        if user.email and user.email in taken_emails:
+            errors.append(schemas.BulkUserError(index=index, field="email", detail=_REGISTERED["email"]))
+        elif user.username in taken_usernames:
+            errors.append(schemas.BulkUserError(index=index, field="username", detail=_REGISTERED["username"]))
+        else:
+            # later rows in the same batch with the same email or username are duplicates too
+            if user.email:
+                taken_emails.add(user.email)
+            taken_usernames.add(user.username)
+            accepted.append((index, user))
+
+    hashed_passwords = await password_hasher.hash_many([user.password for _, user in accepted])
+    rows = [(index, {
+        "username": user.username,
+        "email": user.email,
+        "display_name": user.display_name if user.display_name else user.username,
+        "hashed_password": hashed_password,
+        "is_active": True,
+    }) for (index, user), hashed_password in zip(accepted, hashed_passwords)]
+
+    created = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        try:
+            created += await crud.user.create_many(db, [row for _, row in chunk])
+        except IntegrityError:
+            # someone registered one of these since the check, redo the chunk row by row to find out which
+            for index, row in chunk:
+                try:
+                    created += await crud.user.create_many(db, [row])
+                except IntegrityError as integrity_error:
+                    field = crud.user.duplicate_field(integrity_error)
+                    errors.append(schemas.BulkUserError(index=index, field=field, detail=_REGISTERED.get(
+                        field, "Email or username already registered")))
+
+    return schemas.BulkUserResult(created=created, errors=sorted(errors, key=lambda error: error.index))
+
+
+async def get_user_by_id(user_id: int, db: AsyncSession) -> schemas.User:
     """
     Get a user by their ID
     :param user_id:     The ID of the user to get
     :param db:          The database session
     :return:            The user with the given ID
     """
-    if db_user := crud.user.read_by_id(db, user_id):
+    # only shown, never trusted: the replica may answer
+    if db_user := await crud.user.read_by_id(db, user_id, replica=True):
+        user_cache.set_version(db_user.id, db_user.version)
         return db_user
     else:
         raise UserNotFoundError(f"Could not find user with ID {user_id}")
 
 
+def get_cached_version(user_id: int) -> int | None:
+    """
+    Get the version of a user as last read by this process, without touching the database.
+    Dropped when the user is updated or deleted here, and after USER_CACHE_TTL for changes made elsewhere.
+    :param user_id:     The ID of the user
+    :return:            The version, or None if it isn't cached
+    """
+    return user_cache.get_version(user_id)
+
+
 # TODO: make this possibly use auth or user session once permissions are somehow added
 #       to the system so that the amount of users returned can be limited
-def get_users(skip: int = 0, limit: int = 100, db: Session = None) -> list[schemas.User]:
+async def get_users(skip: int = 0, limit: int = 100, db: AsyncSession = None,
+                    cursor: str | None = None) -> list[schemas.User]:
     """
     Get a list of users
-    :param skip:    The number of users to skip
+    :param skip:    The number of users to skip, only used when no cursor is given
     :param limit:   The maximum number of users to return
     :param db:      The database session
+    :param cursor:  The cursor returned with the previous page
     :return:        A list of users
     """
-    return crud.user.read(db, skip=skip, limit=limit)
+    after_id = decode_cursor(cursor) if cursor else None
+    return await crud.user.read(db, skip=skip, limit=limit, after_id=after_id)
 
 
-def update_user(db: Session, user_id: int, update: schemas.UserUpdate) -> schemas.User:
+def encode_cursor(user_id: int) -> str:
+    """
+    Build the opaque cursor for the page after a user
+    :param user_id:     The ID of the last user on the current page
+    :return:            The cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps({"id": user_id}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """
+    Get the ID a cursor continues after
+    :param cursor:  A cursor from encode_cursor
+    :return:        The ID of the last user on the previous page
+    """
     try:
-        if not (db_user := crud.user.read_by_id(db, user_id)):
+        after_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["id"]
+    except (binascii.Error, ValueError, KeyError, TypeError) as cursor_error:
+        raise InvalidCursorError(cursor) from cursor_error
+    if not isinstance(after_id, int):
+        raise InvalidCursorError(cursor)
+    return after_id
+
+
+def next_cursor(users: list[schemas.User], limit: int) -> str | None:
+    """
+    Get the cursor for the page after `users`
+    :param users:   The current page
+    :param limit:   The page size that was asked for
+    :return:        The cursor, or None if this was the last page
+    """
+    if limit <= 0 or len(users) < limit:
+        return None
+    return encode_cursor(users[-1].id)
+
+
+async def export_users() -> AsyncIterator[bytes]:
+    """
+    Every user as newline delimited JSON, fetched in batches of EXPORT_BATCH_SIZE.
+    Uses its own database session since the response is still being sent after the request handler returns.
+    :return:    An iterator of NDJSON chunks, one per batch
+    """
+    async with AsyncSessionLocal() as db:
+        async for batch in crud.user.stream(db, batch_size=EXPORT_BATCH_SIZE):
+            yield "".join(schemas.User.model_validate(db_user).model_dump_json() + "\n"
+                          for db_user in batch).encode()
+
+
+async def update_user(db: AsyncSession, user_id: int, update: schemas.UserUpdate) -> schemas.User:
+    try:
+        if not (db_user := await crud.user.read_by_id(db, user_id)):
             raise UserNotFoundError(f"User not found for ID: {user_id}")
     except UserNotFoundError as user_error:
         raise UserUpdateError(f"Authorization error: {user_error}") from user_error
 
     update_data = update.model_dump(exclude_unset=True)
 
-    if ('new_email' in update_data
-            and update_data['new_email']
-            and crud.user.read_by_email(db, update_data['new_email'])):
-        raise UserUpdateError("Email is already taken")
-
-    if ('new_username' in update_data
-            and update_data['new_username']
-            and crud.user.read_by_username(db, update_data['new_username'])):
-        raise UserUpdateError("Username is already taken")
-
     if ('new_password' in update_data
             and update_data['new_password']):
-        hashed_password = pwd_context.hash(update_data['new_password'])
+        hashed_password = await password_hasher.hash(update_data['new_password'])
         update_data['hashed_password'] = hashed_password
 
     # remove new_password and new_password2 from update_data, and drop new_ from the rest of the keys
     update_data = {key.replace('new_', ''): value for key, value in update_data.items()
                       if key != 'new_password'}
 
-    return crud.user.update(db, db_user, update_data)
+    if 'hashed_password' in update_data:
+        # logins from before the password change can't renew their access tokens. Committed by the update, so
+        # the password never changes without the tokens going too
+        await crud.refresh_token.delete_by_user(db, db_user.id, commit=False)
+
+    # the unique indexes reject a taken email or username, no need to look them up first
+    try:
+        db_user = await crud.user.update(db, db_user, update_data)
+    except IntegrityError as integrity_error:
+        raise UserUpdateError(_TAKEN.get(crud.user.duplicate_field(integrity_error),
+                                         "Email or username is already taken")) from integrity_error
+    return db_user
+
+
+async def delete_user(db: AsyncSession, user_id: int) -> schemas.User:
+    """
+    Delete a user by their ID
+    :param db:          The database session
+    :param user_id:     The ID of the user to delete
+    :return:            The deleted user
+    """
+    # the store may not be the users database, so its sessions can't go with the user in one transaction
+    await session_cache.invalidate(*await session_store.delete_by_user(user_id))
+    if not (db_user := await crud.user.delete(db, user_id)):
+        raise UserNotFoundError(f"User not found for ID: {user_id}")
+    return db_user
 
 
-def get_user_by_session(request: Request, db: Session) -> schemas.User:
+@crud.user.register_invalidation_hook
+async def drop_cached_user(db: AsyncSession, db_user: models.User):
     """
-    Get a user by their session ID
-    :param request:    The request to get the session ID from
+    Forget every cached copy of a user that was just updated or is about to be deleted
     :param db:          The database session
-    :return:            The user with the given session ID
+    :param db_user:     The user that changed
+    """
+    user_cache.invalidate(db_user.id)
+    await invalidate_user_sessions(db_user.id)
+
+
+async def get_user_by_session(request: Request, db: AsyncSession) -> schemas.User:
     """
-    session_id = request.cookies.get("session_id")
-    if session_id is None:
+    Get a user by their session token
+    :param request:    The request to get the session token from
+    :param db:          The database session
+    :return:            The user the session belongs to
+    """
+    token = request.cookies.get("session_id")
+    if token is None:
         raise UserAuthorizationError("User is not logged in.")
-    elif not (session := crud.user_session.read_by_id(db, int(session_id))):
+    token_hash = hash_token(token)
+    if cached := await session_cache.get(token_hash):
+        # sliding expiry, the extension is buffered and written later by the refresher
+        if expires_at := session_refresher.refresh(token_hash, cached.expires_at):
+            await session_cache.set(token_hash, cached.user, expires_at)
+        return cached.user
+    elif not (session := await session_store.get(token_hash)):
         raise UserAuthorizationError("Could not find session.")
 
-    return session.user
+    if not (user := user_cache.get_by_id(session.user_id)):
+        # the session store may live apart from the users, so the user is a lookup of its own
+        if not (db_user := await crud.user.read_by_id(db, session.user_id)):
+            raise UserAuthorizationError("Could not find user for session.")
+        user = schemas.User.model_validate(db_user)
+        user_cache.set(user)
+    await session_cache.set(token_hash, user, session_refresher.refresh(token_hash, session.expires_at)
+                            or session.expires_at)
+    return user
 
 
-def get_user_by_token(token: str, db: Session) -> schemas.User:
+async def get_user_by_token(token: str, db: AsyncSession) -> schemas.User:
     """
     Get a user by their token
     :param token:   The token to get the user for
@@ -115,12 +302,21 @@ def get_user_by_token(token: str, db: Session) -> schemas.User:
     if token is None:
         raise UserAuthorizationError("Temporary authorization token not found.")
 
+    # imported on first use, it pulls in cryptography which adds noticeably to every worker's startup
+    import jwt
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
+        if (username := token_cache.get(token)) is None:
+            payload = key_ring.verify(token)
+            username = payload.get("sub")
+            if "exp" in payload:
+                token_cache.set(token, username, payload["exp"])
+
+        if user := user_cache.get_by_username(username):
+            return user
 
-        user = crud.user.read_by_username(db, username)
-        if user is None:
+        db_user = await crud.user.read_by_username(db, username)
+        if db_user is None:
             raise UserNotFoundError(f"User not found for username: {username} (Token: {token})")
 
     except UserNotFoundError as user_error:
@@ -133,10 +329,12 @@ def get_user_by_token(token: str, db: Session) -> schemas.User:
         # Catch any other unexpected exceptions and re-raise as UserAuthorizationError
         raise UserAuthorizationError(f"Unexpected error: {e}") from e
 
+    user = schemas.User.model_validate(db_user)
+    user_cache.set(user)
     return user
 
 
-def verify_credentials(form_data: OAuth2PasswordRequestForm, db: Session) -> schemas.User:
+async def verify_credentials(form_data: OAuth2PasswordRequestForm, db: AsyncSession) -> schemas.User:
     """
     Verify the credentials of a user
     :param form_data:   The credentials to verify
@@ -144,13 +342,17 @@ def verify_credentials(form_data: OAuth2PasswordRequestForm, db: Session) -> sch
     :return:            The user with the given credentials
     """
     try:
-        if not (db_user := crud.user.read_by_username(db, form_data.username)):
+        if not (db_user := await crud.user.read_by_username(db, form_data.username)):
             raise UserNotFoundError(f"User not found for username: {form_data.username}")
     except UserNotFoundError as user_error:
         raise UserAuthorizationError(f"Authorization error: {user_error}") from user_error
 
     hashed_password = db_user.hashed_password
-    if not pwd_context.verify(form_data.password, hashed_password):
+    verified, needs_update = await password_hasher.verify_needs_update(form_data.password, hashed_password)
+    if not verified:
         raise UserAuthorizationError("Incorrect password")
+    if needs_update and PASSWORD_REHASH_ON_LOGIN:
+        # the hash is from another scheme or cost profile, replace it without making the login wait
+        password_rehasher.submit(db_user.id, hashed_password, form_data.password)
 
     return db_user
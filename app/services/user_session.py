@@ -1,14 +1,19 @@
 from datetime import timedelta, datetime
 from typing import Optional
-from fastapi import Response
+import logging
 
-import jwt
-from sqlalchemy.orm import Session
+from fastapi import Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from app import schemas, crud
-from app.config import ACCESS_TOKEN_EXPIRE_MINUTES, SECRET_KEY, ALGORITHM
+from app import crud, schemas
+from app.cache import session_cache, user_cache
+from app.config import ACCESS_TOKEN_EXPIRE_MINUTES, MAX_SESSIONS_PER_USER, SESSION_LIFETIME_SECONDS
+from app.crud.refresh_token import RefreshTokenReuseError
 from app.errors import UserAuthorizationError
+from app.keys import key_ring
+from app.session_store import hash_token, new_token, session_store
 
+logger = logging.getLogger(__name__)
 
 def cross_validate_user(session_user: schemas.User,
                         token_user: schemas.User):
@@ -24,27 +29,77 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = key_ring.sign(to_encode)
     return encoded_jwt
 
 
-def session_login(user: schemas.User, db: Session):
-    user_session = crud.user_session.create(db, user.id)
+async def issue_tokens(user: schemas.User, db: AsyncSession) -> schemas.Token:
+    """
+    Start a token login: a short-lived access token and a refresh token to renew it with
+    :param user:    The authenticated user
+    :param db:      The database session
+    :return:        Both tokens. Only the digest of the refresh token is stored
+    """
+    refresh_token = new_token()
+    await crud.refresh_token.create(db, user.id, hash_token(refresh_token))
+    return schemas.Token(access_token=create_access_token(data={"sub": user.username}), token_type="bearer",
+                         refresh_token=refresh_token)
 
-    users_current_sessions = crud.user_session.read_by_user(db, user.id)
-    if users_current_sessions is not None and len(users_current_sessions) >= 5:
-        oldest_session = users_current_sessions[0]
-        crud.user_session.delete(db, oldest_session.session_id)
-    # Set a cookie with the session ID, that the client's browser will store.
-    return user_session
 
+async def refresh_tokens(refresh_token: str, db: AsyncSession) -> schemas.Token:
+    """
+    Renew an access token without the password. The refresh token is rotated: it can be used once, and the
+    response carries its replacement. A token used twice means it was copied, so every token from that login is
+    revoked and both the thief and the client have to log in again.
+    :param refresh_token:   The refresh token from /session/auth or the previous refresh
+    :param db:              The database session
+    :return:                A new access token and a new refresh token
+    """
+    new_refresh_token = new_token()
+    try:
+        db_token = await crud.refresh_token.rotate(db, hash_token(refresh_token), hash_token(new_refresh_token))
+    except RefreshTokenReuseError as reuse_error:
+        logger.warning("Refresh token reused, revoked every refresh token of its login for user %d",
+                       reuse_error.user_id)
+        raise UserAuthorizationError("Refresh token has already been used") from reuse_error
+    if db_token is None:
+        raise UserAuthorizationError("Invalid or expired refresh token")
 
-def session_logout(user: schemas.User, db: Session):
-    user_sessions = crud.user_session.read_by_user(db, user.id)
-    if user_sessions is None:
-        raise UserAuthorizationError("No sessions to delete")
-    else:
-        crud.user_session.delete_by_user(db, user.id)
+    if not (user := user_cache.get_by_id(db_token.user_id)):
+        if not (db_user := await crud.user.read_by_id(db, db_token.user_id)):
+            raise UserAuthorizationError("Could not find user for refresh token.")
+        user = schemas.User.model_validate(db_user)
+        user_cache.set(user)
+    return schemas.Token(access_token=create_access_token(data={"sub": user.username}), token_type="bearer",
+                         refresh_token=new_refresh_token)
+
+
+async def session_login(user: schemas.User) -> str:
+    """
+    Start a session for a user, dropping everything past their newest MAX_SESSIONS_PER_USER
+    :param user:    The authenticated user
+    :return:        The session token, for the cookie. Only its digest is stored
+    """
+    token = new_token()
+    evicted = await session_store.create(user.id, hash_token(token), SESSION_LIFETIME_SECONDS, MAX_SESSIONS_PER_USER)
+    await session_cache.invalidate(*evicted)
+    return token
+
+
+async def session_logout(user: schemas.User):
+    """
+    End every session of a user
+    :param user:    The user
+    """
+    await session_cache.invalidate(*await session_store.delete_by_user(user.id))
     return True
 
 
+async def invalidate_user_sessions(user_id: int):
+    """
+    Drop every cached session of a user, so changes to the user are seen on their next request
+    :param user_id:     The ID of the user
+    """
+    await session_cache.invalidate(*await session_store.list_by_user(user_id))
+
+
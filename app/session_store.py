@@ -0,0 +1,183 @@
+import hashlib
+import importlib
+import secrets
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from app import crud, schemas
+from app.config import SESSION_STORE
+from app.database import AsyncSessionLocal
+
+
+def new_token() -> str:
+    """
+    :return:    A random 256-bit session token, URL safe
+    """
+    return secrets.token_urlsafe(32)
+
+
+def hash_token(token: str) -> bytes:
+    """
+    The digest sessions are stored, looked up and cached by. A leaked store or cache holds no usable tokens,
+    and the digest of a random 256-bit token needs no salt or slow hash
+    :param token:   The session token from the cookie
+    :return:        Its sha256 digest, 32 bytes
+    """
+    return hashlib.sha256(token.encode()).digest()
+
+
+class SessionStore:
+    """
+    Where sessions live, by token digest. Implement this on top of e.g. redis to move session traffic off the
+    users database altogether. Expired sessions must not be returned by get().
+    """
+
+    async def create(self, user_id: int, token_hash: bytes, lifetime: float,
+                     max_sessions: int) -> list[bytes]:
+        """
+        Create a session and drop all but the user's `max_sessions` newest
+        :return:    The token digests of the dropped sessions
+        """
+        raise NotImplementedError
+
+    async def get(self, token_hash: bytes) -> schemas.SessionInDB | None:
+        raise NotImplementedError
+
+    async def list_by_user(self, user_id: int) -> list[bytes]:
+        """
+        :return:    The token digests of the user's sessions
+        """
+        raise NotImplementedError
+
+    async def delete_by_user(self, user_id: int) -> list[bytes]:
+        """
+        :return:    The token digests of the deleted sessions
+        """
+        raise NotImplementedError
+
+    async def extend(self, last_seen: dict[bytes, datetime], lifetime: float):
+        """
+        Make each session expire `lifetime` seconds after it was last seen, unless it already expires later.
+        Called in batches by tasks.SessionRefresher, sessions that no longer exist are skipped
+        :param last_seen:   Token digest -> when the session was last used
+        """
+        raise NotImplementedError
+
+    async def delete_expired(self, batch_size: int) -> int:
+        """
+        Delete up to `batch_size` expired sessions, for stores that don't expire entries on their own
+        :return:    The number of deleted sessions
+        """
+        raise NotImplementedError
+
+
+class SqlSessionStore(SessionStore):
+    """
+    The user_sessions table, each call in its own short transaction on the primary.
+    """
+
+    def __init__(self, sessionmaker=AsyncSessionLocal):
+        self.sessionmaker = sessionmaker
+
+    async def create(self, user_id: int, token_hash: bytes, lifetime: float,
+                     max_sessions: int) -> list[bytes]:
+        async with self.sessionmaker() as db:
+            _, evicted = await crud.user_session.create_capped(
+                db, user_id, token_hash, max_sessions, expires_at=datetime.utcnow() + timedelta(seconds=lifetime))
+        return evicted
+
+    async def get(self, token_hash: bytes) -> schemas.SessionInDB | None:
+        async with self.sessionmaker() as db:
+            db_session = await crud.user_session.read_by_token_hash(db, token_hash)
+            return schemas.SessionInDB.model_validate(db_session) if db_session else None
+
+    async def list_by_user(self, user_id: int) -> list[bytes]:
+        async with self.sessionmaker() as db:
+            return [db_session.token_hash for db_session in await crud.user_session.read_by_user(db, user_id)]
+
+    async def delete_by_user(self, user_id: int) -> list[bytes]:
+        async with self.sessionmaker() as db:
+            return await crud.user_session.delete_by_user(db, user_id)
+
+    async def extend(self, last_seen: dict[bytes, datetime], lifetime: float):
+        async with self.sessionmaker() as db:
+            await crud.user_session.extend(db, last_seen, timedelta(seconds=lifetime))
+
+    async def delete_expired(self, batch_size: int) -> int:
+        async with self.sessionmaker() as db:
+            return await crud.user_session.delete_expired(db, batch_size)
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Process local stand-in for a key-value store, for tests and development. Sessions are lost on restart
+    and not shared between workers.
+    """
+
+    def __init__(self):
+        self._sessions: dict[bytes, schemas.SessionInDB] = {}
+        # user id -> their token digests, oldest first
+        self._by_user: dict[int, OrderedDict[bytes, None]] = {}
+
+    def _drop(self, token_hash: bytes):
+        if (session := self._sessions.pop(token_hash, None)) is not None:
+            user_hashes = self._by_user.get(session.user_id, {})
+            user_hashes.pop(token_hash, None)
+            if not user_hashes:
+                self._by_user.pop(session.user_id, None)
+
+    async def create(self, user_id: int, token_hash: bytes, lifetime: float,
+                     max_sessions: int) -> list[bytes]:
+        now = datetime.utcnow()
+        self._sessions[token_hash] = schemas.SessionInDB(user_id=user_id, token_hash=token_hash, created_at=now,
+                                                         expires_at=now + timedelta(seconds=lifetime))
+        user_hashes = self._by_user.setdefault(user_id, OrderedDict())
+        user_hashes[token_hash] = None
+        evicted = list(user_hashes)[:-max_sessions] if len(user_hashes) > max_sessions else []
+        for evicted_hash in evicted:
+            self._drop(evicted_hash)
+        return evicted
+
+    async def get(self, token_hash: bytes) -> schemas.SessionInDB | None:
+        session = self._sessions.get(token_hash)
+        return session if session is not None and session.expires_at > datetime.utcnow() else None
+
+    async def list_by_user(self, user_id: int) -> list[bytes]:
+        return list(self._by_user.get(user_id, ()))
+
+    async def delete_by_user(self, user_id: int) -> list[bytes]:
+        deleted = list(self._by_user.get(user_id, ()))
+        for token_hash in deleted:
+            self._drop(token_hash)
+        return deleted
+
+    async def extend(self, last_seen: dict[bytes, datetime], lifetime: float):
+        for token_hash, seen in last_seen.items():
+            session = self._sessions.get(token_hash)
+            if session is not None and session.expires_at < (expires_at := seen + timedelta(seconds=lifetime)):
+                self._sessions[token_hash] = session.model_copy(update={"last_seen_at": seen,
+                                                                        "expires_at": expires_at})
+
+    async def delete_expired(self, batch_size: int) -> int:
+        now = datetime.utcnow()
+        expired = [token_hash for token_hash, session in self._sessions.items() if session.expires_at <= now]
+        for token_hash in expired[:batch_size]:
+            self._drop(token_hash)
+        return min(len(expired), batch_size)
+
+
+def load_store(spec: str | None) -> SessionStore:
+    """
+    Build a session store from a config value
+    :param spec:    None for the user_sessions table, "memory", or "package.module:Class" for a SessionStore subclass
+    :return:        The store
+    """
+    if not spec:
+        return SqlSessionStore()
+    if spec == "memory":
+        return InMemorySessionStore()
+    module_name, _, class_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+session_store = load_store(SESSION_STORE)
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from app import crud
+from app.config import (SESSION_REAPER_INTERVAL, SESSION_REAPER_BATCH_SIZE, SESSION_LIFETIME_SECONDS,
+                        SESSION_REFRESH_AFTER, SESSION_REFRESH_INTERVAL, SESSION_REFRESH_MAX_PENDING,
+                        HASH_POOL_MAX_PENDING)
+from app.database import AsyncSessionLocal
+from app.errors import ServiceUnavailableError
+from app.hashing import password_hasher
+from app.session_store import session_store
+
+logger = logging.getLogger(__name__)
+
+
+async def _delete_expired_refresh_tokens(batch_size: int) -> int:
+    async with AsyncSessionLocal() as db:
+        return await crud.refresh_token.delete_expired(db, batch_size)
+
+
+class SessionReaper:
+    """
+    Periodically deletes expired sessions and refresh tokens in batches of `batch_size`, each batch in its own
+    transaction so no lock is held for longer than one small delete.
+    """
+
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.deleted = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def reap(self) -> int:
+        """
+        Delete every session and refresh token that has expired so far
+        :return:    The number of deleted sessions and refresh tokens
+        """
+        deleted = await self._reap(session_store.delete_expired) + await self._reap(_delete_expired_refresh_tokens)
+        self.deleted += deleted
+        return deleted
+
+    async def _reap(self, delete_expired: Callable[[int], Awaitable[int]]) -> int:
+        deleted = 0
+        while True:
+            batch = await delete_expired(self.batch_size)
+            deleted += batch
+            if batch < self.batch_size:
+                break
+            # give requests a turn between batches
+            await asyncio.sleep(0)
+        return deleted
+
+    async def _run(self):
+        while True:
+            try:
+                if deleted := await self.reap():
+                    logger.info("Deleted %d expired sessions and refresh tokens", deleted)
+            except Exception:
+                logger.exception("Failed to delete expired sessions and refresh tokens")
+            await asyncio.sleep(self.interval)
+
+
+class SessionRefresher:
+    """
+    Sliding session expiry without a write per request. A session is only extended once `refresh_after` of its
+    lifetime has passed, and then only in memory: the last-seen time goes into a buffer of at most `max_pending`
+    sessions, and the buffer is written every `interval` seconds in UPDATEs of `batch_size` sessions, sooner when
+    it fills up, and once more on shutdown.
+
+    A session used over and over between two flushes is one entry and one row in the next flush. The interval
+    has to stay well below the part of the lifetime left when a session becomes due, or it could expire in the
+    store before its extension is written.
+    """
+
+    def __init__(self, lifetime: float, refresh_after: float, interval: float, max_pending: int,
+                 batch_size: int = 1000):
+        self.lifetime = lifetime
+        self.refresh_after = refresh_after
+        self.interval = interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flushed = 0
+        self.dropped = 0
+        self._pending: dict[bytes, datetime] = {}
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def refresh(self, token_hash: bytes, expires_at: datetime) -> datetime | None:
+        """
+        Extend a session that was just used, if it is due
+        :param token_hash:  The digest of the session token
+        :param expires_at:  When the session expires as far as the caller knows
+        :return:            The new expiry, or None if the session was left as it is
+        """
+        if self.interval <= 0:
+            return None
+        now = datetime.utcnow()
+        if (expires_at - now).total_seconds() > self.lifetime * (1 - self.refresh_after):
+            return None
+        if token_hash not in self._pending and len(self._pending) >= self.max_pending:
+            # not extended, so the next request for this session tries again
+            self.dropped += 1
+            self._full.set()
+            return None
+        self._pending[token_hash] = now
+        if len(self._pending) >= self.max_pending:
+            self._full.set()
+        return now + timedelta(seconds=self.lifetime)
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop flushing periodically and write what is still buffered
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Failed to write %d session extensions on shutdown", len(self._pending))
+
+    async def flush(self) -> int:
+        """
+        Write every buffered extension
+        :return:    The number of sessions written
+        """
+        pending, self._pending = self._pending, {}
+        self._full.clear()
+        items = list(pending.items())
+        for start in range(0, len(items), self.batch_size):
+            batch = dict(items[start:start + self.batch_size])
+            try:
+                await session_store.extend(batch, self.lifetime)
+            except Exception:
+                # put back what wasn't written, unless the session was used again since, up to the bound
+                for token_hash, seen in items[start:]:
+                    if len(self._pending) >= self.max_pending:
+                        break
+                    self._pending.setdefault(token_hash, seen)
+                raise
+            self.flushed += len(batch)
+        return len(items)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write session extensions")
+
+    def metrics(self) -> dict:
+        return {"pending": len(self._pending), "flushed": self.flushed, "dropped": self.dropped}
+
+
+class PasswordRehasher:
+    """
+    Replaces password hashes made with an outdated scheme or cost, right after a login has proven the password.
+    The new hash and its UPDATE run in the background, so the login answers without waiting for a second hash.
+
+    Rehashes take a place in the hashing pool like any other hash, but at most `max_in_flight` at once: past that,
+    or while the pool turns work away, a rehash is skipped and happens at one of the user's later logins.
+    """
+
+    def __init__(self, max_in_flight: int):
+        self.max_in_flight = max_in_flight
+        self.rehashed = 0
+        self.skipped = 0
+        self.failed = 0
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(self, user_id: int, old_hash: str, password: str) -> bool:
+        """
+        Schedule a rehash
+        :param user_id:     The ID of the user who just logged in
+        :param old_hash:    Their current hash, it is only replaced if it is still the current one
+        :param password:    The password they logged in with
+        :return:            Whether the rehash was scheduled
+        """
+        if len(self._tasks) >= self.max_in_flight:
+            self.skipped += 1
+            return False
+        task = asyncio.create_task(self._rehash(user_id, old_hash, password))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _rehash(self, user_id: int, old_hash: str, password: str):
+        try:
+            new_hash = await password_hasher.hash(password)
+            async with AsyncSessionLocal() as db:
+                if await crud.user.replace_password_hash(db, user_id, old_hash, new_hash):
+                    self.rehashed += 1
+        except ServiceUnavailableError:
+            self.skipped += 1
+        except Exception:
+            self.failed += 1
+            logger.exception("Failed to rehash the password of user %d", user_id)
+
+    async def stop(self):
+        """
+        Wait for the rehashes in progress, before the hashing pool and the engines go
+        """
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def metrics(self) -> dict:
+        return {"in_flight": len(self._tasks), "rehashed": self.rehashed, "skipped": self.skipped,
+                "failed": self.failed}
+
+
+session_reaper = SessionReaper(SESSION_REAPER_INTERVAL, SESSION_REAPER_BATCH_SIZE)
+session_refresher = SessionRefresher(SESSION_LIFETIME_SECONDS, SESSION_REFRESH_AFTER, SESSION_REFRESH_INTERVAL,
+                                     SESSION_REFRESH_MAX_PENDING)
+# at most half the pool's queue, logins keep the rest
+password_rehasher = PasswordRehasher(max(1, HASH_POOL_MAX_PENDING // 2))
@@ -0,0 +1,18 @@
+"""
+Shared setup for the benchmark scripts.
+
+Importing this module points the app at a throwaway sqlite database (unless the environment already
+configures one) so the benchmarks can run without a MySQL server. Import it before anything from `app`.
+"""
+import os
+import tempfile
+
+BENCH_DIR = tempfile.mkdtemp(prefix="fast-backend-bench-")
+BENCH_DB = os.path.join(BENCH_DIR, "bench.db")
+
+os.environ.setdefault("DB_URL", f"sqlite:///{BENCH_DB}")
+os.environ.setdefault("ASYNC_DB_URL", f"sqlite+aiosqlite:///{BENCH_DB}")
+os.environ.setdefault("CRYPT_SCHEME", "bcrypt")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-at-least-32-bytes-long")
+os.environ.setdefault("HASH_ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "15")
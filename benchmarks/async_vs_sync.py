@@ -0,0 +1,117 @@
+"""
+Throughput of the async request path against the old sync (threadpool) one.
+
+Both modes serve `GET /user/{user_id}` from the same database through the same chain: MetricsMiddleware, a
+yield `get_db` dependency, the service, the crud read and the ETag headers. The sync mode is a stand-in app
+that reproduces the previous stack on top of that: `def` route and dependency run in starlette's threadpool,
+with a blocking `SessionLocal()`.
+
+Against the bundled sqlite setup the async path is the slower one, about 320-350 against 380 req/s on a single
+core: aiosqlite hands every call to a thread of its own and waits for the answer on a queue, which costs more
+than the sqlite3 call it wraps, and sqlite answers from memory so there is no waiting on the database for the
+event loop to overlap. What the async path buys shows with a networked database, where each query waits on a
+round trip: run it against MySQL and aiomysql, the production driver, before drawing conclusions.
+
+    python -m benchmarks.async_vs_sync --requests 5000 --concurrency 200
+    DB_URL=mysql+pymysql://... ASYNC_DB_URL=mysql+aiomysql://... python -m benchmarks.async_vs_sync
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks import _env  # noqa: F401
+
+import httpx
+from fastapi import Depends, FastAPI, Header, Response
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session, sessionmaker
+
+from app import models, schemas
+from app.api.user import _PUBLIC, _etag, _matches, _not_modified
+from app.cache import user_cache
+from app.database import SQLALCHEMY_DB_URL, create_tables, engine
+from app.errors import UserNotFoundError
+from app.instrumentation import MetricsMiddleware, RequestMetrics
+from app.main import app as async_app
+
+
+def build_sync_app(concurrency: int) -> FastAPI:
+    sync_app = FastAPI()
+    sync_app.add_middleware(MetricsMiddleware, metrics=RequestMetrics())
+    # a connection for every request in flight: with fewer, the routes holding the threadpool's threads wait on
+    # the pool for connections that are only returned by `get_db` exits queued behind them for a thread, and
+    # the run deadlocks instead of measuring anything
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False,
+                                bind=create_engine(SQLALCHEMY_DB_URL, pool_size=concurrency, max_overflow=0))
+
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def read_by_id(db: Session, user_id: int) -> models.User | None:
+        return db.scalar(select(models.User).filter(models.User.id == user_id))
+
+    def get_user_by_id(user_id: int, db: Session) -> schemas.User:
+        if db_user := read_by_id(db, user_id):
+            user_cache.set_version(db_user.id, db_user.version)
+            return db_user
+        raise UserNotFoundError(f"Could not find user with ID {user_id}")
+
+    @sync_app.get("/user/{user_id}", response_model=schemas.User)
+    def read_user(user_id: int, response: Response, if_none_match: str | None = Header(None),
+                  db: Session = Depends(get_db)):
+        user = get_user_by_id(user_id, db)
+        etag = _etag(user.id, user.version)
+        if _matches(if_none_match, etag):
+            return _not_modified(etag, _PUBLIC)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = _PUBLIC
+        return user
+
+    return sync_app
+
+
+def seed(users: int):
+    create_tables()
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [
+            {"username": f"user{i}", "email": f"user{i}@example.com", "display_name": f"user{i}",
+             "hashed_password": "x", "is_active": True}
+            for i in range(users)
+        ])
+
+
+async def run(app, requests: int, concurrency: int, users: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one():
+            async with semaphore:
+                response = await client.get(f"/user/{random.randint(1, users)}")
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(requests)))
+        return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    seed(args.users)
+    for name, app in (("sync", build_sync_app(args.concurrency)), ("async", async_app)):
+        throughput = asyncio.run(run(app, args.requests, args.concurrency, args.users))
+        print(f"{name:>6}: {throughput:8.1f} req/s  ({args.requests} requests, concurrency {args.concurrency})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Concurrent signups competing for the same usernames, with the old check-then-insert create_user and the
+constraint-driven services.user.create_user. Exactly one signup per username should succeed and every other
+one should get a UserCreationError, never an unhandled IntegrityError.
+
+    python -m benchmarks.concurrent_signup --usernames 200 --attempts 4 --concurrency 32
+
+Point DB_URL / ASYNC_DB_URL at MySQL for meaningful contention. sqlite lets one writer in at a time and the rest
+back off and retry, so past a couple of concurrent writers a starved one can give up with "database is locked"
+after 5s (reported as OperationalError). The default concurrency is 2 on sqlite for that reason.
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from benchmarks import _env  # noqa: F401
+
+from sqlalchemy import delete, event, func, select
+from sqlalchemy.exc import IntegrityError
+
+from app import crud, models, schemas, services
+from app.database import AsyncSessionLocal, async_engine, create_tables, engine
+from app.errors import UserCreationError
+from app.hashing import password_hasher
+
+
+async def legacy_create_user(user: schemas.UserCreate, db):
+    # create_user before: look both identifiers up, then insert, with a race window in between
+    if error := next((msg for msg, check in [
+        ("Email already registered", await crud.user.read_by_email(db, user.email)),
+        ("Username already registered", await crud.user.read_by_username(db, user.username))
+    ] if check), None):
+        raise UserCreationError(error)
+    return await crud.user.create(db, {"username": user.username, "email": user.email,
+                                       "display_name": user.username, "hashed_password": "x", "is_active": True})
+
+
+async def signup(create_user, user: schemas.UserCreate, gate: asyncio.Semaphore, outcomes: Counter):
+    async with gate:
+        async with AsyncSessionLocal() as db:
+            try:
+                await create_user(user, db)
+                outcomes["created"] += 1
+            except UserCreationError:
+                outcomes["rejected"] += 1
+            except IntegrityError:
+                outcomes["unhandled IntegrityError"] += 1
+            except Exception as error:
+                outcomes[f"other: {type(error).__name__}"] += 1
+
+
+async def run(name: str, create_user, usernames: int, attempts: int, concurrency: int, statements: Counter):
+    with engine.begin() as conn:
+        conn.execute(delete(models.User))
+    users = [schemas.UserCreate(username=f"user{i}", email=f"user{i}@example.com", password="password1")
+             for _ in range(attempts) for i in range(usernames)]
+    gate = asyncio.Semaphore(concurrency)
+    outcomes = Counter()
+    statements.clear()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(signup(create_user, user, gate, outcomes) for user in users))
+    elapsed = time.perf_counter() - start
+
+    async with AsyncSessionLocal() as db:
+        rows = await db.scalar(select(func.count()).select_from(models.User))
+    correct = outcomes["created"] == usernames == rows and not outcomes["unhandled IntegrityError"]
+    print(f"{name:>10}: {len(users) / elapsed:8.1f} signups/s, "
+          f"{statements['count'] / len(users):4.2f} statements per signup, {rows} rows, "
+          f"{dict(outcomes)} -> {'correct' if correct else 'WRONG'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usernames", type=int, default=200)
+    parser.add_argument("--attempts", type=int, default=4, help="signups per username")
+    parser.add_argument("--concurrency", type=int, help="default: 32, 2 on sqlite")
+    args = parser.parse_args()
+    if args.concurrency is None:
+        args.concurrency = 2 if engine.dialect.name == "sqlite" else 32
+
+    create_tables()
+    statements = Counter()
+
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def count_statement(*_):
+        statements["count"] += 1
+
+    # bcrypt costs the same in both versions and would drown out the database work being compared
+    async def skip_hashing(password: str) -> str:
+        return "x"
+
+    password_hasher.hash = skip_hashing
+
+    async def both():
+        await run("before", legacy_create_user, args.usernames, args.attempts, args.concurrency, statements)
+        await run("after", services.user.create_user, args.usernames, args.attempts, args.concurrency, statements)
+        await async_engine.dispose()
+
+    asyncio.run(both())
+
+
+if __name__ == "__main__":
+    main()
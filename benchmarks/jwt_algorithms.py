@@ -0,0 +1,73 @@
+"""
+Cost of signing and verifying an access token per algorithm, with a fresh key of each kind. "key ring" is what
+get_user_by_token pays on a token cache miss: app.keys.KeyRing.verify, the kid lookup and the signature check.
+The two decode columns are jwt.decode alone, handed the key object parsed once against the PEM text, which
+PyJWT parses again on every call: the difference is what the pre-parsed keys save per verification.
+
+    python -m benchmarks.jwt_algorithms --iterations 2000
+"""
+import argparse
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks import _env  # noqa: F401
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+
+from app.keys import KeyRing, generate_key
+
+ALGORITHMS = ("HS256", "RS256", "ES256", "EdDSA")
+
+
+def per_call(function, iterations: int, rounds: int = 5) -> float:
+    # the best of a few rounds, the differences between columns are small next to a noisy neighbour
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(max(1, iterations // rounds)):
+            function()
+        best = min(best, (time.perf_counter() - start) / max(1, iterations // rounds))
+    return best
+
+
+def measure(algorithm: str, iterations: int) -> dict[str, float]:
+    directory = tempfile.mkdtemp(prefix=f"jwt-{algorithm}-")
+    secret = "benchmark-secret-at-least-32-bytes-long"
+    if algorithm != "HS256":
+        generate_key(algorithm, directory)
+    # reload_seconds high enough that the directory isn't even stat'ed during the run
+    key_ring = KeyRing(algorithm, secret, directory, activation_seconds=0, reload_seconds=3600)
+    payload = {"sub": "benchmark", "exp": datetime.utcnow() + timedelta(minutes=15)}
+    token = key_ring.sign(payload)
+
+    key = key_ring.signing_key()
+    pem = secret if algorithm == "HS256" else key.public_key.public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+
+    return {
+        "sign": per_call(lambda: key_ring.sign(payload), iterations),
+        "key ring": per_call(lambda: key_ring.verify(token), iterations),
+        "parsed key": per_call(lambda: jwt.decode(token, key.public_key, algorithms=[algorithm]), iterations),
+        "PEM": per_call(lambda: jwt.decode(token, pem, algorithms=[algorithm]), iterations),
+        "token bytes": len(token),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--algorithms", nargs="+", default=list(ALGORITHMS), choices=ALGORITHMS)
+    args = parser.parse_args()
+
+    print(f"{'us per token':<14} {'sign':>8} {'key ring':>10} {'decode, parsed key':>20} {'decode, PEM':>13} "
+          f"{'token bytes':>12}")
+    for algorithm in args.algorithms:
+        # RSA signing is slow enough that a tenth of the iterations says as much
+        results = measure(algorithm, args.iterations // 10 if algorithm == "RS256" else args.iterations)
+        print(f"{algorithm:<14} {results['sign'] * 1e6:>8.1f} {results['key ring'] * 1e6:>10.1f} "
+              f"{results['parsed key'] * 1e6:>20.1f} {results['PEM'] * 1e6:>13.1f} {results['token bytes']:>12}")
+
+if __name__ == "__main__":
+    main()
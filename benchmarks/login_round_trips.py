@@ -0,0 +1,79 @@
+"""
+Database round trips and latency per login, for the old create + read_by_user + delete flow and the
+single transaction crud.user_session.create_capped.
+
+    python -m benchmarks.login_round_trips --logins 500
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks import _env  # noqa: F401
+
+from sqlalchemy import event, insert
+
+from app import crud, models
+from app.config import MAX_SESSIONS_PER_USER
+from app.database import AsyncSessionLocal, async_engine, create_tables, engine
+from app.session_store import hash_token, new_token
+
+
+class RoundTrips:
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def listen(self, sync_engine):
+        @event.listens_for(sync_engine, "before_cursor_execute")
+        def count_statement(*args):
+            self.statements += 1
+
+        @event.listens_for(sync_engine, "commit")
+        def count_commit(*args):
+            self.commits += 1
+
+
+async def legacy_login(db, user_id: int):
+    # the flow session_login used before: commit + refresh, load every session, delete the oldest in a second commit
+    user_session = await crud.user_session.create(db, user_id, hash_token(new_token()))
+    users_current_sessions = await crud.user_session.read_by_user(db, user_id)
+    if users_current_sessions is not None and len(users_current_sessions) >= MAX_SESSIONS_PER_USER:
+        await crud.user_session.delete(db, users_current_sessions[0].token_hash)
+    return user_session
+
+
+async def capped_login(db, user_id: int):
+    user_session, _ = await crud.user_session.create_capped(db, user_id, hash_token(new_token()),
+                                                            MAX_SESSIONS_PER_USER)
+    return user_session
+
+
+async def run(name: str, login, user_id: int, logins: int, counter: RoundTrips):
+    counter.statements = counter.commits = 0
+    start = time.perf_counter()
+    for _ in range(logins):
+        async with AsyncSessionLocal() as db:
+            await login(db, user_id)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8}: {counter.statements / logins:5.2f} statements + {counter.commits / logins:4.2f} commits "
+          f"per login, {elapsed / logins * 1000:6.2f} ms per login")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=500)
+    args = parser.parse_args()
+
+    create_tables()
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [
+            {"username": f"user{i}", "email": f"user{i}@example.com", "hashed_password": "x"} for i in (1, 2)])
+
+    counter = RoundTrips()
+    counter.listen(async_engine.sync_engine)
+    asyncio.run(run("before", legacy_login, 1, args.logins, counter))
+    asyncio.run(run("after", capped_login, 2, args.logins, counter))
+
+
+if __name__ == "__main__":
+    main()
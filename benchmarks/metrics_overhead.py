@@ -0,0 +1,76 @@
+"""
+Per request cost of MetricsMiddleware: a trivial route called straight through ASGI, with and without it.
+
+    python -m benchmarks.metrics_overhead --requests 20000
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks import _env  # noqa: F401
+
+from fastapi import FastAPI
+
+from app.instrumentation import MetricsMiddleware, QueryStats, RequestMetrics
+
+
+def build_app(instrumented: bool) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/item/{item_id}")
+    async def read_item(item_id: int):
+        return {"id": item_id}
+
+    if instrumented:
+        app.add_middleware(MetricsMiddleware, metrics=RequestMetrics())
+    return app
+
+
+async def call(app: FastAPI, item_id: int):
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": f"/item/{item_id}", "raw_path": f"/item/{item_id}".encode(), "root_path": "",
+             "query_string": b"", "headers": [], "client": ("127.0.0.1", 1), "server": ("testserver", 80)}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def per_request(app: FastAPI, requests: int) -> float:
+    for item_id in range(200):
+        await call(app, item_id)
+    start = time.perf_counter()
+    for item_id in range(requests):
+        await call(app, item_id)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    plain, instrumented = build_app(False), build_app(True)
+    # best of a few alternating rounds, so a noisy neighbour hits both sides alike
+    bare = measured = float("inf")
+    for _ in range(args.rounds):
+        bare = min(bare, asyncio.run(per_request(plain, args.requests)))
+        measured = min(measured, asyncio.run(per_request(instrumented, args.requests)))
+    print(f"without metrics: {bare * 1e6:7.1f} us/request")
+    print(f"   with metrics: {measured * 1e6:7.1f} us/request "
+          f"(+{(measured - bare) * 1e6:.1f} us, {(measured - bare) / bare:+.1%})")
+
+    metrics, stats = RequestMetrics(), QueryStats()
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        metrics.observe("GET", "/item/{item_id}", 200, 0.0042, stats)
+    print(f"RequestMetrics.observe alone: {(time.perf_counter() - start) / args.requests * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
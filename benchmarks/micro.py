@@ -0,0 +1,103 @@
+"""
+Micro-benchmarks for the per request building blocks: issuing and resolving access tokens, bcrypt verify and
+the pydantic validation in schemas.user. Times are per call, best of a few repeats.
+
+    python -m benchmarks.micro
+"""
+import argparse
+import asyncio
+import time
+import timeit
+
+from benchmarks import _env  # noqa: F401
+
+from sqlalchemy import delete, insert
+
+from app import models, schemas, services
+from app.cache import token_cache, user_cache
+from app.config import pwd_context
+from app.database import AsyncSessionLocal, async_engine, create_tables, engine
+from benchmarks.results import result
+
+USERNAME = "micro_bench"
+PASSWORD = "password1"
+
+
+def per_call(fn, repeat: int = 3) -> float:
+    timer = timeit.Timer(fn)
+    calls, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=calls)) / calls
+
+
+async def per_call_async(fn, min_time: float = 0.2, repeat: int = 3) -> float:
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            await fn()
+        if time.perf_counter() - start >= min_time:
+            break
+        calls *= 2
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            await fn()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+async def token_lookups(token: str) -> tuple[float, float]:
+    async with AsyncSessionLocal() as db:
+        async def cached():
+            await services.user.get_user_by_token(token, db)
+
+        async def uncached():
+            token_cache.local.clear()
+            user_cache.by_id.clear()
+            await services.user.get_user_by_token(token, db)
+
+        await cached()
+        return await per_call_async(cached), await per_call_async(uncached)
+
+
+def run() -> dict[str, dict]:
+    """
+    Run every micro-benchmark
+    :return:    Result entries by name, in microseconds per call
+    """
+    create_tables()
+    hashed_password = pwd_context.hash(PASSWORD)
+    with engine.begin() as conn:
+        conn.execute(delete(models.User).filter(models.User.username == USERNAME))
+        conn.execute(insert(models.User), [{"username": USERNAME, "email": f"{USERNAME}@example.com",
+                                            "display_name": USERNAME, "hashed_password": hashed_password,
+                                            "is_active": True}])
+
+    token = services.user_session.create_access_token(data={"sub": USERNAME})
+    cached, uncached = asyncio.run(token_lookups(token))
+    asyncio.run(async_engine.dispose())
+
+    user_fields = {"username": USERNAME, "email": f"{USERNAME}@example.com", "password": PASSWORD}
+    db_user = models.User(id=1, username=USERNAME, email=f"{USERNAME}@example.com", display_name=USERNAME,
+                          is_active=True, version=1, hashed_password=hashed_password)
+    timings = {
+        "create_access_token": per_call(lambda: services.user_session.create_access_token(data={"sub": USERNAME})),
+        "get_user_by_token_cached": cached,
+        "get_user_by_token_uncached": uncached,
+        "pwd_context_verify": per_call(lambda: pwd_context.verify(PASSWORD, hashed_password), repeat=1),
+        "user_create_validate": per_call(lambda: schemas.UserCreate.model_validate(user_fields)),
+        "user_from_orm": per_call(lambda: schemas.User.model_validate(db_user)),
+        "user_dump_json": per_call(schemas.User.model_validate(db_user).model_dump_json),
+    }
+    return {f"micro.{name}": result(seconds * 1e6, "us") for name, seconds in timings.items()}
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter).parse_args()
+    for name, entry in run().items():
+        print(f"{name:<40} {entry['value']:>12.2f} {entry['unit']}")
+
+
+if __name__ == "__main__":
+    main()
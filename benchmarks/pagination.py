@@ -0,0 +1,70 @@
+"""
+Page latency of offset (`skip`) against keyset (`cursor`) pagination on a large users table.
+
+    python -m benchmarks.pagination --users 1000000 --limit 100
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from benchmarks import _env  # noqa: F401
+
+from sqlalchemy import insert
+
+from app import crud, models
+from app.database import AsyncSessionLocal, create_tables, engine
+
+CHUNK = 10_000
+
+
+def seed(users: int):
+    create_tables()
+    with engine.begin() as conn:
+        for start in range(0, users, CHUNK):
+            conn.execute(insert(models.User), [
+                {"username": f"user{i}", "email": f"user{i}@example.com", "display_name": f"user{i}",
+                 "hashed_password": "x", "is_active": True}
+                for i in range(start, min(start + CHUNK, users))
+            ])
+
+
+async def page_latency(depth: int, limit: int, keyset: bool, repeat: int) -> float:
+    samples = []
+    async with AsyncSessionLocal() as db:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if keyset:
+                # ids are sequential from 1, so the last id before `depth` rows is `depth`
+                page = await crud.user.read(db, limit=limit, after_id=depth)
+            else:
+                page = await crud.user.read(db, skip=depth, limit=limit)
+            samples.append(time.perf_counter() - start)
+            assert page[0].id == depth + 1
+            db.expunge_all()
+    return statistics.median(samples)
+
+
+async def run(users: int, limit: int, repeat: int):
+    print(f"{'depth':>10} {'offset ms':>10} {'keyset ms':>10}")
+    for depth in (0, users // 100, users // 10, users // 2, users - limit):
+        offset = await page_latency(depth, limit, keyset=False, repeat=repeat)
+        keyset = await page_latency(depth, limit, keyset=True, repeat=repeat)
+        print(f"{depth:>10} {offset * 1000:>10.2f} {keyset * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    seed(args.users)
+    print(f"seeded {args.users} users in {time.perf_counter() - start:.1f}s")
+    asyncio.run(run(args.users, args.limit, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
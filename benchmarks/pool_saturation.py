@@ -0,0 +1,69 @@
+"""
+Connection pool behaviour as concurrency grows past pool_size + max_overflow.
+
+Every task checks out a connection, runs a query and keeps the connection for `--hold` ms, like a request
+doing some work inside a transaction. Past the pool's capacity, throughput flattens, checkout waits grow and,
+once they exceed DB_POOL_TIMEOUT, checkouts start failing.
+
+    DB_POOL_SIZE=4 DB_MAX_OVERFLOW=2 DB_POOL_TIMEOUT=1 python -m benchmarks.pool_saturation
+"""
+import argparse
+import asyncio
+import os
+import time
+
+os.environ.setdefault("DB_POOL_SIZE", "4")
+os.environ.setdefault("DB_MAX_OVERFLOW", "2")
+os.environ.setdefault("DB_POOL_TIMEOUT", "1")
+
+from benchmarks import _env  # noqa: F401
+
+from sqlalchemy import exc, text
+
+from app.database import async_engine, pool_metrics, pool_stats
+
+
+async def hold_connection(hold: float) -> bool:
+    try:
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            await asyncio.sleep(hold)
+        return True
+    except exc.TimeoutError:
+        return False
+
+
+async def run(concurrency: int, tasks: int, hold: float):
+    pool_stats["primary"].reset()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            return await hold_connection(hold)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(tasks)))
+    elapsed = time.perf_counter() - start
+
+    metrics = pool_metrics(async_engine, pool_stats["primary"])
+    wait = metrics["checkout_wait_seconds"]
+    print(f"{concurrency:>11} {sum(results) / elapsed:>9.1f} {wait['p50'] * 1000:>9.1f} {wait['p99'] * 1000:>9.1f} "
+          f"{metrics['timeouts']:>8}")
+
+
+async def main(levels: list[int], tasks: int, hold: float):
+    print(f"pool_size={os.environ['DB_POOL_SIZE']} max_overflow={os.environ['DB_MAX_OVERFLOW']} "
+          f"timeout={os.environ['DB_POOL_TIMEOUT']}s hold={hold * 1000:.0f}ms")
+    print(f"{'concurrency':>11} {'ok/s':>9} {'wait p50':>9} {'wait p99':>9} {'timeouts':>8}")
+    for concurrency in levels:
+        await run(concurrency, tasks, hold)
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 6, 8, 16, 32, 64])
+    parser.add_argument("--tasks", type=int, default=400)
+    parser.add_argument("--hold", type=float, default=20, help="milliseconds each connection is held")
+    args = parser.parse_args()
+    asyncio.run(main(args.levels, args.tasks, args.hold / 1000))
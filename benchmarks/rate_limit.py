@@ -0,0 +1,76 @@
+"""
+Cost of the login throttle: LoginThrottle.check on its own, and a rejected POST /session/login against one
+that gets through to a password check, through the full app. Rejected attempts should run no statements and
+no hashes.
+
+    python -m benchmarks.rate_limit --requests 2000
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks import _env  # noqa: F401
+
+import httpx
+from sqlalchemy import event, insert
+
+from app import models
+from app.config import pwd_context
+from app.database import async_engine, create_tables, engine
+from app.hashing import password_hasher
+from app.main import app
+from app.ratelimit import InMemoryRateLimitBackend, LoginThrottle, login_throttle
+
+
+async def check_cost(requests: int) -> float:
+    # limits high enough that every check passes and keeps updating its buckets
+    throttle = LoginThrottle(InMemoryRateLimitBackend(100_000), 1e9, 10 ** 9, 1e9, 10 ** 9, 5, 30, 900, 3600)
+    start = time.perf_counter()
+    for i in range(requests):
+        await throttle.check(f"10.0.{i % 256}.{i // 256 % 256}", f"user{i % 1000}")
+    return (time.perf_counter() - start) / requests
+
+
+async def login_cost(client: httpx.AsyncClient, username: str, requests: int, statements: list[int]) -> tuple:
+    statements[0] = 0
+    hashes = password_hasher.latency["verify"].count
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = await client.post("/session/login", data={"username": username, "password": "wrong-password"})
+    elapsed = (time.perf_counter() - start) / requests
+    hashes = password_hasher.latency["verify"].count - hashes
+    return elapsed, response.status_code, statements[0] / requests, hashes / requests
+
+
+async def main(requests: int):
+    print(f"LoginThrottle.check (allowed): {await check_cost(requests * 10) * 1e6:8.2f} us")
+
+    create_tables()
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"username": name, "hashed_password": pwd_context.hash("password1"),
+                                            "is_active": True} for name in ("victim", "bystander")])
+    statements = [0]
+
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def count_statement(*_):
+        statements[0] += 1
+
+    # one throttle for the whole app: lock one account, let the other through every time
+    login_throttle.user_limit = login_throttle.ip_limit = (10 ** 9, 1e9)
+    login_throttle.lockout_threshold = 10 ** 9
+    await login_throttle.backend.lock("lockout:victim", 3600)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            for name, username, count in (("rejected (429)", "victim", requests),
+                                          ("checked  (401)", "bystander", max(1, requests // 200))):
+                elapsed, status, queries, hashes = await login_cost(client, username, count, statements)
+                print(f"{name}: {elapsed * 1000:9.3f} ms/request, status {status}, "
+                      f"{queries:.1f} statements and {hashes:.1f} hashes per request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
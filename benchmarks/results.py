@@ -0,0 +1,106 @@
+"""
+The JSON results format of the benchmark suite, and comparison against a stored baseline.
+
+    {
+      "created": "2024-01-01T12:00:00Z",
+      "python": "3.12.1",
+      "machine": "x86_64, 8 cpus",
+      "database": "sqlite",
+      "commit": "1a2b3c4",
+      "results": {
+        "micro.create_access_token": {"value": 11.8, "unit": "us", "better": "lower"},
+        "load.flows_per_second": {"value": 21.5, "unit": "flows/s", "better": "higher"}
+      }
+    }
+
+A result regresses when it moves the wrong way by more than the tolerance, relative to the baseline.
+"""
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+
+def result(value: float, unit: str, better: str = "lower") -> dict:
+    """
+    One measurement
+    :param value:   The measured value
+    :param unit:    Its unit, for display
+    :param better:  "lower" or "higher", which direction is an improvement
+    :return:        The result entry
+    """
+    return {"value": value, "unit": unit, "better": better}
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine() -> str:
+    return f"{platform.machine()}, {os.cpu_count()} cpus"
+
+
+def report(results: dict[str, dict], database: str) -> dict:
+    """
+    Wrap results with what is needed to judge whether two runs are comparable
+    :param results:     Result entries by name
+    :param database:    The database backend the run used
+    :return:            The report
+    """
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": machine(),
+        "database": database,
+        "commit": _commit(),
+        "results": results,
+    }
+
+
+def save(report: dict, path: str):
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+        file.write("\n")
+
+
+def load(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[tuple[str, float, float, float, bool]]:
+    """
+    Compare every result present in both reports
+    :param current:     The new report
+    :param baseline:    The stored report
+    :param tolerance:   The relative change allowed in the wrong direction, e.g. 0.1 for 10%
+    :return:            (name, baseline value, current value, relative change, regressed) per result
+    """
+    rows = []
+    for name, entry in current["results"].items():
+        if (base := baseline["results"].get(name)) is None or not base["value"]:
+            continue
+        change = (entry["value"] - base["value"]) / base["value"]
+        worse = change if entry["better"] == "lower" else -change
+        rows.append((name, base["value"], entry["value"], change, worse > tolerance))
+    return rows
+
+
+def print_comparison(rows: list[tuple[str, float, float, float, bool]], current: dict, baseline: dict):
+    setups = [(run["database"], run["python"], run.get("machine", "unknown machine"))
+              for run in (baseline, current)]
+    if setups[0] != setups[1]:
+        (database, python, host), (current_database, current_python, current_host) = setups
+        print(f"note: baseline ran on {database} / python {python} / {host}, "
+              f"this run on {current_database} / python {current_python} / {current_host}")
+    width = max((len(name) for name, *_ in rows), default=10)
+    print(f"{'benchmark':<{width}} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, base, value, change, regressed in rows:
+        unit = current["results"][name]["unit"]
+        print(f"{name:<{width}} {base:>12.2f} {value:>12.2f} {change:>+8.1%} {unit}"
+              f"{'  REGRESSION' if regressed else ''}")
@@ -0,0 +1,125 @@
+"""
+GET /user/ at 100, 1000 and 10000 rows: the route as it was, with response_model validating the ORM rows
+(emails through email-validator again), dumping them to dicts and the stdlib encoding those, against the current one, which validates and dumps the
+page to JSON bytes in one pass through schemas.UserList. Both run the same query, and their bodies are checked
+to be the same JSON. The query and loading the rows cost the same on both sides, so the serialization of
+already loaded rows is timed on its own too.
+
+    python -m benchmarks.serialization --rounds 5
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks import _env  # noqa: F401
+
+import httpx
+from fastapi import Depends, FastAPI
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from sqlalchemy import delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models, schemas, services
+from app.api import user_router
+from app.database import AsyncSessionLocal, async_engine, create_tables, engine
+from app.dependencies import get_db
+
+SIZES = (100, 1000, 10000)
+
+
+def seed(users: int):
+    create_tables()
+    with engine.begin() as conn:
+        conn.execute(delete(models.User).filter(models.User.username.like("serialize_%")))
+        # the password is never checked here, any string will do
+        conn.execute(insert(models.User), [
+            {"username": f"serialize_{i}", "email": f"serialize_{i}@example.com", "display_name": f"serialize_{i}",
+             "hashed_password": "not-a-hash", "is_active": True}
+            for i in range(users)
+        ])
+
+
+class LegacyUser(schemas.user.UserBase):
+    """
+    schemas.User before it stopped validating stored emails
+    """
+    id: int
+    is_active: bool
+
+    model_config = {"from_attributes": True}
+
+
+def legacy_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/user/", response_model=list[LegacyUser])
+    async def read_users(limit: int = 100, db: AsyncSession = Depends(get_db)):
+        return await services.user.get_users(limit=limit, db=db)
+
+    return app
+
+
+def current_app() -> FastAPI:
+    app = FastAPI(default_response_class=ORJSONResponse)
+    app.include_router(user_router)
+    return app
+
+
+async def per_request(client: httpx.AsyncClient, limit: int, rounds: int) -> tuple[float, bytes]:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        response = await client.get("/user/", params={"limit": limit})
+        best = min(best, time.perf_counter() - start)
+        response.raise_for_status()
+    return best, response.content
+
+
+async def serialize_only(app: FastAPI, limit: int, rounds: int) -> tuple[float, float]:
+    async with AsyncSessionLocal() as db:
+        users = await services.user.get_users(limit=limit, db=db)
+    field = next(route.response_field for route in app.routes if getattr(route, "path", None) == "/user/")
+
+    async def legacy():
+        return JSONResponse(await serialize_response(field=field, response_content=users)).body
+
+    async def current():
+        return schemas.UserList.dump_json(schemas.UserList.validate_python(users, from_attributes=True))
+
+    timings = []
+    for serialize in (legacy, current):
+        best = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            await serialize()
+            best = min(best, time.perf_counter() - start)
+        timings.append(best)
+    return timings[0], timings[1]
+
+
+async def main(rounds: int):
+    seed(max(SIZES))
+    legacy = legacy_app()
+    transports = {"legacy": httpx.ASGITransport(app=legacy), "current": httpx.ASGITransport(app=current_app())}
+    for limit in SIZES:
+        timings, bodies = {}, {}
+        for name, transport in transports.items():
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                timings[name], bodies[name] = await per_request(client, limit, rounds)
+        assert json.loads(bodies["legacy"]) == json.loads(bodies["current"])
+        print(f"{limit:>6} rows: legacy {timings['legacy'] * 1000:8.2f} ms, "
+              f"current {timings['current'] * 1000:8.2f} ms ({timings['legacy'] / timings['current']:.2f}x), "
+              f"{len(bodies['current']) / 1024:.0f} KiB")
+        legacy_seconds, current_seconds = await serialize_only(legacy, limit, rounds)
+        print(f"{'':>6}  serialization only: legacy {legacy_seconds * 1000:8.2f} ms, "
+              f"current {current_seconds * 1000:8.2f} ms ({legacy_seconds / current_seconds:.2f}x)")
+    await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5, help="requests per size and path, the best one counts")
+    args = parser.parse_args()
+    asyncio.run(main(args.rounds))
@@ -0,0 +1,96 @@
+"""
+Cold start of a worker, each run in a fresh interpreter: importing app.main, the startup handlers, and the
+first request (GET /user/1, which has to open a database connection). The legacy runs emulate how workers
+used to boot: passlib and jwt imported up front, and create_all issued through both models' Base on startup
+instead of the schema version check.
+
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks import _env  # noqa: F401
+
+MODES = ("legacy", "current")
+
+
+def child(mode: str):
+    start = time.perf_counter()
+    if mode == "legacy":
+        import jwt  # noqa: F401
+        from passlib.context import CryptContext
+        CryptContext(schemes=[os.environ["CRYPT_SCHEME"]], deprecated="auto")
+    import httpx
+    from app import main, migrations
+    imported = time.perf_counter()
+
+    if mode == "legacy":
+        from app.database import Base, engine
+
+        async def create_all(_):
+            Base.metadata.create_all(bind=engine)
+            Base.metadata.create_all(bind=engine)
+
+        migrations.check = create_all
+
+    async def boot() -> tuple[float, float]:
+        async with main.app.router.lifespan_context(main.app):
+            started = time.perf_counter()
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as c:
+                (await c.get("/user/1")).raise_for_status()
+            return started, time.perf_counter()
+
+    started, answered = asyncio.run(boot())
+    print(json.dumps({"import": imported - start, "startup": started - imported, "first_request": answered - started}))
+
+
+def run_child(mode: str) -> dict[str, float]:
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child", mode], check=True,
+                            capture_output=True, text=True).stdout
+    timings = json.loads(output.splitlines()[-1])
+    # including the interpreter's own startup and shutdown
+    timings["process"] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    from sqlalchemy import insert
+
+    from app import models
+    from app.database import create_tables, engine
+
+    create_tables()
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"username": "startup", "hashed_password": "not-a-hash",
+                                            "is_active": True}])
+
+    samples = {mode: [] for mode in MODES}
+    # alternating, so the page cache and a noisy neighbour treat both alike
+    for _ in range(args.runs):
+        for mode in MODES:
+            samples[mode].append(run_child(mode))
+
+    print(f"median of {args.runs} runs, ms     import   startup   first request   whole process")
+    for mode, runs in samples.items():
+        medians = {key: statistics.median(run[key] for run in runs) * 1000 for key in runs[0]}
+        print(f"{mode:<24} {medians['import']:>9.1f} {medians['startup']:>9.1f} "
+              f"{medians['first_request']:>15.1f} {medians['process']:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
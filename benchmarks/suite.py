@@ -0,0 +1,65 @@
+"""
+Runs the micro-benchmarks and the load generator, writes the results as JSON and compares them with a baseline.
+Exits with status 1 when a result regressed by more than the tolerance, so it can gate CI.
+
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --output bench.json --baseline benchmarks/baseline.json --tolerance 0.15
+
+No baseline ships with the repository: the numbers only mean something next to a run on the same machine,
+database and python. Make one on the machine that will run the comparisons (the CI runner, say), from a commit
+known to be good, and keep it there or commit it for that runner:
+
+    git checkout <good commit> && python -m benchmarks.suite --output benchmarks/baseline.json
+
+The report records the machine, database and python it ran on, and the comparison points out any that differ.
+See benchmarks/results.py for the format.
+"""
+import os
+import argparse
+import sys
+
+from benchmarks import _env  # noqa: F401
+
+from app.config import HASH_POOL_MAX_PENDING
+from app.database import engine
+from benchmarks import load, micro, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="where to write this run's results")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression (default 0.1)")
+    parser.add_argument("--skip", choices=("micro", "load"), action="append", default=[])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--flows", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=HASH_POOL_MAX_PENDING)
+    args = parser.parse_args()
+    if args.baseline and not os.path.exists(args.baseline):
+        # before the run, not after minutes of benchmarks
+        parser.exit(2, f"No baseline at {args.baseline}. Create one on this machine from a known good commit with "
+                       f"`python -m benchmarks.suite --output {args.baseline}`, see the top of benchmarks/suite.py\n")
+
+    measured = {}
+    if "micro" not in args.skip:
+        measured |= micro.run()
+    if "load" not in args.skip:
+        measured |= load.run(args.users, args.flows, args.concurrency)
+
+    report = results.report(measured, engine.dialect.name)
+    for name, entry in measured.items():
+        print(f"{name:<40} {entry['value']:>12.2f} {entry['unit']}")
+    if args.output:
+        results.save(report, args.output)
+
+    if args.baseline:
+        baseline = results.load(args.baseline)
+        rows = results.compare(report, baseline, args.tolerance)
+        print()
+        results.print_comparison(rows, report, baseline)
+        if any(regressed for *_, regressed in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Renewing an access token through the full app: POST /session/auth with the password (a user lookup and a
+password verify in the hashing pool) against POST /session/refresh with the last refresh token (an indexed
+lookup, the rotation, and the JWT signature). Each client renews in a loop, carrying its refresh token forward.
+
+    python -m benchmarks.token_renewal --renewals 200 --concurrency 8
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks import _env  # noqa: F401
+
+import httpx
+from sqlalchemy import event, insert
+
+from app import models
+from app.config import pwd_context
+from app.database import async_engine, create_tables, engine
+from app.hashing import password_hasher
+from app.main import app
+from app.ratelimit import login_throttle
+
+PASSWORD = "password1"
+
+
+async def login(client: httpx.AsyncClient, username: str) -> str:
+    response = await client.post("/session/auth", data={"username": username, "password": PASSWORD})
+    return response.raise_for_status().json()["refresh_token"]
+
+
+async def renew_with_password(client: httpx.AsyncClient, username: str, renewals: int):
+    for _ in range(renewals):
+        await login(client, username)
+
+
+async def renew_with_refresh_token(client: httpx.AsyncClient, refresh_token: str, renewals: int):
+    for _ in range(renewals):
+        response = await client.post("/session/refresh", data={"refresh_token": refresh_token})
+        refresh_token = response.raise_for_status().json()["refresh_token"]
+
+
+async def run(name: str, renew, client: httpx.AsyncClient, credentials: list[str], renewals: int,
+              statements: list[int]):
+    statements[0] = 0
+    hashes = password_hasher.latency["verify"].count
+    start = time.perf_counter()
+    await asyncio.gather(*(renew(client, credential, renewals) for credential in credentials))
+    elapsed = time.perf_counter() - start
+    total = renewals * len(credentials)
+    hashes = password_hasher.latency["verify"].count - hashes
+    print(f"{name:<14} {total / elapsed:9.1f} renewals/s {elapsed / renewals * 1000:9.2f} ms/renewal "
+          f"{statements[0] / total:6.2f} statements {hashes / total:5.2f} hashes per renewal")
+
+
+async def main(renewals: int, concurrency: int):
+    create_tables()
+    hashed_password = pwd_context.hash(PASSWORD)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"username": f"user{i}", "hashed_password": hashed_password,
+                                            "is_active": True} for i in range(concurrency)])
+    statements = [0]
+
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def count_statement(*_):
+        statements[0] += 1
+
+    # renewals are not what the throttle is for, keep it out of the way
+    login_throttle.user_limit = login_throttle.ip_limit = (10 ** 9, 1e9)
+
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            print(f"{concurrency} clients x {renewals} renewals, {password_hasher.workers} hashing workers")
+            usernames = [f"user{i}" for i in range(concurrency)]
+            await run("password", renew_with_password, client, usernames, renewals, statements)
+            # each client logs in once, outside the measurement, then only renews with its latest refresh token
+            refresh_tokens = await asyncio.gather(*(login(client, username) for username in usernames))
+            await run("refresh token", renew_with_refresh_token, client, refresh_tokens, renewals, statements)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--renewals", type=int, default=200, help="renewals per client")
+    parser.add_argument("--concurrency", type=int, default=8, help="clients renewing at the same time")
+    args = parser.parse_args()
+    asyncio.run(main(args.renewals, args.concurrency))
@@ -0,0 +1,119 @@
+"""
+Throughput of `python -m app.cli serve` by worker count: for each count the launcher is started on a real
+socket, and GET /user/1 (a database read and a serialization) is driven from separate client processes for a
+fixed time. Reports requests per second and the speedup over one worker.
+
+    python -m benchmarks.workers --workers 1 2 4 --seconds 10 --clients 4
+
+The clients need cores of their own, otherwise they compete with the workers and hide the scaling: run on a
+machine with at least workers + clients cores, or keep the client count low.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from benchmarks import _env  # noqa: F401
+
+import httpx
+from sqlalchemy import insert
+
+from app import models
+from app.database import create_tables, engine
+
+
+def seed():
+    create_tables()
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"username": "workers", "email": "workers@example.com",
+                                            "hashed_password": "not-a-hash", "is_active": True}])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url).raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def drive(url: str, seconds: float, concurrency: int) -> tuple[int, int]:
+    completed = failed = 0
+    deadline = time.monotonic() + seconds
+
+    async def one(client: httpx.AsyncClient):
+        nonlocal completed, failed
+        while time.monotonic() < deadline:
+            try:
+                response = await client.get("/user/1")
+                if response.is_success:
+                    completed += 1
+                else:
+                    failed += 1
+            except httpx.HTTPError:
+                failed += 1
+
+    async with httpx.AsyncClient(base_url=url, limits=httpx.Limits(max_connections=concurrency)) as client:
+        await asyncio.gather(*(one(client) for _ in range(concurrency)))
+    return completed, failed
+
+
+def client_process(url: str, seconds: float, concurrency: int, results):
+    results.put(asyncio.run(drive(url, seconds, concurrency)))
+
+
+def measure(workers: int, clients: int, seconds: float, concurrency: int) -> tuple[float, int]:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen([sys.executable, "-m", "app.cli", "serve", "--workers", str(workers),
+                               "--port", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(f"{url}/user/1")
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [context.Process(target=client_process, args=(url, seconds, concurrency, results))
+                     for _ in range(clients)]
+        for process in processes:
+            process.start()
+        totals = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return sum(completed for completed, _ in totals) / seconds, sum(failed for _, failed in totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help="load generating processes")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight per client process")
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    seed()
+    print(f"{os.cpu_count()} cores, {args.clients} client processes x {args.concurrency} connections")
+    baseline = None
+    for workers in args.workers:
+        throughput, failed = measure(workers, args.clients, args.seconds, args.concurrency)
+        baseline = baseline or throughput
+        print(f"{workers:>3} workers: {throughput:9.1f} requests/s ({throughput / baseline:.2f}x), {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
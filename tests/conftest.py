@@ -0,0 +1,109 @@
+"""
+Points the app at throwaway sqlite files before anything from `app` is imported: a primary, and a read replica
+that every test starts as a copy of the primary and that is never written to afterwards, so it goes stale the
+way a lagging replica does.
+
+    python -m pytest
+"""
+import os
+import shutil
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix="fast-backend-tests-")
+PRIMARY_DB = os.path.join(TEST_DIR, "primary.db")
+REPLICA_DB = os.path.join(TEST_DIR, "replica.db")
+
+os.environ.update({
+    "DB_URL": f"sqlite:///{PRIMARY_DB}",
+    "ASYNC_DB_URL": f"sqlite+aiosqlite:///{PRIMARY_DB}",
+    "ASYNC_REPLICA_DB_URL": f"sqlite+aiosqlite:///{REPLICA_DB}",
+    "SECRET_KEY": "test-secret-at-least-32-bytes-long",
+    "HASH_ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "15",
+    # the cheapest cost bcrypt takes, the tests are about everything around the hash
+    "PASSWORD_HASH_PROFILE": "bcrypt:rounds=4",
+    "HASH_POOL_WORKERS": "1",
+    "HASH_POOL_MAX_PENDING": "64",
+    "SESSION_CACHE_BACKEND": "memory",
+    "SESSION_REAPER_INTERVAL": "0",
+    "MIGRATE_ON_STARTUP": "true",
+    "RATE_LIMIT_IP_BURST": "100000",
+    "RATE_LIMIT_USER_BURST": "100000",
+})
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+from app import database  # noqa: E402
+from app.cache import session_cache, token_cache, user_cache  # noqa: E402
+from app.main import app  # noqa: E402
+
+PASSWORD = "password1"
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+async def app_lifespan(anyio_backend):
+    # started once: the hashing pool's worker processes take a while to spawn
+    async with app.router.lifespan_context(app):
+        yield app
+
+
+async def reset_databases():
+    """
+    Start from an empty, migrated primary and a replica that is a copy of it
+    """
+    await database.async_engine.dispose()
+    database.engine.dispose()
+    for path in (PRIMARY_DB, REPLICA_DB):
+        if os.path.exists(path):
+            os.remove(path)
+    database.create_tables()
+    await sync_replica()
+
+
+async def sync_replica():
+    """
+    Let the replica catch up with the primary
+    """
+    await database.replica_engine.dispose()
+    database.engine.dispose()
+    shutil.copyfile(PRIMARY_DB, REPLICA_DB)
+
+
+@pytest.fixture
+async def client(app_lifespan):
+    await reset_databases()
+    session_cache.local.clear()
+    if session_cache.backend is not None:
+        session_cache.backend._data.clear()
+    token_cache.local.clear()
+    for lru in (user_cache.by_id, user_cache.ids_by_username, user_cache.versions):
+        lru.clear()
+    database._recent_writers.clear()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as test_client:
+        yield test_client
+
+
+async def signup(client: httpx.AsyncClient, username: str, email: str | None = None) -> dict:
+    response = await client.post("/user/", json={"username": username, "email": email or f"{username}@example.com",
+                                                 "password": PASSWORD})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def login(client: httpx.AsyncClient, username: str, password: str = PASSWORD) -> httpx.Response:
+    """
+    Start a session, the client keeps its cookie
+    """
+    return await client.post("/session/login", data={"username": username, "password": password})
+
+
+async def auth_token(client: httpx.AsyncClient, username: str, password: str = PASSWORD) -> str:
+    response = await client.post("/session/auth", data={"username": username, "password": password})
+    assert response.status_code == 200, response.text
+    return response.json()["access_token"]
@@ -0,0 +1,110 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import schemas
+from app.cache import InMemoryBackend, SessionCache, session_cache
+from app.session_store import hash_token
+from tests.conftest import auth_token, login, signup
+
+pytestmark = pytest.mark.anyio
+
+TOKEN_HASH = hash_token("a-session-token")
+USER = schemas.User(id=1, username="alice", email="alice@example.com", display_name="alice", is_active=True)
+
+
+def in_an_hour() -> datetime:
+    return datetime.utcnow() + timedelta(hours=1)
+
+
+async def test_shared_backend_serves_other_processes():
+    backend = InMemoryBackend()
+    await SessionCache(10, 30, backend).set(TOKEN_HASH, USER, in_an_hour())
+
+    # a second process: nothing local, the shared copy is found and kept locally from then on
+    other = SessionCache(10, 30, backend)
+    assert (await other.get(TOKEN_HASH)).user == USER
+    assert (await other.get(TOKEN_HASH)).user == USER
+    assert (other.hits_shared, other.hits_local, other.misses) == (1, 1, 0)
+
+
+async def test_invalidate_drops_local_and_shared_copies():
+    backend = InMemoryBackend()
+    cache, other = SessionCache(10, 30, backend), SessionCache(10, 30, backend)
+    await cache.set(TOKEN_HASH, USER, in_an_hour())
+    await other.get(TOKEN_HASH)
+
+    await cache.invalidate(TOKEN_HASH)
+    assert await cache.get(TOKEN_HASH) is None
+    assert await backend.get(cache._key(TOKEN_HASH)) is None
+    # the other process still has its local copy, until local_ttl runs out
+    assert await other.get(TOKEN_HASH) is not None
+
+
+async def test_local_copies_are_capped_at_local_ttl():
+    backend = InMemoryBackend()
+    cache = SessionCache(10, 0.05, backend)
+    await cache.set(TOKEN_HASH, USER, in_an_hour())
+    await backend.delete(cache._key(TOKEN_HASH))
+    assert await cache.get(TOKEN_HASH) is not None
+
+    # the session lasts another hour, the local copy does not
+    await asyncio.sleep(0.1)
+    assert await cache.get(TOKEN_HASH) is None
+
+
+async def test_local_copy_of_a_shared_entry_is_capped_at_local_ttl():
+    backend = InMemoryBackend()
+    await SessionCache(10, 30, backend).set(TOKEN_HASH, USER, in_an_hour())
+    cache = SessionCache(10, 0.05, backend)
+    await cache.get(TOKEN_HASH)
+
+    await asyncio.sleep(0.1)
+    await cache.get(TOKEN_HASH)
+    assert (cache.hits_shared, cache.hits_local) == (2, 0)
+
+
+async def test_no_local_copies_without_local_ttl():
+    # two forked workers: a logout on one is seen by the other on its next lookup
+    backend = InMemoryBackend()
+    cache, other = SessionCache(10, 0, backend), SessionCache(10, 0, backend)
+    await cache.set(TOKEN_HASH, USER, in_an_hour())
+    assert (await other.get(TOKEN_HASH)).user == USER
+
+    await cache.invalidate(TOKEN_HASH)
+    assert await other.get(TOKEN_HASH) is None
+    assert (len(cache.local), len(other.local)) == (0, 0)
+
+
+async def test_session_expiry_caps_local_ttl():
+    cache = SessionCache(10, 30)
+    await cache.set(TOKEN_HASH, USER, datetime.utcnow() + timedelta(seconds=0.05))
+    await asyncio.sleep(0.1)
+    assert await cache.get(TOKEN_HASH) is None
+
+
+async def test_logout_invalidates_cached_session(client):
+    await signup(client, "alice")
+    await login(client, "alice")
+    token = client.cookies["session_id"]
+    assert (await client.get("/user/me")).status_code == 200
+    assert await session_cache.get(hash_token(token)) is not None
+
+    assert (await client.post("/session/logout")).status_code == 200
+    assert await session_cache.get(hash_token(token)) is None
+    assert await session_cache.backend.get(session_cache._key(hash_token(token))) is None
+    response = await client.get("/user/me", cookies={"session_id": token})
+    assert response.status_code == 401
+
+
+async def test_user_update_invalidates_cached_session(client):
+    await signup(client, "alice")
+    await login(client, "alice")
+    access_token = await auth_token(client, "alice")
+    assert (await client.get("/user/me")).json()["display_name"] == "alice"
+
+    response = await client.put("/user/me", json={"new_display_name": "Alice A."},
+                                headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200, response.text
+    assert (await client.get("/user/me")).json()["display_name"] == "Alice A."
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app import hashing
+from app.config import pwd_context
+from app.hashing import PasswordHasher
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def hasher():
+    # threads instead of spawned processes: the same code path, without the pool's start up time
+    hasher = PasswordHasher(workers=4, max_pending=1, max_batch_chunks=2)
+    hasher._executor = ThreadPoolExecutor(4)
+    yield hasher
+    hasher.shutdown()
+
+
+async def test_hash_many_keeps_to_its_own_capacity(hasher, monkeypatch):
+    in_flight, peak, lock = 0, 0, threading.Lock()
+    hash_chunk = hashing._hash_many
+
+    def counting_hash_many(passwords):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        try:
+            return hash_chunk(passwords)
+        finally:
+            with lock:
+                in_flight -= 1
+
+    monkeypatch.setattr(hashing, "_hash_many", counting_hash_many)
+    passwords = [f"password{index}" for index in range(20)]
+    # two imports at once still share the two chunk slots
+    first, second = await asyncio.gather(hasher.hash_many(passwords, chunk_size=2),
+                                         hasher.hash_many(passwords[:6], chunk_size=2))
+
+    assert peak == 2
+    assert all(pwd_context.verify(password, hash_) for password, hash_ in zip(passwords, first))
+    assert all(pwd_context.verify(password, hash_) for password, hash_ in zip(passwords, second))
+    assert (hasher.pending, hasher.batch_pending) == (0, 0)
+
+
+async def test_hash_many_leaves_room_for_logins(hasher):
+    batch = asyncio.create_task(hasher.hash_many([f"password{index}" for index in range(16)], chunk_size=2))
+    while not hasher.batch_pending:
+        await asyncio.sleep(0)
+
+    # max_pending is 1, the import's chunks don't count against it
+    assert pwd_context.verify("password1", await hasher.hash("password1"))
+    assert hasher.rejected == 0
+    assert len(await batch) == 16
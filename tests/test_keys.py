@@ -0,0 +1,101 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import jwt
+import pytest
+
+from app.keys import KeyRing, _unverified_kid, generate_key
+
+ACTIVATION = 600
+
+
+def add_key(directory: Path, age: float) -> str:
+    """
+    A new ES256 key made `age` seconds ago, going by its kid
+    :return:    The kid
+    """
+    kid = generate_key("ES256", str(directory))
+    aged_kid = f"{int(time.time() - age)}-{kid.partition('-')[2]}"
+    os.rename(directory / f"{kid}.pem", directory / f"{aged_kid}.pem")
+    return aged_kid
+
+
+def ring(directory: Path) -> KeyRing:
+    # reload_seconds=0: every call sees the directory as it is
+    return KeyRing("ES256", None, str(directory), activation_seconds=ACTIVATION, reload_seconds=0)
+
+
+def claims() -> dict:
+    return {"sub": "alice", "exp": int(time.time()) + 60}
+
+
+def test_tokens_carry_the_signing_kid(tmp_path):
+    kid = add_key(tmp_path, 10000)
+    key_ring = ring(tmp_path)
+
+    token = key_ring.sign(claims())
+    assert jwt.get_unverified_header(token)["kid"] == _unverified_kid(token) == kid
+    assert key_ring.verify(token)["sub"] == "alice"
+
+
+def test_symmetric_tokens_have_no_kid_and_nothing_is_published():
+    key_ring = KeyRing("HS256", "test-secret-at-least-32-bytes-long", None, ACTIVATION, 0)
+    token = key_ring.sign(claims())
+    assert "kid" not in jwt.get_unverified_header(token)
+    assert key_ring.verify(token)["sub"] == "alice"
+    assert json.loads(key_ring.jwks()) == {"keys": []}
+
+
+def test_rotation_keeps_verifying_the_previous_key(tmp_path):
+    old_kid = add_key(tmp_path, 10000)
+    key_ring = ring(tmp_path)
+    old_token = key_ring.sign(claims())
+
+    # published, but too new to sign
+    pending_kid = add_key(tmp_path, 10)
+    assert key_ring.signing_key().kid == old_kid
+    assert pending_kid in {key["kid"] for key in json.loads(key_ring.jwks())["keys"]}
+
+    new_kid = add_key(tmp_path, ACTIVATION + 10)
+    new_token = key_ring.sign(claims())
+    assert _unverified_kid(new_token) == new_kid
+    assert key_ring.verify(old_token)["sub"] == key_ring.verify(new_token)["sub"] == "alice"
+
+
+def test_jwks_lets_others_verify(tmp_path):
+    kids = [add_key(tmp_path, 10000), add_key(tmp_path, 5000)]
+    key_ring = ring(tmp_path)
+    jwks = json.loads(key_ring.jwks())
+
+    assert [key["kid"] for key in jwks["keys"]] == kids
+    for jwk in jwks["keys"]:
+        assert (jwk["kty"], jwk["alg"], jwk["use"]) == ("EC", "ES256", "sig")
+        # the public half only
+        assert "d" not in jwk
+
+    token = key_ring.sign(claims())
+    public_key = jwt.PyJWK(next(jwk for jwk in jwks["keys"] if jwk["kid"] == _unverified_kid(token))).key
+    assert jwt.decode(token, public_key, algorithms=["ES256"])["sub"] == "alice"
+
+
+def test_retired_keys_are_pruned_once_their_tokens_expired(tmp_path):
+    old_kid = add_key(tmp_path, 100000)
+    key_ring = ring(tmp_path)
+    old_token = key_ring.sign(claims())
+
+    # the new key signs, but the old key's last tokens may still be live
+    add_key(tmp_path, ACTIVATION + 10)
+    assert key_ring.retired() == []
+
+    # past activation and a whole token lifetime
+    for path in tmp_path.glob("*.pem"):
+        if path.stem != old_kid:
+            path.unlink()
+    add_key(tmp_path, 5000)
+    assert [key.kid for key in key_ring.retired()] == [old_kid]
+
+    (tmp_path / f"{old_kid}.pem").unlink()
+    with pytest.raises(jwt.InvalidKeyError):
+        key_ring.verify(old_token)
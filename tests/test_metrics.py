@@ -0,0 +1,30 @@
+import httpx
+import pytest
+
+from app import dependencies
+from app.main import app
+
+pytestmark = pytest.mark.anyio
+
+
+def client_from(host: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=(host, 40000)), base_url="http://test")
+
+
+@pytest.mark.parametrize("path", ["/metrics", "/metrics/pool", "/metrics/session-cache"])
+async def test_metrics_only_served_locally_without_a_token(client, path):
+    assert (await client.get(path)).status_code == 200
+    async with client_from("203.0.113.7") as remote:
+        assert (await remote.get(path)).status_code == 403
+
+
+async def test_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(dependencies, "METRICS_TOKEN", "scrape-me")
+    async with client_from("203.0.113.7") as remote:
+        assert (await remote.get("/metrics")).status_code == 403
+        assert (await remote.get("/metrics", headers={"Authorization": "Bearer wrong"})).status_code == 403
+        response = await remote.get("/metrics", headers={"Authorization": "Bearer scrape-me"})
+        assert response.status_code == 200
+        assert 'http_responses_total{method="GET",route="/metrics",status="403"}' in response.text
+    # with a token set, being local is not enough
+    assert (await client.get("/metrics")).status_code == 403
@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import database
+from app.cli import import_users
+from app.migrations import LATEST_VERSION, migrate, read_version
+
+# the tables as create_all made them before schema migrations, version 1
+VERSION_1 = [
+    "CREATE TABLE users (id INTEGER PRIMARY KEY, email VARCHAR(255), username VARCHAR(255), "
+    "display_name VARCHAR(255), is_active BOOLEAN, hashed_password VARCHAR(255))",
+    "CREATE UNIQUE INDEX ix_users_email ON users (email)",
+    "CREATE UNIQUE INDEX ix_users_username ON users (username)",
+    "CREATE TABLE user_sessions (session_id INTEGER PRIMARY KEY, created_at DATETIME NOT NULL, "
+    "expires_at DATETIME NOT NULL, user_id INTEGER REFERENCES users (id))",
+    "INSERT INTO users (id, username, email, display_name, is_active, hashed_password) "
+    "VALUES (1, 'alice', 'alice@example.com', 'alice', 1, 'x')",
+]
+
+
+@pytest.mark.parametrize("version_added_by_hand", [False, True])
+def test_migrate_from_version_1(tmp_path, version_added_by_hand):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        for statement in VERSION_1:
+            conn.execute(text(statement))
+        if version_added_by_hand:
+            # what the ETag change asked for before users.version had a migration
+            conn.execute(text("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+    assert migrate(engine) == (None, LATEST_VERSION)
+    with engine.connect() as conn:
+        assert read_version(conn) == LATEST_VERSION
+        assert conn.execute(text("SELECT username, version FROM users")).all() == [("alice", 1)]
+        assert inspect(conn).has_table("refresh_tokens")
+
+
+@pytest.mark.anyio
+async def test_import_leaves_migrating_to_migrate(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "async_engine", create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'new.db'}"))
+
+    with pytest.raises(SystemExit, match="fast-backend migrate"):
+        await import_users([{"username": "alice", "password": "password1"}], 10, 10)
+    assert inspect(create_engine(f"sqlite:///{tmp_path / 'new.db'}")).get_table_names() == []
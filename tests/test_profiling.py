@@ -0,0 +1,27 @@
+import os
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from app.instrumentation import ProfilingMiddleware
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_every_profiled_request_gets_its_own_file(tmp_path):
+    profiled = FastAPI()
+
+    @profiled.get("/item/{item_id}")
+    async def read_item(item_id: int):
+        return {"id": item_id}
+
+    middleware = ProfilingMiddleware(profiled, directory=str(tmp_path))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=middleware), base_url="http://test") as client:
+        # well within a second, same route
+        for item_id in range(5):
+            assert (await client.get(f"/item/{item_id}", headers={"X-Profile": "1"})).status_code == 200
+
+    files = os.listdir(tmp_path)
+    assert len(files) == 5
+    assert all("-GET-_item_item_id-" in name and name.endswith(".prof") for name in files)
@@ -0,0 +1,64 @@
+import httpx
+import pytest
+from fastapi import FastAPI
+from sqlalchemy import text
+
+from app.database import AsyncSessionLocal
+from app.instrumentation import QueryBudgetExceeded, QueryBudgetMiddleware
+from app.main import app
+from tests.conftest import PASSWORD, signup
+
+pytestmark = pytest.mark.anyio
+
+
+def budgeted(asgi_app, budget: int) -> httpx.AsyncClient:
+    """
+    A client whose every request fails with QueryBudgetExceeded at the query past `budget`
+    """
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=QueryBudgetMiddleware(asgi_app, budget, "raise")),
+                             base_url="http://test")
+
+
+async def test_route_over_budget_raises(client):
+    chatty = FastAPI()
+
+    @chatty.get("/chatty")
+    async def run_queries(queries: int):
+        async with AsyncSessionLocal() as db:
+            for _ in range(queries):
+                await db.execute(text("SELECT 1"))
+        return {}
+
+    async with budgeted(chatty, 2) as over_budget:
+        assert (await over_budget.get("/chatty", params={"queries": 2})).status_code == 200
+        with pytest.raises(QueryBudgetExceeded):
+            await over_budget.get("/chatty", params={"queries": 3})
+
+
+async def test_login_within_budget(client):
+    # the user lookup, then the session insert and the trim of the user's oldest sessions
+    await signup(client, "alice")
+    async with budgeted(app, 3) as login_client:
+        response = await login_client.post("/session/login", data={"username": "alice", "password": PASSWORD})
+        assert response.status_code == 200
+
+
+async def test_token_login_within_budget(client):
+    # the user lookup and the refresh token insert
+    await signup(client, "alice")
+    async with budgeted(app, 2) as auth_client:
+        response = await auth_client.post("/session/auth", data={"username": "alice", "password": PASSWORD})
+        assert response.status_code == 200
+
+
+async def test_me_within_budget(client):
+    await signup(client, "alice")
+    await client.post("/session/login", data={"username": "alice", "password": PASSWORD})
+    cookies = {"session_id": client.cookies["session_id"]}
+
+    # the session, then its user
+    async with budgeted(app, 2) as me_client:
+        assert (await me_client.get("/user/me", cookies=cookies)).status_code == 200
+    # after that, from the session cache
+    async with budgeted(app, 0) as me_client:
+        assert (await me_client.get("/user/me", cookies=cookies)).status_code == 200
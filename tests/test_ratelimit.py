@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from app import dependencies, ratelimit
+from app.errors import TooManyRequestsError
+from app.hashing import password_hasher
+from app.instrumentation import QueryBudgetMiddleware
+from app.main import app
+from app.ratelimit import InMemoryRateLimitBackend, LoginThrottle
+from tests.conftest import PASSWORD, signup
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    The time the throttle sees, moved forward by hand
+    """
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(ratelimit, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def throttle(ip_burst: int = 100, user_burst: int = 100) -> LoginThrottle:
+    # buckets refill a token a second, lockouts start at the third failure
+    return LoginThrottle(InMemoryRateLimitBackend(100), ip_per_minute=60, ip_burst=ip_burst, user_per_minute=60,
+                         user_burst=user_burst, lockout_threshold=3, lockout_base=30, lockout_max=100,
+                         lockout_window=3600)
+
+
+async def test_ip_bucket_refills(clock):
+    login_throttle = throttle(ip_burst=2)
+    await login_throttle.check("10.0.0.1", "alice")
+    await login_throttle.check("10.0.0.1", "bob")
+    with pytest.raises(TooManyRequestsError) as rejected:
+        await login_throttle.check("10.0.0.1", "carol")
+    assert rejected.value.headers == {"Retry-After": "1"}
+    # other addresses have buckets of their own
+    await login_throttle.check("10.0.0.2", "carol")
+
+    clock.now += 1
+    await login_throttle.check("10.0.0.1", "carol")
+    with pytest.raises(TooManyRequestsError):
+        await login_throttle.check("10.0.0.1", "carol")
+    assert login_throttle.rejected["ip"] == 2
+
+
+async def test_user_bucket_spans_addresses(clock):
+    login_throttle = throttle(user_burst=1)
+    await login_throttle.check("10.0.0.1", "alice")
+    with pytest.raises(TooManyRequestsError):
+        await login_throttle.check("10.0.0.2", "alice")
+    assert login_throttle.rejected["username"] == 1
+
+
+async def test_lockout_after_repeated_failures(clock):
+    login_throttle = throttle()
+    for _ in range(2):
+        await login_throttle.failed("alice")
+    await login_throttle.check("10.0.0.1", "alice")
+
+    await login_throttle.failed("alice")
+    with pytest.raises(TooManyRequestsError) as rejected:
+        await login_throttle.check("10.0.0.1", "alice")
+    assert rejected.value.headers == {"Retry-After": "30"}
+    # only the account is locked
+    await login_throttle.check("10.0.0.1", "bob")
+
+    clock.now += 30
+    await login_throttle.check("10.0.0.1", "alice")
+    assert (login_throttle.lockouts, login_throttle.rejected["lockout"]) == (1, 1)
+
+
+async def test_lockouts_double_up_to_the_max(clock):
+    login_throttle = throttle()
+    lockouts = []
+    for _ in range(6):
+        await login_throttle.failed("alice")
+        lockouts.append(await login_throttle.backend.locked_for("lockout:alice"))
+    assert lockouts == [0, 0, 30, 60, 100, 100]
+
+
+async def test_success_forgets_failures(clock):
+    login_throttle = throttle()
+    for _ in range(3):
+        await login_throttle.failed("alice")
+    await login_throttle.succeeded("alice")
+    await login_throttle.failed("alice")
+    assert await login_throttle.backend.locked_for("lockout:alice") == 0
+
+
+async def test_rejected_before_database_or_hashing(client, monkeypatch):
+    await signup(client, "alice")
+    monkeypatch.setattr(dependencies, "login_throttle", throttle(ip_burst=1))
+    assert (await client.post("/session/auth", data={"username": "alice", "password": PASSWORD})).status_code == 200
+
+    verified = password_hasher.latency["verify"].count
+    # a budget of no queries: any database work would fail the request
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=QueryBudgetMiddleware(app, 0, "raise")),
+                                 base_url="http://test") as throttled:
+        response = await throttled.post("/session/auth", data={"username": "alice", "password": PASSWORD})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert password_hasher.latency["verify"].count == verified
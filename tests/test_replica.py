@@ -0,0 +1,102 @@
+import pytest
+from sqlalchemy import event, update
+
+from app import database, models
+from app.cache import user_cache
+from app.config import pwd_context
+from tests.conftest import PASSWORD, auth_token, login, signup, sync_replica
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def replica_statements():
+    """
+    The statements the read replica runs during the test
+    """
+    statements = []
+
+    def record(conn, cursor, statement, *_):
+        statements.append(statement)
+
+    event.listen(database.replica_engine.sync_engine, "before_cursor_execute", record)
+    yield statements
+    event.remove(database.replica_engine.sync_engine, "before_cursor_execute", record)
+
+
+def write_to_primary_only(client, user_id: int, **values):
+    """
+    Change a user on the primary without the replica catching up, and forget who wrote recently, so the next
+    request is from a client the stickiness doesn't cover
+    """
+    with database.engine.begin() as conn:
+        conn.execute(update(models.User).filter(models.User.id == user_id)
+                     .values(version=models.User.version + 1, **values))
+    database._recent_writers.clear()
+    client.cookies.delete(database.REPLICA_STICKY_COOKIE)
+    user_cache.invalidate(user_id)
+
+
+async def test_display_reads_use_the_replica(client, replica_statements):
+    user = await signup(client, "alice")
+    await sync_replica()
+    write_to_primary_only(client, user["id"], display_name="renamed")
+
+    response = await client.get(f"/user/{user['id']}")
+    assert response.json()["display_name"] == "alice"
+    assert replica_statements
+
+
+async def test_login_reads_the_primary(client, replica_statements):
+    user = await signup(client, "alice")
+    await sync_replica()
+    write_to_primary_only(client, user["id"], hashed_password=pwd_context.hash("new-password"))
+
+    response = await client.post("/session/auth", data={"username": "alice", "password": PASSWORD})
+    assert response.status_code == 401
+    response = await client.post("/session/auth", data={"username": "alice", "password": "new-password"})
+    assert response.status_code == 200
+    response = await client.post("/session/refresh", data={"refresh_token": response.json()["refresh_token"]})
+    assert response.status_code == 200
+    assert (await login(client, "alice", "new-password")).status_code == 200
+    assert (await client.get("/user/me")).status_code == 200
+    assert replica_statements == []
+
+
+async def test_update_reads_the_primary(client, replica_statements):
+    user = await signup(client, "alice")
+    await login(client, "alice")
+    access_token = await auth_token(client, "alice")
+    await sync_replica()
+    write_to_primary_only(client, user["id"], email="alice@primary.example.com")
+
+    response = await client.put("/user/me", json={"new_display_name": "Alice A."},
+                                headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200, response.text
+    assert response.json()["email"] == "alice@primary.example.com"
+    assert response.json()["version"] == 3
+    assert replica_statements == []
+
+
+async def test_writes_keep_the_client_on_the_primary_across_workers(client, replica_statements):
+    await signup(client, "alice")
+    await login(client, "alice")
+    assert database.sticky_cookie_active(client.cookies[database.REPLICA_STICKY_COOKIE])
+    await sync_replica()
+    access_token = await auth_token(client, "alice")
+    response = await client.put("/user/me", json={"new_display_name": "Alice A."},
+                                headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200, response.text
+
+    # another worker, which never saw the write: the cookie alone keeps the read on the primary
+    database._recent_writers.clear()
+    user_cache.invalidate(response.json()["id"])
+    response = await client.get(f"/user/{response.json()['id']}")
+    assert response.json()["display_name"] == "Alice A."
+    assert replica_statements == []
+
+    # once it runs out, reads go back to the replica
+    client.cookies.set(database.REPLICA_STICKY_COOKIE, "0", domain="test.local")
+    assert not database.sticky_cookie_active(client.cookies[database.REPLICA_STICKY_COOKIE])
+    await client.get(f"/user/{response.json()['id']}")
+    assert replica_statements
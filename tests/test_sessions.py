@@ -0,0 +1,112 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, update
+
+from app import models, tasks
+from app.cache import session_cache
+from app.database import AsyncSessionLocal
+from app.session_store import InMemorySessionStore, hash_token
+from app.tasks import SessionRefresher, session_refresher
+from tests.conftest import login, signup
+
+pytestmark = pytest.mark.anyio
+
+LIFETIME = 100
+
+
+@pytest.fixture
+async def store(monkeypatch):
+    store = InMemorySessionStore()
+    monkeypatch.setattr(tasks, "session_store", store)
+    return store
+
+
+async def start_session(store: InMemorySessionStore, token: str, expires_in: float) -> bytes:
+    token_hash = hash_token(token)
+    await store.create(1, token_hash, expires_in, max_sessions=10)
+    return token_hash
+
+
+def expires_in(seconds: float) -> datetime:
+    return datetime.utcnow() + timedelta(seconds=seconds)
+
+
+def close_to(when: datetime, seconds: float) -> bool:
+    return abs((when - expires_in(seconds)).total_seconds()) < 5
+
+
+async def test_only_due_sessions_are_extended(store):
+    refresher = SessionRefresher(LIFETIME, refresh_after=0.5, interval=60, max_pending=10)
+    fresh = await start_session(store, "fresh", 90)
+    due = await start_session(store, "due", 40)
+
+    assert refresher.refresh(fresh, expires_in(90)) is None
+    assert close_to(refresher.refresh(due, expires_in(40)), LIFETIME)
+    # used again before the flush: still one entry, one row
+    refresher.refresh(due, expires_in(40))
+    assert refresher.pending == 1
+
+    assert await refresher.flush() == 1
+    assert close_to((await store.get(due)).expires_at, LIFETIME)
+    assert close_to((await store.get(fresh)).expires_at, 90)
+
+
+async def test_flushed_every_interval(store):
+    refresher = SessionRefresher(LIFETIME, refresh_after=0.5, interval=0.05, max_pending=10)
+    due = await start_session(store, "due", 40)
+    refresher.start()
+    try:
+        refresher.refresh(due, expires_in(40))
+        await asyncio.sleep(0.2)
+        assert (refresher.pending, refresher.flushed) == (0, 1)
+        assert close_to((await store.get(due)).expires_at, LIFETIME)
+    finally:
+        await refresher.stop()
+
+
+async def test_flushed_on_stop(store):
+    refresher = SessionRefresher(LIFETIME, refresh_after=0.5, interval=60, max_pending=10)
+    due = await start_session(store, "due", 40)
+    refresher.start()
+    refresher.refresh(due, expires_in(40))
+
+    await refresher.stop()
+    assert close_to((await store.get(due)).expires_at, LIFETIME)
+
+
+async def test_full_buffer_drops_new_sessions(store):
+    refresher = SessionRefresher(LIFETIME, refresh_after=0.5, interval=60, max_pending=2)
+    first, second, third = [await start_session(store, token, 40) for token in ("first", "second", "third")]
+    refresher.refresh(first, expires_in(40))
+    refresher.refresh(second, expires_in(40))
+
+    # left as it is, its next request tries again
+    assert refresher.refresh(third, expires_in(40)) is None
+    assert (refresher.pending, refresher.dropped) == (2, 1)
+    # a session already in the buffer is still taken
+    assert refresher.refresh(first, expires_in(40)) is not None
+
+    await refresher.flush()
+    assert close_to((await store.get(third)).expires_at, 40)
+    assert refresher.refresh(third, expires_in(40)) is not None
+
+
+async def test_active_session_is_pushed_back(client):
+    await signup(client, "alice")
+    await login(client, "alice")
+    token_hash = hash_token(client.cookies["session_id"])
+    # most of the session's lifetime has gone by
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(models.UserSession).filter(models.UserSession.token_hash == token_hash)
+                         .values(expires_at=expires_in(session_refresher.lifetime * 0.1)))
+        await db.commit()
+    await session_cache.invalidate(token_hash)
+
+    assert (await client.get("/user/me")).status_code == 200
+    await session_refresher.flush()
+    async with AsyncSessionLocal() as db:
+        expires_at = await db.scalar(select(models.UserSession.expires_at)
+                                     .filter(models.UserSession.token_hash == token_hash))
+    assert close_to(expires_at, session_refresher.lifetime)
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from app import crud, schemas, services
+from app.database import AsyncSessionLocal
+from app.errors import UserCreationError
+
+pytestmark = pytest.mark.anyio
+
+ATTEMPTS = 6
+
+
+async def signup(user: schemas.UserCreate):
+    async with AsyncSessionLocal() as db:
+        return await services.user.create_user(user, db)
+
+
+@pytest.mark.parametrize("field", ["username", "email"])
+async def test_concurrent_duplicate_signups(client, field):
+    # every attempt shares `field` and differs in the other one
+    users = [schemas.UserCreate(username="alice" if field == "username" else f"alice{i}",
+                                email="alice@example.com" if field == "email" else f"alice{i}@example.com",
+                                password="password1") for i in range(ATTEMPTS)]
+
+    results = await asyncio.gather(*(signup(user) for user in users), return_exceptions=True)
+
+    created = [result for result in results if not isinstance(result, Exception)]
+    rejected = [result for result in results if isinstance(result, Exception)]
+    assert len(created) == 1
+    assert len(rejected) == ATTEMPTS - 1
+    for error in rejected:
+        assert isinstance(error, UserCreationError)
+        assert isinstance(error.__cause__, IntegrityError)
+        assert crud.user.duplicate_field(error.__cause__) == field
+        assert error.detail == f"Could not create user: {field.capitalize()} already registered"
+
+
+@pytest.mark.parametrize("message, field", [
+    ("UNIQUE constraint failed: users.email", "email"),
+    ("UNIQUE constraint failed: users.username", "username"),
+    # mysql 8 names the key after its table, 5.7 does not, and the duplicated value comes first
+    ("(1062, \"Duplicate entry 'alice@example.com' for key 'users.ix_users_email'\")", "email"),
+    ("(1062, \"Duplicate entry 'alice' for key 'users.ix_users_username'\")", "username"),
+    ("(1062, \"Duplicate entry 'alice' for key 'ix_users_username'\")", "username"),
+    ("(1062, \"Duplicate entry 'users.email' for key 'users.ix_users_username'\")", "username"),
+    ('duplicate key value violates unique constraint "ix_users_email"\n'
+     'DETAIL:  Key (email)=(alice@example.com) already exists.', "email"),
+    ("FOREIGN KEY constraint failed", None),
+])
+def test_duplicate_field(message, field):
+    assert crud.user.duplicate_field(IntegrityError("INSERT INTO users ...", {}, Exception(message))) == field
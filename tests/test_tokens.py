@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+
+from app import models
+from app.database import AsyncSessionLocal
+from tests.conftest import PASSWORD, signup
+
+pytestmark = pytest.mark.anyio
+
+
+async def token_login(client) -> dict:
+    response = await client.post("/session/auth", data={"username": "alice", "password": PASSWORD})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def exchange(client, refresh_token: str):
+    return await client.post("/session/refresh", data={"refresh_token": refresh_token})
+
+
+async def count_refresh_tokens() -> int:
+    async with AsyncSessionLocal() as db:
+        return await db.scalar(select(func.count()).select_from(models.RefreshToken))
+
+
+async def test_refresh_token_works_once(client):
+    await signup(client, "alice")
+    tokens = await token_login(client)
+
+    response = await exchange(client, tokens["refresh_token"])
+    assert response.status_code == 200, response.text
+    renewed = response.json()
+    assert renewed["access_token"] and renewed["refresh_token"] != tokens["refresh_token"]
+    # the new one works in turn
+    assert (await exchange(client, renewed["refresh_token"])).status_code == 200
+
+
+async def test_unknown_refresh_token_is_rejected(client):
+    await signup(client, "alice")
+    assert (await exchange(client, "not-a-refresh-token")).status_code == 401
+
+
+async def test_reuse_revokes_the_whole_login(client):
+    await signup(client, "alice")
+    tokens = await token_login(client)
+    other_login = await token_login(client)
+    renewed = (await exchange(client, tokens["refresh_token"])).json()
+
+    # replayed, e.g. by whoever copied it: rejected, and the token it was exchanged for goes too
+    assert (await exchange(client, tokens["refresh_token"])).status_code == 401
+    assert (await exchange(client, renewed["refresh_token"])).status_code == 401
+    # logins of their own are left alone
+    assert (await exchange(client, other_login["refresh_token"])).status_code == 200
+
+
+async def test_racing_exchanges_count_as_reuse(client):
+    await signup(client, "alice")
+    tokens = await token_login(client)
+
+    responses = await asyncio.gather(exchange(client, tokens["refresh_token"]),
+                                     exchange(client, tokens["refresh_token"]))
+    assert sorted(response.status_code for response in responses) == [200, 401]
+    # the winner's new token belonged to the revoked family
+    winner = next(response for response in responses if response.status_code == 200)
+    assert (await exchange(client, winner.json()["refresh_token"])).status_code == 401
+    assert await count_refresh_tokens() == 0
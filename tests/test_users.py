@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+from app import crud, services
+from app.database import AsyncSessionLocal
+from app.errors import UserNotFoundError
+from tests.conftest import PASSWORD, login, signup, sync_replica
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_deleting_a_deleted_user_is_not_found(client):
+    user = await signup(client, "alice")
+    async with AsyncSessionLocal() as db:
+        assert (await services.user.delete_user(db, user["id"])).id == user["id"]
+    # a concurrent delete, or a request still carrying the gone user's session
+    async with AsyncSessionLocal() as db:
+        with pytest.raises(UserNotFoundError):
+            await services.user.delete_user(db, user["id"])
+
+
+async def start_token_login(client) -> tuple[dict, str]:
+    """
+    A session and an access token for alice, as PUT /user/me needs both
+    :return:    The Authorization header and the refresh token
+    """
+    await signup(client, "alice")
+    await login(client, "alice")
+    tokens = (await client.post("/session/auth", data={"username": "alice", "password": PASSWORD})).json()
+    return {"Authorization": f"Bearer {tokens['access_token']}"}, tokens["refresh_token"]
+
+
+async def test_password_change_revokes_refresh_tokens(client):
+    authorization, refresh_token = await start_token_login(client)
+    response = await client.put("/user/me", json={"new_password": "new-password"}, headers=authorization)
+    assert response.status_code == 200, response.text
+    assert (await client.post("/session/refresh", data={"refresh_token": refresh_token})).status_code == 401
+
+
+async def test_failed_password_change_keeps_refresh_tokens(client):
+    authorization, refresh_token = await start_token_login(client)
+    await signup(client, "bob")
+    response = await client.put("/user/me", json={"new_password": "new-password", "new_username": "bob"},
+                                headers=authorization)
+    assert response.status_code == 400
+    assert (await client.post("/session/refresh", data={"refresh_token": refresh_token})).status_code == 200
+
+
+async def test_password_and_refresh_tokens_change_together(client, monkeypatch):
+    authorization, refresh_token = await start_token_login(client)
+    revoke = crud.refresh_token.delete_by_user
+
+    async def revoke_then_die(*args, **kwargs):
+        await revoke(*args, **kwargs)
+        raise RuntimeError("worker died")
+
+    monkeypatch.setattr(crud.refresh_token, "delete_by_user", revoke_then_die)
+    with pytest.raises(RuntimeError):
+        await client.put("/user/me", json={"new_password": "new-password"}, headers=authorization)
+
+    # neither happened: the old password still works, and so does the refresh token
+    assert (await login(client, "alice")).status_code == 200
+    assert (await client.post("/session/refresh", data={"refresh_token": refresh_token})).status_code == 200
+
+
+async def signup_many(client, count: int) -> list[int]:
+    ids = [(await signup(client, f"user{index}"))["id"] for index in range(count)]
+    await sync_replica()
+    return ids
+
+
+async def read_all_pages(client, limit: int) -> list[list[int]]:
+    """
+    Follow X-Next-Cursor from the first page to the last
+    :return:    The IDs on every page
+    """
+    pages, params = [], {"limit": limit}
+    while True:
+        response = await client.get("/user/", params=params)
+        assert response.status_code == 200, response.text
+        pages.append([user["id"] for user in response.json()])
+        if "X-Next-Cursor" not in response.headers:
+            return pages
+        params = {"limit": limit, "cursor": response.headers["X-Next-Cursor"]}
+
+
+async def test_cursor_pages_cover_every_user_once(client):
+    ids = await signup_many(client, 5)
+    assert await read_all_pages(client, 2) == [ids[0:2], ids[2:4], ids[4:5]]
+    # a full last page gets a cursor, and the page after it is empty
+    assert await read_all_pages(client, 5) == [ids, []]
+
+
+async def test_cursor_does_not_shift_when_earlier_users_go(client):
+    ids = await signup_many(client, 4)
+    response = await client.get("/user/", params={"limit": 2})
+    cursor = response.headers["X-Next-Cursor"]
+
+    async with AsyncSessionLocal() as db:
+        await services.user.delete_user(db, ids[0])
+    await sync_replica()
+    response = await client.get("/user/", params={"limit": 2, "cursor": cursor})
+    assert [user["id"] for user in response.json()] == ids[2:4]
+
+
+@pytest.mark.parametrize("cursor", ["not-base64!", services.user.encode_cursor(1)[:-2], "eyJ4IjogMX0",
+                                    "eyJpZCI6ICIxIn0"])
+async def test_bad_cursor_is_rejected(client, cursor):
+    response = await client.get("/user/", params={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("Invalid pagination cursor")
+
+
+async def test_export_streams_every_user_as_ndjson(client, monkeypatch):
+    monkeypatch.setattr(services.user, "EXPORT_BATCH_SIZE", 2)
+    ids = await signup_many(client, 5)
+
+    response = await client.get("/user/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert response.text.endswith("\n")
+    assert [json.loads(line)["id"] for line in lines] == ids
+    assert "hashed_password" not in lines[0]